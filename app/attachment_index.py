@@ -0,0 +1,192 @@
+import asyncio
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from pathlib import Path
+
+import structlog
+
+from metrics import ATTACHMENT_DEDUP_SAVED_BYTES
+from settings import get_settings
+
+logger = structlog.get_logger(__name__)
+
+
+class AttachmentIndex:
+    """Remembers the backend attachment every Telegram file produced, and keeps recent files on disk.
+
+    Files are identified by Telegram's ``file_unique_id`` and size, which are the same for
+    a forwarded or re-sent file. A file already attached to the task isn't uploaded again;
+    a file attached to another task is uploaded from its local copy (a blob) instead of being
+    downloaded from Telegram again. The index lives in SQLite in WAL mode, so worker processes
+    on one host share it.
+
+    Retention: records are forgotten after ``ttl`` seconds, blobs after ``blob_ttl`` seconds
+    without use, and the least recently used blobs are deleted once they take more than
+    ``blob_max_total_size`` bytes (0 keeps no blobs).
+    """
+
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path: Path, blob_dir: Path, ttl: float, blob_ttl: float, blob_max_total_size: int) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        blob_dir.mkdir(parents=True, exist_ok=True)
+        self._blob_dir = blob_dir
+        self._ttl = ttl
+        self._blob_ttl = blob_ttl
+        self._blob_max_total_size = blob_max_total_size
+        # one thread owns the connection, so queries never run concurrently on it
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='attachment-index')
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('PRAGMA busy_timeout=5000')
+        self._connection.executescript(
+            'CREATE TABLE IF NOT EXISTS attachments ('
+            'file_unique_id TEXT NOT NULL, file_size INTEGER NOT NULL, task_id INTEGER NOT NULL, '
+            'attachment_url TEXT NOT NULL, created_at REAL NOT NULL, '
+            'PRIMARY KEY (file_unique_id, file_size, task_id));'
+            'CREATE TABLE IF NOT EXISTS blobs ('
+            'file_unique_id TEXT NOT NULL, file_size INTEGER NOT NULL, used_at REAL NOT NULL, '
+            'PRIMARY KEY (file_unique_id, file_size));'
+            'CREATE TABLE IF NOT EXISTS savings ('
+            'direction TEXT PRIMARY KEY, files INTEGER NOT NULL, bytes INTEGER NOT NULL);'
+        )
+        self._purged_at = 0.0
+
+    async def find_attachment(self, file_unique_id: str, file_size: int, task_id: int) -> str | None:
+        return await self._run(self._find_attachment, file_unique_id, file_size, task_id)
+
+    async def add_attachment(self, file_unique_id: str, file_size: int, task_id: int, attachment_url: str) -> None:
+        await self._run(self._add_attachment, file_unique_id, file_size, task_id, attachment_url)
+
+    async def find_blob(self, file_unique_id: str, file_size: int) -> Path | None:
+        """Path of the local copy of the file, it may still be deleted by another process before it's opened."""
+        return await self._run(self._find_blob, file_unique_id, file_size)
+
+    async def add_blob(self, file_unique_id: str, file_size: int, source: Path) -> None:
+        """Moves the downloaded file into the blob directory."""
+        if self._blob_max_total_size:
+            await self._run(self._add_blob, file_unique_id, file_size, source)
+
+    async def record_saving(self, direction: str, size: int) -> None:
+        """``direction`` is ``download`` (from Telegram) or ``upload`` (to the backend)."""
+        ATTACHMENT_DEDUP_SAVED_BYTES.labels(direction).inc(size)
+        await self._run(self._record_saving, direction, size)
+
+    async def get_savings(self) -> dict[str, tuple[int, int]]:
+        """Files and bytes that were not transferred, per direction, since the index was created."""
+        return await self._run(self._get_savings)
+
+    async def close(self) -> None:
+        for direction, (files, size) in (await self.get_savings()).items():
+            logger.info('attachment transfers saved', direction=direction, files=files, bytes=size)
+        await self._run(self._connection.close)
+        self._executor.shutdown()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _get_blob_path(self, file_unique_id: str, file_size: int) -> Path:
+        return self._blob_dir / f'{file_unique_id}-{file_size}'
+
+    def _find_attachment(self, file_unique_id: str, file_size: int, task_id: int) -> str | None:
+        row = self._connection.execute(
+            'SELECT attachment_url FROM attachments '
+            'WHERE file_unique_id = ? AND file_size = ? AND task_id = ? AND created_at > ?',
+            (file_unique_id, file_size, task_id, time.time() - self._ttl),
+        ).fetchone()
+        return row[0] if row else None
+
+    def _add_attachment(self, file_unique_id: str, file_size: int, task_id: int, attachment_url: str) -> None:
+        self._connection.execute(
+            'INSERT OR REPLACE INTO attachments (file_unique_id, file_size, task_id, attachment_url, created_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (file_unique_id, file_size, task_id, attachment_url, time.time()),
+        )
+        self._purge()
+
+    def _find_blob(self, file_unique_id: str, file_size: int) -> Path | None:
+        now = time.time()
+        cursor = self._connection.execute(
+            'UPDATE blobs SET used_at = ? WHERE file_unique_id = ? AND file_size = ? AND used_at > ?',
+            (now, file_unique_id, file_size, now - self._blob_ttl),
+        )
+        if not cursor.rowcount:
+            return None
+        path = self._get_blob_path(file_unique_id, file_size)
+        if not path.exists():
+            # removed behind the index's back, e.g. the data directory was cleaned up
+            self._connection.execute(
+                'DELETE FROM blobs WHERE file_unique_id = ? AND file_size = ?', (file_unique_id, file_size),
+            )
+            return None
+        return path
+
+    def _add_blob(self, file_unique_id: str, file_size: int, source: Path) -> None:
+        if file_size > self._blob_max_total_size:
+            return
+        # the spool may be on another filesystem, then this is a copy
+        shutil.move(source, self._get_blob_path(file_unique_id, file_size))
+        self._connection.execute(
+            'INSERT OR REPLACE INTO blobs (file_unique_id, file_size, used_at) VALUES (?, ?, ?)',
+            (file_unique_id, file_size, time.time()),
+        )
+        self._evict_blobs()
+
+    def _record_saving(self, direction: str, size: int) -> None:
+        self._connection.execute(
+            'INSERT INTO savings (direction, files, bytes) VALUES (?, 1, ?) '
+            'ON CONFLICT(direction) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes',
+            (direction, size),
+        )
+
+    def _get_savings(self) -> dict[str, tuple[int, int]]:
+        rows = self._connection.execute('SELECT direction, files, bytes FROM savings').fetchall()
+        return {direction: (files, size) for direction, files, size in rows}
+
+    def _purge(self) -> None:
+        now = time.time()
+        if now - self._purged_at < self.PURGE_INTERVAL:
+            return
+        self._purged_at = now
+        self._connection.execute('DELETE FROM attachments WHERE created_at <= ?', (now - self._ttl,))
+        expired = self._connection.execute(
+            'SELECT file_unique_id, file_size FROM blobs WHERE used_at <= ?', (now - self._blob_ttl,),
+        ).fetchall()
+        self._delete_blobs(expired)
+
+    def _evict_blobs(self) -> None:
+        total_size = 0
+        evicted = []
+        rows = self._connection.execute('SELECT file_unique_id, file_size FROM blobs ORDER BY used_at DESC')
+        for file_unique_id, file_size in rows:
+            total_size += file_size
+            if total_size > self._blob_max_total_size:
+                evicted.append((file_unique_id, file_size))
+        self._delete_blobs(evicted)
+
+    def _delete_blobs(self, blobs: list[tuple[str, int]]) -> None:
+        if not blobs:
+            return
+        self._connection.executemany('DELETE FROM blobs WHERE file_unique_id = ? AND file_size = ?', blobs)
+        for file_unique_id, file_size in blobs:
+            self._get_blob_path(file_unique_id, file_size).unlink(missing_ok=True)
+        logger.info('attachment blobs deleted', count=len(blobs))
+
+
+@cache
+def get_attachment_index() -> AttachmentIndex | None:
+    """``None`` when ``ATTACHMENT_DEDUP`` is off."""
+    settings = get_settings()
+    if not settings.attachment_dedup:
+        return None
+    return AttachmentIndex(
+        settings.attachment_index_path,
+        blob_dir=settings.attachment_blob_dir,
+        ttl=settings.attachment_index_ttl,
+        blob_ttl=settings.attachment_blob_ttl,
+        blob_max_total_size=settings.attachment_blob_max_total_size,
+    )
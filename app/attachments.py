@@ -0,0 +1,660 @@
+import asyncio
+import os
+import random
+import tempfile
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import cache
+from pathlib import Path
+from typing import AsyncGenerator, Awaitable, Callable, Hashable, Iterator
+
+import aiofiles
+import aiohttp
+import httpx
+import structlog
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import Animation, Audio, Document, File, Message, PhotoSize, Video
+from aiohttp import StreamReader
+
+import constants
+from attachment_index import AttachmentIndex, get_attachment_index
+from metrics import (
+    ATTACHMENT_DEDUP, ATTACHMENT_TRANSFERS_WAITING, ATTACHMENT_UPLOAD_BYTES, ATTACHMENT_UPLOAD_THROUGHPUT,
+)
+from settings import get_settings
+from url import Url
+
+logger = structlog.get_logger(__name__)
+
+
+class AttachmentUploadError(Exception):
+    pass
+
+
+class BandwidthLimiter:
+    """Token bucket over bytes, shared by all uploads of the process. ``0`` means unlimited."""
+
+    def __init__(self, bytes_per_second: int) -> None:
+        self._rate = bytes_per_second
+        self._allowance = float(bytes_per_second)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def consume(self, size: int) -> None:
+        if not self._rate:
+            return
+
+        # waiting under the lock queues uploads up fairly instead of letting them race for the budget
+        async with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self._rate, self._allowance + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+
+            self._allowance -= size
+            if self._allowance < 0:
+                await asyncio.sleep(-self._allowance / self._rate)
+
+
+@cache
+def get_bandwidth_limiter() -> BandwidthLimiter:
+    return BandwidthLimiter(get_settings().attachment_bandwidth_limit)
+
+
+class MemoryBudget:
+    """Caps the bytes all relays of the process may buffer at once, waiters are served in FIFO order."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self._max_bytes = max_bytes
+        self._available = max_bytes
+        self._waiters: deque[tuple[int, asyncio.Future]] = deque()
+
+    async def acquire(self, size: int) -> int:
+        # a single relay may never need more than the whole budget, otherwise it would wait forever
+        size = min(size, self._max_bytes)
+        if not self._waiters and self._available >= size:
+            self._available -= size
+            return size
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append((size, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(size)
+            raise
+        return size
+
+    def release(self, size: int) -> None:
+        self._available += size
+        while self._waiters:
+            size, waiter = self._waiters[0]
+            if waiter.done():
+                self._waiters.popleft()
+            elif size <= self._available:
+                self._waiters.popleft()
+                self._available -= size
+                waiter.set_result(None)
+            else:
+                break
+
+
+@cache
+def get_memory_budget() -> MemoryBudget:
+    return MemoryBudget(get_settings().attachment_memory_budget)
+
+
+@cache
+def get_transfer_slots() -> asyncio.Semaphore:
+    # caps the transfers of all chats together, ATTACHMENT_UPLOAD_CONCURRENCY only applies within a batch
+    return asyncio.Semaphore(get_settings().attachment_max_transfers)
+
+
+MIN_CHUNK_SIZE = 64 * 1024
+
+
+def get_read_buffer_size(content_length: int | None) -> int:
+    """Read buffer for a download: small files don't need big buffers, big ones are capped per upload."""
+    if not content_length:
+        return MIN_CHUNK_SIZE
+    buffer_size = 1 << max(content_length // 8, 1).bit_length()
+    return max(MIN_CHUNK_SIZE, min(buffer_size, get_settings().attachment_max_chunk_size))
+
+
+class ChunkSizer:
+    """Sizes chunks so that one chunk takes about ``TARGET_CHUNK_INTERVAL`` at the measured throughput."""
+
+    TARGET_CHUNK_INTERVAL = 0.05
+    SMOOTHING = 0.2
+
+    def __init__(self, content_length: int | None, max_chunk_size: int) -> None:
+        self._max_chunk_size = max_chunk_size
+        self._throughput: float | None = None
+        self.chunk_size = self._clamp((content_length or 0) // 8)
+
+    def record(self, size: int, elapsed: float) -> None:
+        if elapsed <= 0:
+            return
+        throughput = size / elapsed
+        if self._throughput is None:
+            self._throughput = throughput
+        else:
+            self._throughput += self.SMOOTHING * (throughput - self._throughput)
+        self.chunk_size = self._clamp(int(self._throughput * self.TARGET_CHUNK_INTERVAL))
+
+    def _clamp(self, chunk_size: int) -> int:
+        return max(MIN_CHUNK_SIZE, min(chunk_size, self._max_chunk_size))
+
+
+class AsyncIterableOverStreamReader:
+    """Relays a download to an upload chunk by chunk.
+
+    Buffers of the ``StreamReader`` are passed on as they are, large ones as ``memoryview`` slices,
+    so no data is copied on the way. How much is buffered is bounded by the download's
+    ``read_bufsize`` (see ``get_read_buffer_size``).
+    """
+
+    def __init__(
+            self,
+            stream_reader: StreamReader,
+            content_length: int | None = None,
+            limiter: BandwidthLimiter | None = None,
+            max_chunk_size: int | None = None,
+    ) -> None:
+        self._stream_reader = stream_reader
+        self._content_length = content_length
+        self._limiter = limiter or get_bandwidth_limiter()
+        self._max_chunk_size = max_chunk_size or get_settings().attachment_max_chunk_size
+
+    async def __aiter__(self) -> AsyncGenerator:
+        sizer = ChunkSizer(self._content_length, self._max_chunk_size)
+        started_at = time.monotonic()
+
+        while True:
+            data, end_of_http_chunk = await self._stream_reader.readchunk()
+            if not data:
+                if end_of_http_chunk:
+                    continue
+                break
+
+            chunk_size = sizer.chunk_size
+            if len(data) <= chunk_size:
+                await self._limiter.consume(len(data))
+                yield data
+            else:
+                view = memoryview(data)
+                for offset in range(0, len(view), chunk_size):
+                    chunk = view[offset:offset + chunk_size]
+                    await self._limiter.consume(len(chunk))
+                    yield chunk
+
+            now = time.monotonic()
+            sizer.record(len(data), now - started_at)
+            started_at = now
+
+
+class UploadTransport:
+    """Long-lived connection pools for the attachment path, made at startup and shared by all uploads.
+
+    Downloads from Telegram go through an aiohttp session, uploads to the backend through
+    an httpx client with keep-alive (and HTTP/2 when enabled, which needs ``httpx[http2]``
+    and an https backend).
+    """
+
+    def __init__(self) -> None:
+        self._telegram: aiohttp.ClientSession | None = None
+        self._backend: httpx.AsyncClient | None = None
+
+    async def start(self) -> None:
+        if self._telegram is not None:
+            return
+
+        settings = get_settings()
+        self._telegram = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=settings.attachment_max_connections,
+                keepalive_timeout=settings.attachment_keepalive_expiry,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                connect=settings.attachment_connect_timeout,
+                sock_read=settings.attachment_read_timeout,
+            ),
+        )
+        self._backend = httpx.AsyncClient(
+            http2=settings.attachment_http2,
+            limits=httpx.Limits(
+                max_connections=settings.attachment_max_connections,
+                max_keepalive_connections=settings.attachment_max_connections,
+                keepalive_expiry=settings.attachment_keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                connect=settings.attachment_connect_timeout,
+                read=settings.attachment_read_timeout,
+                write=settings.attachment_write_timeout,
+                pool=settings.attachment_pool_timeout,
+            ),
+        )
+        logger.info('upload transport started', http2=settings.attachment_http2)
+
+    async def close(self) -> None:
+        if self._telegram is None:
+            return
+
+        await self._telegram.close()
+        await self._backend.aclose()
+        self._telegram = self._backend = None
+        logger.info('upload transport closed')
+
+    @property
+    def telegram(self) -> aiohttp.ClientSession:
+        if self._telegram is None:
+            raise RuntimeError('Upload transport is not started')
+        return self._telegram
+
+    @property
+    def backend(self) -> httpx.AsyncClient:
+        if self._backend is None:
+            raise RuntimeError('Upload transport is not started')
+        return self._backend
+
+
+upload_transport = UploadTransport()
+
+
+class ResumableRelay:
+    """Body of an attachment upload that survives failures on both sides of the relay.
+
+    A download broken mid-stream is resumed with an HTTP Range request. The bytes are also
+    spooled to a temporary file (when ``spool_path`` is given), so iterating the relay again
+    for a retried backend upload replays the spool instead of downloading the file again.
+    """
+
+    def __init__(
+            self,
+            session: aiohttp.ClientSession,
+            file_url: str,
+            file_size: int | None,
+            spool_path: Path | None,
+    ) -> None:
+        self._session = session
+        self._file_url = file_url
+        self._file_size = file_size
+        self._spool_path = spool_path
+        self._spooled = 0
+
+    @property
+    def spooled_all(self) -> bool:
+        """The whole file is in the spool, it can be kept as a blob of the attachment index."""
+        return self._spool_path is not None and self._file_size is not None and self._spooled == self._file_size
+
+    async def __aiter__(self) -> AsyncGenerator:
+        offset = 0
+        if self._spool_path is not None and self._spooled:
+            async with aiofiles.open(self._spool_path, 'rb') as spool:
+                while offset < self._spooled:
+                    chunk = await spool.read(min(get_settings().attachment_max_chunk_size, self._spooled - offset))
+                    offset += len(chunk)
+                    ATTACHMENT_UPLOAD_BYTES.inc(len(chunk))
+                    yield chunk
+
+        async for chunk in self._download(offset):
+            yield chunk
+
+    async def _download(self, offset: int) -> AsyncGenerator:
+        failures = 0
+        spool = await aiofiles.open(self._spool_path, 'r+b' if self._spooled else 'wb') if self._spool_path else None
+        try:
+            if spool is not None:
+                await spool.seek(offset)
+
+            while self._file_size is None or offset < self._file_size:
+                try:
+                    async for chunk in self._request_from(offset):
+                        if spool is not None:
+                            await spool.write(chunk)
+                            self._spooled = offset + len(chunk)
+                        offset += len(chunk)
+                        ATTACHMENT_UPLOAD_BYTES.inc(len(chunk))
+                        yield chunk
+                    if self._file_size is None:
+                        break
+                    if offset < self._file_size:
+                        raise aiohttp.ClientPayloadError(f'download ended at {offset} of {self._file_size} bytes')
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    failures += 1
+                    if failures > get_settings().attachment_max_retries:
+                        raise
+                    logger.info('telegram download failed, resuming', offset=offset, attempt=failures, error=repr(e))
+                    await asyncio.sleep(get_retry_backoff(failures))
+        finally:
+            if spool is not None:
+                await spool.close()
+
+    async def _request_from(self, offset: int) -> AsyncGenerator:
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        remaining = self._file_size - offset if self._file_size is not None else None
+
+        async with self._session.get(
+                self._file_url, headers=headers, read_bufsize=get_read_buffer_size(remaining),
+        ) as response:
+            if response.status not in (200, 206):
+                raise AttachmentUploadError(f'Telegram responded with {response.status} to the file download')
+
+            skip = offset if response.status == 200 else 0
+            async for chunk in AsyncIterableOverStreamReader(response.content, remaining):
+                if skip:
+                    # the server ignored Range and sent the whole file, drop what we already have
+                    dropped = min(skip, len(chunk))
+                    skip -= dropped
+                    chunk = chunk[dropped:]
+                    if not chunk:
+                        continue
+                yield chunk
+
+
+class BlobBody:
+    """Body of an upload from a file kept by the attachment index, iterating it again replays the file.
+
+    The file is opened before the upload starts: a blob another process evicted in the meantime
+    is noticed while the file can still be downloaded from Telegram instead.
+    """
+
+    def __init__(self, file) -> None:
+        self._file = file
+
+    @classmethod
+    async def open(cls, path: Path) -> 'BlobBody':
+        return cls(await aiofiles.open(path, 'rb'))
+
+    async def __aiter__(self) -> AsyncGenerator:
+        await self._file.seek(0)
+        chunk_size = get_settings().attachment_max_chunk_size
+        limiter = get_bandwidth_limiter()
+        while chunk := await self._file.read(chunk_size):
+            await limiter.consume(len(chunk))
+            yield chunk
+
+    async def close(self) -> None:
+        await self._file.close()
+
+
+async def open_blob(index: AttachmentIndex, media: Document | Animation | Audio | Video | PhotoSize) -> BlobBody | None:
+    path = await index.find_blob(media.file_unique_id, media.file_size)
+    if path is None:
+        return None
+    try:
+        return await BlobBody.open(path)
+    except FileNotFoundError:
+        return None
+
+
+def get_retry_backoff(attempt: int) -> float:
+    return get_settings().attachment_retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+
+@contextmanager
+def spool_file(file_size: int | None) -> Iterator[Path | None]:
+    """Temporary file to spool a download to, ``None`` for files above ``ATTACHMENT_SPOOL_MAX_SIZE``."""
+    settings = get_settings()
+    if file_size is None or file_size > settings.attachment_spool_max_size:
+        yield None
+        return
+
+    fd, path = tempfile.mkstemp(prefix='attachment-', dir=settings.attachment_spool_dir)
+    os.close(fd)
+    try:
+        yield Path(path)
+    finally:
+        Path(path).unlink(missing_ok=True)
+
+
+async def upload_attachment(message: Message, task_id: int) -> str:
+    """Streams the file of the message from Telegram to the backend, returns the attachment url.
+
+    With ``ATTACHMENT_DEDUP`` a file already attached to the task is not uploaded again, and a file
+    the index still keeps on disk is uploaded from there without downloading it from Telegram.
+    """
+    media = get_tg_media(message)
+    # Telegram may not know the size, such files can't be matched reliably
+    index = get_attachment_index() if media.file_size else None
+    if index is not None:
+        attachment_url = await index.find_attachment(media.file_unique_id, media.file_size, task_id)
+        if attachment_url is not None:
+            ATTACHMENT_DEDUP.labels(result='linked').inc()
+            await index.record_saving('download', media.file_size)
+            await index.record_saving('upload', media.file_size)
+            logger.info(
+                'attachment already uploaded', attachment_url=attachment_url, task_id=task_id,
+                command='add_attachment_to_task',
+            )
+            return attachment_url
+
+    headers = {
+        # NOTE (SemenK): as of 2025-07-04 telegram doesn't keep filename for images.
+        # so if filename is None, it means it's an image => .jpg
+        'Filename': get_tg_file_name(message) or 'autogenerated_filename.jpg',
+        "Content-Length": str(media.file_size),
+    }
+    blob = await open_blob(index, media) if index is not None else None
+    if blob is None:
+        file = await get_tg_file(message)
+        tg_file_url = get_tg_file_url(message, file)
+
+    transfer_slots = get_transfer_slots()
+    ATTACHMENT_TRANSFERS_WAITING.inc()
+    try:
+        await transfer_slots.acquire()
+    finally:
+        ATTACHMENT_TRANSFERS_WAITING.dec()
+
+    started_at = time.perf_counter()
+    try:
+        if blob is not None:
+            try:
+                upload_response = await _post_with_retries(Url('task_attachments', task_id), blob, headers)
+            finally:
+                await blob.close()
+        else:
+            # aiohttp buffers up to twice the read buffer before it stops reading from the socket
+            memory_budget = get_memory_budget()
+            reserved = await memory_budget.acquire(2 * get_read_buffer_size(media.file_size))
+            try:
+                with spool_file(media.file_size) as spool_path:
+                    relay = ResumableRelay(upload_transport.telegram, tg_file_url, media.file_size, spool_path)
+                    upload_response = await _post_with_retries(
+                        Url('task_attachments', task_id), relay, headers,
+                    )
+                    if upload_response.status_code == 201 and index is not None and relay.spooled_all:
+                        await index.add_blob(media.file_unique_id, media.file_size, spool_path)
+            finally:
+                memory_budget.release(reserved)
+    finally:
+        transfer_slots.release()
+
+    if upload_response.status_code != 201:
+        logger.info(
+            'something went wrong during attachment upload',
+            response=upload_response.text, task_id=task_id, command='add_attachment_to_task',
+        )
+        raise AttachmentUploadError(upload_response.text)
+
+    if media.file_size:
+        ATTACHMENT_UPLOAD_THROUGHPUT.observe(media.file_size / (time.perf_counter() - started_at))
+
+    attachment_url = upload_response.json()['attachment_url']
+    if index is not None:
+        await index.add_attachment(media.file_unique_id, media.file_size, task_id, attachment_url)
+        if blob is not None:
+            await index.record_saving('download', media.file_size)
+    ATTACHMENT_DEDUP.labels(result='uploaded' if blob is None else 'local').inc()
+    logger.info(
+        'attachment uploaded', attachment_url=attachment_url, task_id=task_id, from_blob=blob is not None,
+        command='add_attachment_to_task',
+    )
+    return attachment_url
+
+
+async def _post_with_retries(url: Url, relay: ResumableRelay | BlobBody, headers: dict[str, str]) -> httpx.Response:
+    max_retries = get_settings().attachment_max_retries
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            response = await upload_transport.backend.post(str(url), content=relay, headers=headers)
+        except httpx.TransportError as e:
+            if attempt > max_retries:
+                raise
+            logger.info('attachment upload to backend failed, retrying', url=str(url), attempt=attempt, error=repr(e))
+        else:
+            if response.status_code < 500 or attempt > max_retries:
+                return response
+            logger.info('backend failed to store attachment, retrying', url=str(url), status=response.status_code)
+
+        await asyncio.sleep(get_retry_backoff(attempt))
+
+
+def get_tg_media(message: Message) -> Document | Animation | Audio | Video | PhotoSize:
+    if message.document:
+        return message.document
+    elif message.animation:
+        return message.animation
+    elif message.audio:
+        return message.audio
+    elif message.video:
+        return message.video
+    elif message.photo:
+        return message.photo[-1]
+    else:
+        raise ValueError('File must be either document or animation or audio or video or photo')
+
+
+async def get_tg_file(message: Message) -> File:
+    file = await message.bot.get_file(get_tg_media(message).file_id)
+    return file
+
+
+def get_tg_file_url(message: Message, file: File) -> str:
+    return message.bot.session.api.file_url(message.bot.token, file.file_path)
+
+
+def get_tg_file_name(message: Message) -> str | None:
+    if message.document or message.animation:
+        return message.document.file_name
+    elif message.animation:
+        return message.animation.file_name
+    elif message.audio:
+        return message.audio.file_name
+    elif message.video:
+        return message.video.file_name
+    elif message.photo:
+        return None
+    else:
+        raise ValueError('File must be either document or animation or audio or video or photo')
+
+
+class AttachmentBatcher:
+    """Collects an album or a burst of files sent to one chat for one target into a single batch.
+
+    The target is what the files are uploaded to (a task id): files for different targets are never
+    merged, each batch is handed over to the ``on_batch`` it was started with once no new file
+    arrived for ``window`` seconds.
+    """
+
+    def __init__(self, window: float, max_size: int) -> None:
+        self._window = window
+        self._max_size = max_size
+        self._batches: dict[tuple[int, Hashable], list[Message]] = {}
+        self._callbacks: dict[tuple[int, Hashable], Callable[[list[Message]], Awaitable[None]]] = {}
+        self._timers: dict[tuple[int, Hashable], asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+        # albums whose first item has been added, the rest of the album goes to the same batch
+        self._albums: dict[str, tuple[Hashable, Callable[[list[Message]], Awaitable[None]]]] = {}
+
+    def add(self, message: Message, target: Hashable, on_batch: Callable[[list[Message]], Awaitable[None]]) -> None:
+        if message.media_group_id is not None:
+            self._albums.setdefault(message.media_group_id, (target, on_batch))
+
+        key = (message.chat.id, target)
+        batch = self._batches.setdefault(key, [])
+        batch.append(message)
+        # a burst of one target is uploaded by the callback that started it
+        self._callbacks.setdefault(key, on_batch)
+
+        if timer := self._timers.pop(key, None):
+            timer.cancel()
+
+        if len(batch) >= self._max_size:
+            self._flush(key)
+        else:
+            self._timers[key] = asyncio.get_running_loop().call_later(self._window, self._flush, key)
+
+    def has_album(self, media_group_id: str) -> bool:
+        return media_group_id in self._albums
+
+    def add_to_album(self, message: Message) -> None:
+        self.add(message, *self._albums[message.media_group_id])
+
+    def _flush(self, key: tuple[int, Hashable]) -> None:
+        self._timers.pop(key, None)
+        batch = self._batches.pop(key)
+        on_batch = self._callbacks.pop(key)
+        for message in batch:
+            self._albums.pop(message.media_group_id, None)
+
+        task = asyncio.create_task(on_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+@cache
+def get_attachment_batcher() -> AttachmentBatcher:
+    settings = get_settings()
+    return AttachmentBatcher(window=settings.attachment_batch_window, max_size=settings.attachment_batch_max_size)
+
+
+class UploadProgress:
+    """Keeps one progress message per batch up to date, edits are throttled to ``edit_interval``."""
+
+    def __init__(self, progress_message: Message, total: int, edit_interval: float) -> None:
+        self._progress_message = progress_message
+        self._total = total
+        self._edit_interval = edit_interval
+        self._edited_at = 0.0
+        self._text = progress_message.text
+        self.uploaded: list[tuple[str, str]] = []
+        self.failed: list[tuple[str, str]] = []
+
+    async def file_uploaded(self, file_name: str, attachment_url: str) -> None:
+        self.uploaded.append((file_name, attachment_url))
+        await self._refresh()
+
+    async def file_failed(self, file_name: str, error: str) -> None:
+        self.failed.append((file_name, error))
+        await self._refresh()
+
+    async def finish(self) -> None:
+        lines = [f'Uploaded {len(self.uploaded)}/{self._total} attachment(s)']
+        lines += [attachment_url for _, attachment_url in self.uploaded]
+        if self.failed:
+            lines.append(f'\nFailed {len(self.failed)}:')
+            lines += [f'{file_name}: {error}' for file_name, error in self.failed]
+        await self._edit('\n'.join(lines))
+
+    async def _refresh(self) -> None:
+        if time.monotonic() - self._edited_at < self._edit_interval:
+            return
+        done = len(self.uploaded) + len(self.failed)
+        failed = f', {len(self.failed)} failed' if self.failed else ''
+        await self._edit(f'Uploading attachments: {done}/{self._total} done{failed}')
+
+    async def _edit(self, text: str) -> None:
+        if text == self._text:
+            return
+        self._text = text
+        self._edited_at = time.monotonic()
+        try:
+            await self._progress_message.edit_text(text[:constants.TELEGRAM_MESSAGE_MAX_LENGTH])
+        except (TelegramAPIError, aiohttp.ClientError) as e:
+            # progress is best-effort, a flood limit or a network error must not fail the whole batch
+            logger.info('failed to edit upload progress', error=str(e))
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import random
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import cache
+from typing import AsyncIterator, Callable
+
+import aiohttp
+import structlog
+
+from cache import TTLCache
+from metrics import BACKEND_REQUEST_DURATION, BACKEND_REQUESTS_WAITING
+from settings import get_settings
+from url import Url
+
+logger = structlog.get_logger(__name__)
+
+RETRYABLE_STATUSES = frozenset({502, 503, 504})
+
+
+@dataclass(frozen=True)
+class BackendResponse:
+    status: int
+    body: bytes
+
+    def json(self):
+        return json.loads(self.body)
+
+    def text(self) -> str:
+        return self.body.decode()
+
+
+class BackendClient:
+    """Long-lived pooled HTTP client for the TMS backend.
+
+    One ``aiohttp.ClientSession`` is shared by all handlers, so connections are kept alive
+    between user steps instead of opening a new TCP connection per backend call.
+    Idempotent GET requests are retried with exponential backoff.
+    At most ``max_concurrency`` requests are in flight, the rest wait for a free slot.
+    """
+
+    def __init__(
+            self,
+            limit: int,
+            limit_per_host: int,
+            keepalive_timeout: float,
+            connect_timeout: float,
+            total_timeout: float,
+            get_retries: int,
+            retry_backoff: float,
+            cache_max_size: int,
+            cache_ttl: float,
+            max_concurrency: int,
+    ) -> None:
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self._get_retries = get_retries
+        self._retry_backoff = retry_backoff
+        self._session: aiohttp.ClientSession | None = None
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._response_listeners: list[Callable[[Url, BackendResponse], None]] = []
+        self.cache: TTLCache[Url, BackendResponse] = TTLCache(max_size=cache_max_size, ttl=cache_ttl)
+
+    async def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                keepalive_timeout=self._keepalive_timeout,
+            ),
+            timeout=self._timeout,
+        )
+        logger.info('backend client started', limit=self._limit, limit_per_host=self._limit_per_host)
+
+    async def close(self) -> None:
+        if self._session is None:
+            return
+
+        await self._session.close()
+        self._session = None
+        logger.info('backend client closed')
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError('Backend client is not started')
+        return self._session
+
+    @asynccontextmanager
+    async def request(self, method: str, url: Url, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        # the slot is held until the response is released, the body is part of the request
+        BACKEND_REQUESTS_WAITING.inc()
+        try:
+            await self._slots.acquire()
+        finally:
+            BACKEND_REQUESTS_WAITING.dec()
+
+        try:
+            response = await self._send(method, url, **kwargs)
+            try:
+                yield response
+            finally:
+                response.release()
+        finally:
+            self._slots.release()
+
+    async def get_cached(self, url: Url) -> BackendResponse:
+        """GET through the read-through cache, only successful responses are cached."""
+        return await self.cache.get_or_load(
+            url,
+            loader=lambda: self._get(url),
+            should_cache=lambda response: response.status == 200,
+        )
+
+    def invalidate(self, url: Url) -> None:
+        self.cache.invalidate(url)
+
+    def add_response_listener(self, listener: Callable[[Url, BackendResponse], None]) -> None:
+        """The listener is called with every response loaded by ``get_cached``."""
+        self._response_listeners.append(listener)
+
+    async def _get(self, url: Url) -> BackendResponse:
+        async with self.request('get', url) as response:
+            backend_response = BackendResponse(status=response.status, body=await response.read())
+        for listener in self._response_listeners:
+            listener(url, backend_response)
+        return backend_response
+
+    async def _send(self, method: str, url: Url, **kwargs) -> aiohttp.ClientResponse:
+        attempts = 1 + (self._get_retries if method.upper() == 'GET' else 0)
+
+        for attempt in range(1, attempts + 1):
+            started_at = time.perf_counter()
+            try:
+                response = await self.session.request(method, str(url), **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self._observe(method, url, 'error', started_at)
+                if attempt == attempts:
+                    raise
+                logger.info('backend request failed, retrying', url=str(url), attempt=attempt, error=repr(e))
+            else:
+                self._observe(method, url, response.status, started_at)
+                if response.status not in RETRYABLE_STATUSES or attempt == attempts:
+                    return response
+                response.release()
+                logger.info('backend responded with retryable status', url=str(url), status=response.status)
+
+            await asyncio.sleep(self._get_backoff(attempt))
+
+    @staticmethod
+    def _observe(method: str, url: Url, status: int | str, started_at: float) -> None:
+        # the template, not the endpoint: ids would make a time series per resource
+        BACKEND_REQUEST_DURATION.labels(
+            method=method.upper(), endpoint=url.template, status=str(status),
+        ).observe(time.perf_counter() - started_at)
+
+    def _get_backoff(self, attempt: int) -> float:
+        return self._retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+
+@cache
+def get_backend() -> BackendClient:
+    settings = get_settings()
+    return BackendClient(
+        limit=settings.backend_connection_limit,
+        limit_per_host=settings.backend_connection_limit_per_host,
+        keepalive_timeout=settings.backend_keepalive_timeout,
+        connect_timeout=settings.backend_connect_timeout,
+        total_timeout=settings.backend_total_timeout,
+        get_retries=settings.backend_get_retries,
+        retry_backoff=settings.backend_retry_backoff,
+        cache_max_size=settings.backend_cache_max_size,
+        cache_ttl=settings.backend_cache_ttl,
+        max_concurrency=settings.backend_max_concurrency,
+    )
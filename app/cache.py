@@ -0,0 +1,72 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class TTLCache(Generic[K, V]):
+    """Bounded LRU cache whose entries expire after ``ttl`` seconds.
+
+    Concurrent misses for the same key share one call of the loader.
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._loading: dict[K, asyncio.Future[V]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get_or_load(
+            self,
+            key: K,
+            loader: Callable[[], Awaitable[V]],
+            should_cache: Callable[[V], bool] = lambda _: True,
+    ) -> V:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+
+        self.misses += 1
+
+        loading = self._loading.get(key)
+        if loading is None:
+            # the load runs as its own task, so a cancelled caller doesn't cancel it for the others
+            loading = asyncio.ensure_future(loader())
+            self._loading[key] = loading
+            loading.add_done_callback(lambda task: self._on_loaded(key, task, should_cache))
+
+        return await asyncio.shield(loading)
+
+    def invalidate(self, key: K) -> None:
+        self._entries.pop(key, None)
+        self._loading.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _on_loaded(self, key: K, loading: asyncio.Future[V], should_cache: Callable[[V], bool]) -> None:
+        failed = loading.cancelled() or loading.exception() is not None
+
+        # a key invalidated while loading must not be cached with a possibly stale value
+        if self._loading.get(key) is not loading:
+            return
+        del self._loading[key]
+
+        if not failed and should_cache(loading.result()):
+            self._set(key, loading.result())
+
+    def _set(self, key: K, value: V) -> None:
+        self._entries[key] = (time.monotonic() + self._ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
@@ -1,14 +1,14 @@
 import json
 
-import aiohttp
 import structlog
 from aiogram import Router
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import Message
 
-import utils
+from backend_client import get_backend
+from rendering import answer_json
 from url import Url
 
 logger = structlog.get_logger(__name__)
@@ -23,7 +23,21 @@ class CreateCommentStates(StatesGroup):
 
 
 @comment_router.message(Command('create_comment'))
-async def create_comment(message: Message, state: FSMContext) -> None:
+async def create_comment(message: Message, state: FSMContext, command: CommandObject, raw_state: str | None) -> None:
+    # one-shot form: /create_comment <task_id> <user_id> <text>
+    if command.args:
+        if raw_state is not None:
+            await state.clear()
+        try:
+            task_id, user_id, text = command.args.split(maxsplit=2)
+            comment_data = {'text': text, 'user_id': int(user_id), 'task_id': int(task_id)}
+        except ValueError:
+            await message.answer('Usage: /create_comment <task_id> <user_id> <text>')
+            return
+        logger.info('one-shot command', command='create_comment', task_id=comment_data['task_id'])
+        await _create_comment(message, comment_data)
+        return
+
     await state.clear()
 
     logger.info('start command', command='create_comment')
@@ -64,21 +78,25 @@ async def task_id_chosen(message: Message, state: FSMContext) -> None:
     await state.update_data(task_id=task_id)
     comment_data = await state.get_data()
 
-    async with aiohttp.request(
+    await _create_comment(message, comment_data)
+    await state.clear()
+
+
+async def _create_comment(message: Message, comment_data: dict) -> None:
+    async with get_backend().request(
             'post',
-            url=str(Url(endpoint='tasks/comments/')),
+            url=Url('comments'),
             json=comment_data,
     ) as response:
-        if response.status == 201:
-            logger.info('comment created', comment=(await response.json()))
-            await message.answer(
-                utils.make_pretty_json_in_telegram(json.dumps(await response.json())),
-                parse_mode='Markdown',
-            )
-        else:
-            await message.answer(await response.text())
+        # the backend slot is released before replying, replies may wait for Telegram flood limits
+        status, body = response.status, await response.read()
 
-        await state.clear()
+    if status == 201:
+        logger.info('comment created', comment=json.loads(body))
+        get_backend().invalidate(Url('task', comment_data["task_id"]))
+        await answer_json(message, body, 'comment.json')
+    else:
+        await message.answer(body.decode())
 
 
 class GetCommentStates(StatesGroup):
@@ -86,7 +104,17 @@ class GetCommentStates(StatesGroup):
 
 
 @comment_router.message(Command('get_comment'))
-async def get_comment(message: Message, state: FSMContext) -> None:
+async def get_comment(message: Message, state: FSMContext, command: CommandObject, raw_state: str | None) -> None:
+    # one-shot form: /get_comment <comment_id>
+    if command.args:
+        if raw_state is not None:
+            await state.clear()
+        if not command.args.strip().isdecimal():
+            await message.answer('Usage: /get_comment <comment_id>')
+            return
+        await _send_comment(message, int(command.args))
+        return
+
     await state.clear()
 
     logger.info('start command', command='get_comment')
@@ -102,19 +130,15 @@ async def comment_id_chosen(message: Message, state: FSMContext) -> None:
     comment_id = int(message.text)
     logger.info('comment id chosen', comment_id=comment_id)
 
-    async with aiohttp.request(
-            'get',
-            url=str(Url(endpoint=f'tasks/comments/{comment_id}')),
-    ) as response:
-        if response.status == 200:
-            comment_json = await response.json()
-            logger.info('comment received', comment=comment_json)
-            await message.answer(
-                utils.make_pretty_json_in_telegram(json.dumps(comment_json)),
-                parse_mode='Markdown',
-            )
-        else:
-            logger.info('got non successful response', response=(await response.text()))
-            await message.answer(await response.text())
-
-        await state.clear()
+    await _send_comment(message, comment_id)
+    await state.clear()
+
+
+async def _send_comment(message: Message, comment_id: int) -> None:
+    response = await get_backend().get_cached(Url('comment', comment_id))
+    if response.status == 200:
+        logger.info('comment received', comment_id=comment_id)
+        await answer_json(message, response.body, f'comment_{comment_id}.json')
+    else:
+        logger.info('got non successful response', response=response.text())
+        await message.answer(response.text())
@@ -1,4 +1 @@
-import os
-
-API_VERSION = os.environ['API_VERSION']
-SERVICE_IP_ADDRESS = os.environ['IP_ADDRESS']
+TELEGRAM_MESSAGE_MAX_LENGTH = 4096
@@ -0,0 +1,50 @@
+import time
+
+import structlog
+from aiogram import Router
+from aiogram.filters import Command, CommandObject
+from aiogram.types import BufferedInputFile, Message
+
+from diagnostics import dump_tasks, get_handler_tracker, get_loop_monitor, get_profiler
+from settings import get_settings
+
+logger = structlog.get_logger(__name__)
+debug_router = Router()
+
+
+def is_admin(message: Message) -> bool:
+    # ADMIN_IDS is read on every call, the settings are loaded lazily
+    return message.from_user is not None and message.from_user.id in get_settings().admin_ids
+
+
+@debug_router.message(Command('debug_profile'), is_admin)
+async def debug_profile(message: Message, command: CommandObject) -> None:
+    # /debug_profile <seconds>
+    profiler = get_profiler()
+    args = (command.args or '').strip()
+    try:
+        duration = float(args) if args else 10
+    except ValueError:
+        duration = 0
+    if not 0 < duration <= profiler.max_duration:
+        await message.answer(f'Usage: /debug_profile <seconds>, at most {profiler.max_duration:g}')
+        return
+    if profiler.running:
+        await message.answer('A profile is already being taken, try again later')
+        return
+
+    logger.info('profiling', duration=duration, user_id=message.from_user.id)
+    await message.answer(f'Profiling for {duration:g} s...')
+    collapsed, samples = await profiler.profile(duration)
+    await message.answer_document(
+        BufferedInputFile(collapsed, filename=f'profile-{int(time.time())}.collapsed'),
+        caption=f'{samples} samples every {profiler.interval * 1000:g} ms. '
+                f'Collapsed stacks: flamegraph.pl or https://www.speedscope.app',
+    )
+
+
+@debug_router.message(Command('debug_tasks'), is_admin)
+async def debug_tasks(message: Message) -> None:
+    logger.info('dumping tasks', user_id=message.from_user.id)
+    dump = dump_tasks(get_loop_monitor(), get_handler_tracker())
+    await message.answer_document(BufferedInputFile(dump.encode(), filename=f'tasks-{int(time.time())}.txt'))
@@ -0,0 +1,258 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+from dataclasses import dataclass
+from functools import cache
+from typing import Any, Awaitable, Callable
+
+import structlog
+from aiogram import BaseMiddleware, Router
+from aiogram.types import TelegramObject
+
+from metrics import EVENT_LOOP_LAG, SLOW_CALLBACKS
+from settings import get_settings
+
+logger = structlog.get_logger(__name__)
+
+
+@dataclass(frozen=True)
+class HandlerCall:
+    handler: str
+    state: str | None
+    started_at: float
+
+
+class HandlerTracker(BaseMiddleware):
+    """Inner middleware remembering which handler every task is running, and in which FSM state.
+
+    Costs a dict insert and delete per handler call; read only when something is reported.
+    """
+
+    def __init__(self) -> None:
+        self.calls: weakref.WeakKeyDictionary[asyncio.Task, HandlerCall] = weakref.WeakKeyDictionary()
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: dict[str, Any],
+    ) -> Any:
+        task = asyncio.current_task()
+        self.calls[task] = HandlerCall(data['handler'].callback.__name__, data.get('raw_state'), time.monotonic())
+        try:
+            return await handler(event, data)
+        finally:
+            self.calls.pop(task, None)
+
+
+class LoopMonitor:
+    """Watches the event loop of the process: how late it runs, and what blocks it.
+
+    - every ``lag_interval`` seconds a task sleeps and records how much later than asked it woke up;
+    - every callback of the loop is timed, one that ran longer than ``slow_threshold`` is logged with
+      the handler and FSM state of its task. Two clock reads per callback, nothing at all while the
+      loop is idle. This patches the private ``asyncio.events.Handle._run`` for the whole process
+      (asyncio's debug mode times callbacks in ``BaseEventLoop._run_once`` instead);
+      under uvloop handles are not run through it, so slow callbacks aren't reported there;
+    - a task factory notes when every task was created, for the dump of in-flight tasks.
+    """
+
+    def __init__(self, lag_interval: float, slow_threshold: float, tracker: HandlerTracker) -> None:
+        self._lag_interval = lag_interval
+        self._slow_threshold = slow_threshold
+        self._tracker = tracker
+        self._created_at: weakref.WeakKeyDictionary[asyncio.Task, float] = weakref.WeakKeyDictionary()
+        self._sampler: asyncio.Task | None = None
+        self._original_run: Callable | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._previous_factory: Callable | None = None
+        self.last_lag = 0.0
+
+    async def start(self) -> None:
+        if self._sampler is not None:
+            return
+
+        self._loop = asyncio.get_running_loop()
+        self._install_task_factory(self._loop)
+        if self._slow_threshold:
+            self._wrap_handles()
+        if self._lag_interval:
+            self._sampler = asyncio.create_task(self._sample_lag(), name='loop-lag-sampler')
+        logger.info('loop monitor started', lag_interval=self._lag_interval, slow_threshold=self._slow_threshold)
+
+    async def close(self) -> None:
+        if self._loop is not None:
+            self._loop.set_task_factory(self._previous_factory)
+            self._loop = None
+        if self._original_run is not None:
+            asyncio.events.Handle._run = self._original_run
+            self._original_run = None
+        if self._sampler is not None:
+            self._sampler.cancel()
+            await asyncio.gather(self._sampler, return_exceptions=True)
+            self._sampler = None
+
+    def get_task_age(self, task: asyncio.Task, now: float) -> float | None:
+        created_at = self._created_at.get(task)
+        return None if created_at is None else now - created_at
+
+    async def _sample_lag(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started_at = loop.time()
+            await asyncio.sleep(self._lag_interval)
+            self.last_lag = max(0.0, loop.time() - started_at - self._lag_interval)
+            EVENT_LOOP_LAG.observe(self.last_lag)
+
+    def _install_task_factory(self, loop: asyncio.AbstractEventLoop) -> None:
+        previous_factory = self._previous_factory = loop.get_task_factory()
+        created_at = self._created_at
+
+        def task_factory(loop: asyncio.AbstractEventLoop, coro, **kwargs) -> asyncio.Task:
+            if previous_factory is None:
+                task = asyncio.Task(coro, loop=loop, **kwargs)
+            else:
+                task = previous_factory(loop, coro, **kwargs)
+            created_at[task] = time.monotonic()
+            return task
+
+        loop.set_task_factory(task_factory)
+
+    def _wrap_handles(self) -> None:
+        original_run = self._original_run = asyncio.events.Handle._run
+        threshold = self._slow_threshold
+        report = self._report_slow_callback
+
+        def run(handle: asyncio.Handle) -> None:
+            started_at = time.perf_counter()
+            original_run(handle)
+            if (duration := time.perf_counter() - started_at) >= threshold:
+                report(handle, duration)
+
+        asyncio.events.Handle._run = run
+
+    def _report_slow_callback(self, handle: asyncio.Handle, duration: float) -> None:
+        SLOW_CALLBACKS.inc()
+        # steps of a task are scheduled as its bound methods
+        task = getattr(handle._callback, '__self__', None)
+        if not isinstance(task, asyncio.Task):
+            logger.warning('slow callback', duration=round(duration, 3), callback=repr(handle))
+            return
+
+        call = self._tracker.calls.get(task)
+        logger.warning(
+            'slow callback',
+            duration=round(duration, 3),
+            task=task.get_name(),
+            handler=call.handler if call else None,
+            state=call.state if call else None,
+            # the step is over, the coroutine now waits at the await that ended it
+            location=format_location(task),
+        )
+
+
+def format_location(task: asyncio.Task) -> str:
+    stack = task.get_stack()
+    if not stack:
+        return task.get_coro().__qualname__ if task.get_coro() else '-'
+    frame = stack[-1]
+    return f'{frame.f_code.co_qualname} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})'
+
+
+def dump_tasks(monitor: LoopMonitor, tracker: HandlerTracker) -> str:
+    """The in-flight tasks of the running loop, the oldest first, with the handler each one runs."""
+    now = time.monotonic()
+    rows = []
+    for task in asyncio.all_tasks():
+        age = monitor.get_task_age(task, now)
+        call = tracker.calls.get(task)
+        handler = f'  handler={call.handler} state={call.state or "-"}' if call else ''
+        rows.append((age if age is not None else float('inf'), f'{task.get_name()}  {format_location(task)}{handler}'))
+
+    rows.sort(key=lambda row: row[0], reverse=True)
+    lines = [f'{len(rows)} tasks, event loop lag {monitor.last_lag * 1000:.1f} ms', '']
+    lines += [f'{"?" if age == float("inf") else f"{age:.1f}":>9} s  {description}' for age, description in rows]
+    return '\n'.join(lines)
+
+
+def sample_stacks(duration: float, interval: float) -> tuple[Counter[str], int]:
+    """Samples the stacks of all threads of the process, blocks for ``duration`` seconds; run it in a thread.
+
+    Returns the collapsed stacks (frames root first, separated by ``;``) with their sample counts,
+    and the number of samples taken.
+    """
+    stacks: Counter[str] = Counter()
+    own_id = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    samples = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f'{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            frames.append(names.get(thread_id, str(thread_id)))
+            stacks[';'.join(reversed(frames))] += 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+
+def collapse(stacks: Counter[str]) -> bytes:
+    """The format of flamegraph.pl and speedscope: one ``frame;frame;frame count`` line per stack."""
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common()).encode()
+
+
+class Profiler:
+    """One sampling profile at a time per process, so two admins don't double the overhead."""
+
+    def __init__(self, interval: float, max_duration: float) -> None:
+        self.interval = interval
+        self.max_duration = max_duration
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def profile(self, duration: float) -> tuple[bytes, int]:
+        async with self._lock:
+            stacks, samples = await asyncio.to_thread(sample_stacks, min(duration, self.max_duration), self.interval)
+        return collapse(stacks), samples
+
+
+@cache
+def get_handler_tracker() -> HandlerTracker:
+    return HandlerTracker()
+
+
+@cache
+def get_loop_monitor() -> LoopMonitor:
+    settings = get_settings()
+    return LoopMonitor(
+        lag_interval=settings.loop_lag_interval,
+        slow_threshold=settings.slow_callback_threshold,
+        tracker=get_handler_tracker(),
+    )
+
+
+@cache
+def get_profiler() -> Profiler:
+    settings = get_settings()
+    return Profiler(interval=settings.profile_interval, max_duration=settings.profile_max_duration)
+
+
+def setup_diagnostics(routers: list[Router]) -> None:
+    tracker = get_handler_tracker()
+    for router in routers:
+        for name, observer in router.observers.items():
+            if name not in ('update', 'error'):
+                observer.middleware(tracker)
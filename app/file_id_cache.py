@@ -0,0 +1,66 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+
+class FileIdCache:
+    """Maps local files to the ``file_id`` Telegram assigned to them after the first upload.
+
+    The mapping is persisted as JSON, so a restarted bot doesn't upload the same file again.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._file_ids: dict[str, str] | None = None
+
+    @staticmethod
+    def make_key(bot_id: int, file_path: Path) -> str:
+        # file_id is only valid for the bot that uploaded the file, and a changed file must be re-uploaded
+        stat = file_path.stat()
+        return f'{bot_id}:{file_path.name}:{stat.st_size}:{stat.st_mtime_ns}'
+
+    def get(self, key: str) -> str | None:
+        return self._load().get(key)
+
+    def set(self, key: str, file_id: str) -> None:
+        file_ids = self._load()
+        file_ids[key] = file_id
+        self._save(file_ids)
+
+    def discard(self, key: str) -> None:
+        file_ids = self._load()
+        if file_ids.pop(key, None) is not None:
+            self._save(file_ids)
+
+    def _load(self) -> dict[str, str]:
+        if self._file_ids is None:
+            try:
+                self._file_ids = json.loads(self._path.read_text())
+            except FileNotFoundError:
+                self._file_ids = {}
+            except (OSError, ValueError) as e:
+                logger.warning('file_id cache is unreadable, starting empty', path=str(self._path), error=repr(e))
+                self._file_ids = {}
+        return self._file_ids
+
+    def _save(self, file_ids: dict[str, str]) -> None:
+        # workers save concurrently: each writes its own temporary file, the last replace wins.
+        # A failed save only costs one more upload later, it must not fail the handler
+        tmp_path = None
+        try:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=self._path.parent, prefix=f'{self._path.stem}.', suffix='.tmp', delete=False,
+            ) as tmp_file:
+                tmp_path = tmp_file.name
+                tmp_file.write(json.dumps(file_ids))
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            logger.warning('failed to save file_id cache', path=str(self._path), error=repr(e))
+            if tmp_path is not None:
+                Path(tmp_path).unlink(missing_ok=True)
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Protocol
+
+import structlog
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from settings import get_settings
+
+logger = structlog.get_logger(__name__)
+
+KEY_BUILDER = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+
+@dataclass
+class StorageRecord:
+    state: str | None = None
+    data: dict[str, Any] = field(default_factory=dict)
+    expires_at: float = float('inf')
+
+    @property
+    def is_empty(self) -> bool:
+        return self.state is None and not self.data
+
+    def copy(self) -> 'StorageRecord':
+        return StorageRecord(state=self.state, data=self.data.copy(), expires_at=self.expires_at)
+
+
+class RecordBackend(Protocol):
+    async def read(self, key: str) -> StorageRecord | None: ...
+
+    async def write_many(self, records: dict[str, StorageRecord]) -> None: ...
+
+    async def close(self) -> None: ...
+
+
+class CachedStorage(BaseStorage):
+    """FSM storage with a small in-memory LRU of hot conversations and write-behind batching.
+
+    Writes land in the cache and are flushed to the backend in one batch every ``flush_interval``
+    seconds. Conversations not touched for ``ttl`` seconds expire.
+    The cache assumes all updates of a chat are processed by one process at a time
+    (polling or chat-pinned workers); set ``cache_size=0`` when they may land on different replicas.
+    """
+
+    def __init__(
+            self,
+            backend: RecordBackend,
+            ttl: float,
+            cache_size: int,
+            flush_interval: float,
+    ) -> None:
+        self._backend = backend
+        self._ttl = ttl
+        self._cache_size = cache_size
+        self._flush_interval = flush_interval
+        self._cache: OrderedDict[str, StorageRecord] = OrderedDict()
+        self._dirty: set[str] = set()
+        self._flushing: dict[str, StorageRecord] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key, record)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._get_record(key)).state
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        record = await self._get_record(key)
+        record.data = data.copy()
+        self._mark_dirty(key, record)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._get_record(key)).data.copy()
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+
+        # the backend writes copies: handlers keep changing the cached records while it runs in its thread
+        records = {key: self._cache[key].copy() for key in self._dirty}
+        self._flushing = records
+        self._dirty.clear()
+        try:
+            await self._backend.write_many(records)
+        except Exception:
+            # keep the records dirty so the next flush retries them
+            self._dirty.update(records)
+            raise
+        finally:
+            self._flushing = {}
+            self._evict()
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        await self.flush()
+        await self._backend.close()
+
+    async def _get_record(self, key: StorageKey) -> StorageRecord:
+        cache_key = KEY_BUILDER.build(key)
+        record = self._cache.get(cache_key)
+
+        if record is None or record.expires_at <= time.time():
+            record = await self._backend.read(cache_key) or StorageRecord()
+            self._cache[cache_key] = record
+            self._evict()
+        else:
+            self._cache.move_to_end(cache_key)
+
+        return record
+
+    def _mark_dirty(self, key: StorageKey, record: StorageRecord) -> None:
+        cache_key = KEY_BUILDER.build(key)
+        record.expires_at = time.time() + self._ttl
+        self._cache[cache_key] = record
+        self._dirty.add(cache_key)
+
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        # writes that arrive while a flush is running find this task busy, so they go into the next round
+        while self._dirty:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                # the records stay dirty, the next write schedules a retry
+                logger.exception('failed to flush fsm storage', pending=len(self._dirty))
+                return
+
+    def _evict(self) -> None:
+        # unflushed records stay cached until they are written, so the cache may briefly exceed its size
+        for cache_key in list(self._cache):
+            if len(self._cache) <= self._cache_size:
+                break
+            if cache_key not in self._dirty and cache_key not in self._flushing:
+                del self._cache[cache_key]
+
+
+class SQLiteRecordBackend:
+    """Stores FSM records in a local SQLite database in WAL mode, shareable by processes on one host."""
+
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # one thread owns the connection, so queries never run concurrently on it
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fsm-sqlite')
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('PRAGMA busy_timeout=5000')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS fsm ('
+            'key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self._purged_at = 0.0
+
+    async def read(self, key: str) -> StorageRecord | None:
+        return await self._run(self._read, key)
+
+    async def write_many(self, records: dict[str, StorageRecord]) -> None:
+        await self._run(self._write_many, records)
+
+    async def close(self) -> None:
+        await self._run(self._connection.close)
+        self._executor.shutdown()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _read(self, key: str) -> StorageRecord | None:
+        row = self._connection.execute(
+            'SELECT state, data, expires_at FROM fsm WHERE key = ? AND expires_at > ?',
+            (key, time.time()),
+        ).fetchone()
+        if row is None:
+            return None
+        state, data, expires_at = row
+        return StorageRecord(state=state, data=json.loads(data), expires_at=expires_at)
+
+    def _write_many(self, records: dict[str, StorageRecord]) -> None:
+        upserts = [
+            (key, record.state, json.dumps(record.data), record.expires_at)
+            for key, record in records.items()
+            if not record.is_empty
+        ]
+        deletes = [(key,) for key, record in records.items() if record.is_empty]
+
+        with self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.executemany(
+                'INSERT INTO fsm (key, state, data, expires_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET '
+                'state = excluded.state, data = excluded.data, expires_at = excluded.expires_at',
+                upserts,
+            )
+            self._connection.executemany('DELETE FROM fsm WHERE key = ?', deletes)
+
+            now = time.time()
+            if now - self._purged_at > self.PURGE_INTERVAL:
+                self._connection.execute('DELETE FROM fsm WHERE expires_at <= ?', (now,))
+                self._purged_at = now
+
+
+def build_storage() -> BaseStorage:
+    settings = get_settings()
+    if settings.fsm_storage == 'memory':
+        return MemoryStorage()
+
+    if settings.fsm_storage == 'sqlite':
+        backend = SQLiteRecordBackend(settings.fsm_sqlite_path)
+    elif settings.fsm_storage == 'redis':
+        # redis is an optional dependency, only needed for this backend
+        from fsm_storage_redis import RedisRecordBackend
+        backend = RedisRecordBackend.from_url(settings.fsm_redis_url, ttl=settings.fsm_ttl)
+    else:
+        raise ValueError(f'Unknown FSM_STORAGE: {settings.fsm_storage!r}')
+
+    logger.info('fsm storage configured', storage=settings.fsm_storage, ttl=settings.fsm_ttl)
+    return CachedStorage(
+        backend,
+        ttl=settings.fsm_ttl,
+        cache_size=settings.fsm_cache_size,
+        flush_interval=settings.fsm_flush_interval,
+    )
@@ -0,0 +1,47 @@
+import json
+import time
+
+from redis.asyncio import ConnectionPool, Redis
+
+from fsm_storage import StorageRecord
+
+
+class RedisRecordBackend:
+    """Stores FSM records in a Redis-compatible server, so conversations are shared by all workers.
+
+    Expiration is left to the server: every write sets the TTL of the record's keys.
+    """
+
+    def __init__(self, redis: Redis, ttl: float) -> None:
+        self._redis = redis
+        self._ttl = int(ttl)
+
+    @classmethod
+    def from_url(cls, url: str, ttl: float) -> 'RedisRecordBackend':
+        return cls(Redis(connection_pool=ConnectionPool.from_url(url)), ttl=ttl)
+
+    async def read(self, key: str) -> StorageRecord | None:
+        state, data = await self._redis.mget(f'{key}:state', f'{key}:data')
+        if state is None and data is None:
+            return None
+        return StorageRecord(
+            state=state.decode() if state is not None else None,
+            data=json.loads(data) if data is not None else {},
+            expires_at=time.time() + self._ttl,
+        )
+
+    async def write_many(self, records: dict[str, StorageRecord]) -> None:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key, record in records.items():
+                if record.state is None:
+                    pipe.delete(f'{key}:state')
+                else:
+                    pipe.set(f'{key}:state', record.state, ex=self._ttl)
+                if not record.data:
+                    pipe.delete(f'{key}:data')
+                else:
+                    pipe.set(f'{key}:data', json.dumps(record.data), ex=self._ttl)
+            await pipe.execute()
+
+    async def close(self) -> None:
+        await self._redis.aclose(close_connection_pool=True)
@@ -0,0 +1,54 @@
+import structlog
+from aiogram import F, Router
+from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import StatesGroup, State
+from aiogram.types import Message
+
+from task_import import import_tasks
+
+logger = structlog.get_logger(__name__)
+import_router = Router()
+
+IMPORT_HELP = (
+    'Send a .csv or .jsonl file with the tasks, one task per row.\n\n'
+    'Fields: title, description, reporter_id, assignee_id, related_task_ids and an optional ref.\n'
+    'related_task_ids may list ids of existing tasks (1, 2, 10-15) and refs of other rows of the file (#setup), '
+    'the referenced rows are created first.\n\n'
+    'CSV example:\n'
+    'ref,title,description,reporter_id,assignee_id,related_task_ids\n'
+    'setup,Set up CI,,1,2,\n'
+    ',Add tests,Unit tests for the API,1,-,"#setup, 42"'
+)
+
+
+class ImportingTasksStates(StatesGroup):
+    waiting_for_file = State()
+
+
+@import_router.message(Command('import_tasks'))
+async def import_tasks_command(message: Message, state: FSMContext) -> None:
+    await state.clear()
+
+    logger.info('starting command', command='import_tasks')
+
+    # the file may be sent right away with the command as its caption
+    if message.document:
+        await import_tasks(message)
+        return
+
+    await state.set_state(ImportingTasksStates.waiting_for_file)
+    await message.answer(IMPORT_HELP)
+
+    logger.info('Asked for import file')
+
+
+@import_router.message(ImportingTasksStates.waiting_for_file, F.document)
+async def import_file_chosen(message: Message, state: FSMContext) -> None:
+    await state.clear()
+    await import_tasks(message)
+
+
+@import_router.message(ImportingTasksStates.waiting_for_file)
+async def import_file_expected(message: Message) -> None:
+    await message.answer('Send the tasks as a .csv or .jsonl file')
@@ -0,0 +1,79 @@
+import asyncio
+import re
+
+import structlog
+from aiogram import Router
+from aiogram.types import InlineQuery, InlineQueryResultArticle, InputTextMessageContent
+
+import constants
+from backend_client import get_backend
+from search_index import SearchEntry, get_search_index
+from settings import get_settings
+from url import Url
+
+logger = structlog.get_logger(__name__)
+inline_router = Router()
+
+TASK_ID_QUERY_RE = re.compile(r'#?(?P<id>\d+)')
+
+# the id of the last inline query of every user, older ones of a burst are not answered
+_latest_queries: dict[int, str] = {}
+
+
+@inline_router.inline_query()
+async def search(inline_query: InlineQuery) -> None:
+    query = inline_query.query.strip()
+    offset = int(inline_query.offset) if inline_query.offset.isdecimal() else 0
+
+    # Telegram sends a query per keystroke, answer only when the user paused typing.
+    # Next pages are requested by scrolling, not typing, so they are answered at once.
+    if offset == 0 and not await _is_last_query(inline_query):
+        return
+
+    logger.info('inline search', query=query, offset=offset)
+    entries = list(get_search_index().search(query))
+    if match := TASK_ID_QUERY_RE.fullmatch(query):
+        if task := await _get_task_entry(int(match['id'])):
+            entries = [task] + [entry for entry in entries if entry.key != task.key]
+
+    settings = get_settings()
+    page = entries[offset:offset + settings.search_page_size]
+    next_offset = offset + settings.search_page_size
+    await inline_query.answer(
+        [_make_result(entry) for entry in page],
+        cache_time=settings.search_cache_time,
+        is_personal=False,
+        next_offset=str(next_offset) if next_offset < len(entries) else '',
+    )
+
+
+async def _is_last_query(inline_query: InlineQuery) -> bool:
+    user_id = inline_query.from_user.id
+    _latest_queries[user_id] = inline_query.id
+    await asyncio.sleep(get_settings().search_debounce)
+    if _latest_queries.get(user_id) != inline_query.id:
+        return False
+    del _latest_queries[user_id]
+    return True
+
+
+async def _get_task_entry(task_id: int) -> SearchEntry | None:
+    # the id lookup is the only search the backend has, the response lands in the index too
+    response = await get_backend().get_cached(Url('task', task_id))
+    if response.status != 200:
+        return None
+    task = response.json()
+    return SearchEntry(kind='task', id=task['id'], title=task['title'], description=task.get('description'))
+
+
+def _make_result(entry: SearchEntry) -> InlineQueryResultArticle:
+    kind = 'Task' if entry.kind == 'task' else 'User'
+    text = f'{kind} #{entry.id}: {entry.title}'
+    if entry.description:
+        text += f'\n\n{entry.description}'
+    return InlineQueryResultArticle(
+        id=entry.key,
+        title=f'{kind} #{entry.id}: {entry.title}',
+        description=entry.description,
+        input_message_content=InputTextMessageContent(message_text=text[:constants.TELEGRAM_MESSAGE_MAX_LENGTH]),
+    )
@@ -0,0 +1,153 @@
+import atexit
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import BinaryIO
+
+import orjson
+import structlog
+
+from settings import get_settings
+
+# ANSI escape-коды
+RESET = "\033[0m"
+COLORS = {
+    "critical": "\033[1;31m",
+    "error": "\033[31m",
+    "warning": "\033[33m",
+    "info": "\033[32m",
+    "debug": "\033[36m",
+}
+KEY_COLOR = "\033[36m"
+VAL_COLOR = "\033[35m"
+TIME_COLOR = "\033[90m"  # тёмно-серый
+
+
+def custom_renderer(_, __, event_dict):
+    level = event_dict.pop("level", "info").lower()
+    ts = datetime.now().isoformat(timespec="seconds")
+
+    color = COLORS.get(level, "")
+    parts = [
+        f"{TIME_COLOR}{ts}{RESET}",
+        f"{color}[{level:<8}]{RESET}",
+    ]
+
+    for key, value in event_dict.items():
+        parts.append(f"{KEY_COLOR}{key}{RESET}={VAL_COLOR}{value}{RESET}")
+
+    return " ".join(parts)
+
+
+class QueueWriter:
+    """Writes log lines to a binary file from a daemon thread.
+
+    Log calls only put the rendered line into a bounded queue, so a slow stdout or pipe
+    never blocks the event loop. When the queue is full lines are dropped and counted,
+    the count is written to the log as soon as the writer catches up.
+    """
+
+    _STOP = object()
+    _BATCH_DELAY = 0.01
+
+    def __init__(self, file: BinaryIO, max_size: int) -> None:
+        self._file = file
+        self._queue: queue.Queue = queue.Queue(maxsize=max_size)
+        self._dropped = 0
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def put(self, line: bytes) -> None:
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self._dropped += 1
+
+    def close(self, timeout: float = 5) -> None:
+        if not self._thread.is_alive():
+            return
+        # blocking put: the stop marker must not be dropped when the queue is full
+        self._queue.put(self._STOP, timeout=timeout)
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            line = self._queue.get()
+            lines = [line]
+            # drain whatever is queued so a burst of log calls becomes one write
+            while lines[-1] is not self._STOP:
+                try:
+                    lines.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = lines[-1] is self._STOP
+            if stop:
+                lines.pop()
+            if self._dropped:
+                dropped, self._dropped = self._dropped, 0
+                lines.append(orjson.dumps({'event': 'log lines dropped', 'level': 'warning', 'count': dropped}))
+
+            try:
+                self._file.write(b'\n'.join(lines) + b'\n' if lines else b'')
+                self._file.flush()
+            except (OSError, ValueError):
+                pass
+
+            if stop:
+                return
+            # let the next burst accumulate instead of waking up on every single line
+            time.sleep(self._BATCH_DELAY)
+
+
+class QueueLogger:
+    def __init__(self, writer: QueueWriter) -> None:
+        self._writer = writer
+
+    def msg(self, message: bytes) -> None:
+        self._writer.put(message)
+
+    log = debug = info = warn = warning = msg
+    err = error = critical = exception = fatal = msg
+
+
+class QueueLoggerFactory:
+    def __init__(self, file: BinaryIO, max_size: int) -> None:
+        self.writer = QueueWriter(file, max_size)
+        atexit.register(self.writer.close)
+
+    def __call__(self, *args) -> QueueLogger:
+        return QueueLogger(self.writer)
+
+
+def configure_logging(mode: str | None = None, level: str | None = None) -> None:
+    """``dev`` prints colored lines synchronously, ``prod`` writes JSON lines through a background thread."""
+    settings = get_settings()
+    mode = mode or settings.log_mode
+    level = level or settings.log_level
+    if mode == 'prod':
+        processors = [
+            structlog.processors.add_log_level,
+            structlog.processors.TimeStamper(fmt='iso', utc=True),
+            structlog.processors.format_exc_info,
+            structlog.processors.JSONRenderer(serializer=orjson.dumps),
+        ]
+        logger_factory = QueueLoggerFactory(file=sys.stdout.buffer, max_size=settings.log_queue_size)
+    elif mode == 'dev':
+        processors = [
+            structlog.processors.add_log_level,
+            structlog.processors.format_exc_info,
+            custom_renderer,
+        ]
+        logger_factory = structlog.PrintLoggerFactory(file=sys.stdout)
+    else:
+        raise ValueError(f'Unknown LOG_MODE: {mode}')
+
+    structlog.configure(
+        processors=processors,
+        wrapper_class=structlog.make_filtering_bound_logger(level.upper()),
+        logger_factory=logger_factory,
+        cache_logger_on_first_use=True,
+    )
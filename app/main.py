@@ -5,55 +5,34 @@ from dotenv import load_dotenv
 
 load_dotenv(dotenv_path=(Path(__file__).resolve().parent.parent / '.env'))
 
-from start_handlers import start_router, bot, setup_bot_commands
+from start_handlers import start_router, get_bot, setup_bot_commands
+
+from attachment_index import get_attachment_index
+from attachments import upload_transport
+from backend_client import get_backend
 
 from user_handlers import user_router
 from task_handlers import task_router
 from comment_handlers import comment_router
+from import_handlers import import_router
+from inline_handlers import inline_router
+from watch_handlers import watch_router
+from debug_handlers import debug_router
 
 from aiogram import Dispatcher
 
+from diagnostics import get_loop_monitor, setup_diagnostics
+from fsm_storage import build_storage
+from metrics import metrics_server, setup_metrics
+from rate_limit import build_rate_limiter
+from search_index import get_search_index
+from task_watch import get_task_sync, get_watch_store
+from settings import get_settings
+from webhook import run_webhook
+from workers import run_workers
+
 import structlog
-import sys
-from datetime import datetime
-
-# ANSI escape-коды
-RESET = "\033[0m"
-COLORS = {
-    "critical": "\033[1;31m",
-    "error": "\033[31m",
-    "warning": "\033[33m",
-    "info": "\033[32m",
-    "debug": "\033[36m",
-}
-KEY_COLOR = "\033[36m"
-VAL_COLOR = "\033[35m"
-TIME_COLOR = "\033[90m"  # тёмно-серый
-
-
-def custom_renderer(_, __, event_dict):
-    level = event_dict.pop("level", "info").lower()
-    ts = datetime.now().isoformat(timespec="seconds")
-
-    color = COLORS.get(level, "")
-    parts = [
-        f"{TIME_COLOR}{ts}{RESET}",
-        f"{color}[{level:<8}]{RESET}",
-    ]
-
-    for key, value in event_dict.items():
-        parts.append(f"{KEY_COLOR}{key}{RESET}={VAL_COLOR}{value}{RESET}")
-
-    return " ".join(parts)
-
-
-structlog.configure(
-    processors=[
-        structlog.stdlib.add_log_level,
-        custom_renderer,
-    ],
-    logger_factory=structlog.PrintLoggerFactory(file=sys.stdout),
-)
+from log_config import configure_logging
 
 log = structlog.get_logger()
 
@@ -65,12 +44,52 @@ logger = structlog.get_logger(__name__)
 # --------------------------------------------------------------------------------------
 
 
+ROUTERS = [
+    start_router, user_router, task_router, comment_router, import_router, inline_router, watch_router, debug_router,
+]
+
+
+def build_dispatcher() -> Dispatcher:
+    # also called in every worker process, each of them gets its own dispatcher
+    dp = Dispatcher(storage=build_storage())
+    dp.include_routers(*ROUTERS)
+    setup_metrics(dp, ROUTERS, caches={'backend': get_backend().cache})
+    setup_diagnostics(ROUTERS)
+    dp.startup.register(get_loop_monitor().start)
+    dp.shutdown.register(get_loop_monitor().close)
+    rate_limiter = build_rate_limiter()
+    dp.message.outer_middleware(rate_limiter)
+    dp.shutdown.register(rate_limiter.close)
+    get_backend().add_response_listener(get_search_index().on_backend_response)
+    dp.startup.register(get_backend().start)
+    dp.shutdown.register(get_backend().close)
+    dp.startup.register(upload_transport.start)
+    dp.shutdown.register(upload_transport.close)
+    if (attachment_index := get_attachment_index()) is not None:
+        dp.shutdown.register(attachment_index.close)
+    dp.startup.register(get_task_sync().start)
+    dp.shutdown.register(get_task_sync().close)
+    dp.shutdown.register(get_watch_store().close)
+    dp.startup.register(metrics_server.start)
+    dp.shutdown.register(metrics_server.close)
+    return dp
+
+
 async def main() -> None:
-    dp = Dispatcher()
-    dp.include_routers(start_router, user_router, task_router, comment_router)
+    # settings are validated here, a missing or malformed variable stops the bot before it connects
+    configure_logging()
     logger.info('bot (probably) started')
+    bot = get_bot()
     await setup_bot_commands(bot)
-    await dp.start_polling(bot)
+
+    bot_mode = get_settings().bot_mode
+    if bot_mode == 'workers':
+        allowed_updates = sorted({update for router in ROUTERS for update in router.resolve_used_update_types()})
+        await run_workers(bot, build_dispatcher, allowed_updates)
+    elif bot_mode == 'webhook':
+        await run_webhook(build_dispatcher(), bot)
+    else:
+        await build_dispatcher().start_polling(bot)
 
 
 if __name__ == '__main__':
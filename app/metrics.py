@@ -0,0 +1,160 @@
+import time
+from typing import Any, Awaitable, Callable
+
+import structlog
+from aiogram import BaseMiddleware, Dispatcher, Router
+from aiogram.types import TelegramObject, Update
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily
+
+from cache import TTLCache
+from settings import get_settings
+
+logger = structlog.get_logger(__name__)
+
+UPDATES_IN_FLIGHT = Gauge('bot_updates_in_flight', 'Updates being processed right now')
+UPDATE_DURATION = Histogram('bot_update_duration_seconds', 'Time to process an update', ['update_type'])
+HANDLER_DURATION = Histogram(
+    'bot_handler_duration_seconds', 'Time spent in a handler', ['handler', 'state'],
+)
+BACKEND_REQUEST_DURATION = Histogram(
+    'bot_backend_request_duration_seconds', 'Time until the backend responded', ['method', 'endpoint', 'status'],
+)
+ATTACHMENT_UPLOAD_BYTES = Counter('bot_attachment_upload_bytes', 'Bytes relayed from Telegram to the backend')
+ATTACHMENT_UPLOAD_THROUGHPUT = Histogram(
+    'bot_attachment_upload_throughput_bytes_per_second', 'Throughput of completed attachment uploads',
+    buckets=[2 ** power for power in range(14, 31, 2)],
+)
+RATE_LIMITED = Counter(
+    'bot_rate_limited_messages', 'Messages delayed or rejected by the rate limit', ['scope', 'result'],
+)
+BACKEND_REQUESTS_WAITING = Gauge('bot_backend_requests_waiting', 'Backend requests waiting for a free slot')
+ATTACHMENT_TRANSFERS_WAITING = Gauge('bot_attachment_transfers_waiting', 'Attachments waiting for a free transfer slot')
+ATTACHMENT_DEDUP = Counter(
+    'bot_attachment_dedup', 'Attachments by how they reached the backend: uploaded, linked, local', ['result'],
+)
+ATTACHMENT_DEDUP_SAVED_BYTES = Counter(
+    'bot_attachment_dedup_saved_bytes', 'Bytes not transferred thanks to the attachment index', ['direction'],
+)
+OUTBOUND_MESSAGES = Counter(
+    'bot_outbound_messages', 'Messages to Telegram by outcome: sent, merged, superseded, retried, failed', ['result'],
+)
+OUTBOUND_QUEUE_DURATION = Histogram(
+    'bot_outbound_queue_seconds', 'Time a message waited for the flood limits', ['priority'],
+)
+TASK_WATCHES = Gauge('bot_task_watches', 'Tasks watched by at least one chat')
+TASK_WATCH_POLLS = Counter(
+    'bot_task_watch_polls', 'Polls of watched tasks by outcome: not_modified, unchanged, changed, deleted, error',
+    ['result'],
+)
+TASK_WATCH_NOTIFICATIONS = Counter('bot_task_watch_notifications', 'Task change notifications sent to chats')
+
+EVENT_LOOP_LAG = Histogram(
+    'bot_event_loop_lag_seconds', 'How late the event loop woke up a sleeping task',
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5],
+)
+SLOW_CALLBACKS = Counter('bot_slow_callbacks', 'Callbacks that blocked the event loop longer than the threshold')
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer middleware on the dispatcher's updates: in-flight count and total update latency."""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: dict[str, Any],
+    ) -> Any:
+        UPDATES_IN_FLIGHT.inc()
+        started_at = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_DURATION.labels(event.event_type).observe(time.perf_counter() - started_at)
+            UPDATES_IN_FLIGHT.dec()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware on router observers: latency per handler and FSM state it was called in.
+
+    It has to be an inner middleware, outer ones run before the handler is chosen.
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: dict[str, Any],
+    ) -> Any:
+        started_at = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_DURATION.labels(
+                handler=data['handler'].callback.__name__,
+                state=data.get('raw_state') or '-',
+            ).observe(time.perf_counter() - started_at)
+
+
+class CacheCollector:
+    def __init__(self, name: str, cache: TTLCache) -> None:
+        self._name = name
+        self._cache = cache
+
+    def collect(self):
+        requests = CounterMetricFamily(
+            f'bot_{self._name}_cache_requests', 'Lookups served by the cache', labels=['result'],
+        )
+        requests.add_metric(['hit'], self._cache.hits)
+        requests.add_metric(['miss'], self._cache.misses)
+        yield requests
+
+
+def setup_metrics(dp: Dispatcher, routers: list[Router], caches: dict[str, TTLCache]) -> None:
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+
+    handler_metrics = HandlerMetricsMiddleware()
+    for router in routers:
+        for name, observer in router.observers.items():
+            if name not in ('update', 'error'):
+                observer.middleware(handler_metrics)
+
+    for name, cache in caches.items():
+        REGISTRY.register(CacheCollector(name, cache))
+
+
+async def metrics(_: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(REGISTRY), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+class MetricsServer:
+    """Serves ``/metrics`` on ``METRICS_HOST:METRICS_PORT``, ``METRICS_PORT=0`` disables it.
+
+    In the workers mode every worker process serves its own metrics, worker N on ``METRICS_PORT + N``.
+    """
+
+    def __init__(self, port: int | None = None) -> None:
+        self.port = port
+        self._runner: web.AppRunner | None = None
+
+    async def start(self) -> None:
+        settings = get_settings()
+        port = settings.metrics_port if self.port is None else self.port
+        if not port or self._runner is not None:
+            return
+
+        app = web.Application()
+        app.router.add_get('/metrics', metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, settings.metrics_host, port).start()
+        logger.info('metrics server started', host=settings.metrics_host, port=port)
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
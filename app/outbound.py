@@ -0,0 +1,323 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+import structlog
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessage, EditMessageCaption, EditMessageMedia, EditMessageReplyMarkup, EditMessageText, ForwardMessage,
+    SendAnimation, SendAudio, SendDocument, SendMediaGroup, SendMessage, SendPhoto, SendSticker, SendVideo,
+    SendVoice, TelegramMethod,
+)
+
+import constants
+from metrics import OUTBOUND_MESSAGES, OUTBOUND_QUEUE_DURATION
+from settings import get_settings
+
+logger = structlog.get_logger(__name__)
+
+# methods that post to a chat, they count against Telegram's flood limits
+MESSAGE_METHODS = (
+    SendMessage, SendPhoto, SendDocument, SendMediaGroup, SendAnimation, SendAudio, SendVideo, SendVoice,
+    SendSticker, CopyMessage, ForwardMessage,
+    EditMessageText, EditMessageCaption, EditMessageMedia, EditMessageReplyMarkup,
+)
+# progress edits, they give way to replies the user is waiting for
+BULK_METHODS = (EditMessageText,)
+INTERACTIVE, BULK = 0, 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+MERGE_SEPARATOR = '\n\n'
+
+_standalone: ContextVar[bool] = ContextVar('outbound_standalone', default=False)
+_background: ContextVar[bool] = ContextVar('outbound_background', default=False)
+
+
+@contextmanager
+def standalone() -> Iterator[None]:
+    """Messages sent inside are never merged with other replies, e.g. a progress message that is edited later."""
+    token = _standalone.set(True)
+    try:
+        yield
+    finally:
+        _standalone.reset(token)
+
+
+@contextmanager
+def background() -> Iterator[None]:
+    """Messages sent inside nobody is waiting for, e.g. notifications; they give way to replies like progress edits."""
+    token = _background.set(True)
+    try:
+        yield
+    finally:
+        _background.reset(token)
+
+
+class TokenBucket:
+    """``rate`` tokens per second up to ``burst``, a rate of 0 means no limit."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+
+    def delay(self) -> float:
+        """Seconds until a token can be taken."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if not self._rate:
+            return 0.0
+        self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+        return max(0.0, (1 - self._tokens) / self._rate)
+
+    def take(self) -> None:
+        if self._rate:
+            self._tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        # the bucket refills from empty over the pause, so the chat doesn't burst right after it
+        self._tokens = min(self._tokens, 0.0)
+        self._updated_at = now
+
+    async def wait(self) -> None:
+        while (delay := self.delay()) > 0:
+            await asyncio.sleep(delay)
+        self.take()
+
+
+class PriorityLimiter:
+    """A token bucket shared by all chats; when tokens are short, waiters with a lower priority value go first."""
+
+    def __init__(self, bucket: TokenBucket) -> None:
+        self._bucket = bucket
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self._granting: asyncio.Task | None = None
+
+    async def acquire(self, priority: int) -> None:
+        if not self._waiters and self._bucket.delay() == 0:
+            self._bucket.take()
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), waiter))
+        if self._granting is None or self._granting.done():
+            self._granting = asyncio.create_task(self._grant())
+        await waiter
+
+    async def _grant(self) -> None:
+        while self._waiters:
+            if (delay := self._bucket.delay()) > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                self._bucket.take()
+                waiter.set_result(None)
+
+
+@dataclass
+class Outbound:
+    make_request: NextRequestMiddlewareType
+    bot: Bot
+    method: TelegramMethod
+    priority: int
+    mergeable: bool
+    queued_at: float = field(default_factory=time.monotonic)
+    # callers waiting for this request, more than one once replies were merged or edits superseded
+    waiters: list[asyncio.Future] = field(default_factory=list)
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Session middleware every request to Telegram goes through; messages are sent within the flood limits.
+
+    Messages of a chat are sent one by one, in order, within the chat's token bucket (groups have
+    their own, lower limit) and the global one. A 429 pauses the chat for ``retry_after`` and the
+    message is sent again. While a message waits, a plain text reply to the same chat is merged into
+    it, and a newer edit of the same message replaces the older one. Replies go before progress edits
+    of other chats when the global limit is reached. Other requests (getUpdates, getFile, ...) pass through.
+    """
+
+    def __init__(
+            self,
+            global_rate: float,
+            chat_rate: float,
+            chat_burst: int,
+            group_rate: float,
+            group_burst: int,
+            max_retries: int,
+            max_chats: int,
+    ) -> None:
+        self._global = PriorityLimiter(TokenBucket(global_rate, max(1, int(global_rate))))
+        self._chat_limit = (chat_rate, chat_burst)
+        self._group_limit = (group_rate, group_burst)
+        self._max_retries = max_retries
+        self._max_chats = max_chats
+        self._buckets: OrderedDict[int | str, TokenBucket] = OrderedDict()
+        self._lanes: dict[int | str, deque[Outbound]] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType,
+            bot: Bot,
+            method: TelegramMethod,
+    ) -> Any:
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None or not isinstance(method, MESSAGE_METHODS):
+            return await make_request(bot, method)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._enqueue(chat_id, Outbound(
+            make_request=make_request,
+            bot=bot,
+            method=method,
+            priority=BULK if isinstance(method, BULK_METHODS) or _background.get() else INTERACTIVE,
+            mergeable=isinstance(method, SendMessage) and not _standalone.get(),
+            waiters=[waiter],
+        ))
+        return await waiter
+
+    def _enqueue(self, chat_id: int | str, outbound: Outbound) -> None:
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            lane = self._lanes[chat_id] = deque()
+            task = asyncio.create_task(self._drain(chat_id, lane))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        # a reply overtakes the progress edits waiting in its chat, an edit doesn't change the order of messages
+        index = len(lane)
+        while index and lane[index - 1].priority > outbound.priority:
+            index -= 1
+        if (index and self._merge(lane[index - 1], outbound)) or self._supersede(lane, outbound):
+            return
+        lane.insert(index, outbound)
+
+    @staticmethod
+    def _merge(last: Outbound, outbound: Outbound) -> bool:
+        """Appends a text reply to the reply waiting before it in the chat, if they can be one message."""
+        if not (last.mergeable and outbound.mergeable):
+            return False
+        first, second = last.method, outbound.method
+        text = f'{first.text}{MERGE_SEPARATOR}{second.text}'
+        if (
+                len(text) > constants.TELEGRAM_MESSAGE_MAX_LENGTH
+                or first.reply_markup is not None or second.reply_markup is not None
+                or first.entities is not None or second.entities is not None
+                or first.model_dump(exclude={'text'}) != second.model_dump(exclude={'text'})
+        ):
+            return False
+        last.method = first.model_copy(update={'text': text})
+        last.waiters += outbound.waiters
+        OUTBOUND_MESSAGES.labels(result='merged').inc()
+        return True
+
+    @staticmethod
+    def _supersede(lane: deque[Outbound], outbound: Outbound) -> bool:
+        """Replaces a waiting edit of the same message, only the latest text is worth sending."""
+        method = outbound.method
+        if not isinstance(method, EditMessageText):
+            return False
+        for waiting in lane:
+            if isinstance(waiting.method, EditMessageText) and waiting.method.message_id == method.message_id:
+                waiting.method = method
+                waiting.waiters += outbound.waiters
+                OUTBOUND_MESSAGES.labels(result='superseded').inc()
+                return True
+        return False
+
+    async def _drain(self, chat_id: int | str, lane: deque[Outbound]) -> None:
+        bucket = self._get_bucket(chat_id)
+        try:
+            while lane:
+                # the head may still get replies merged into it while it waits
+                await bucket.wait()
+                await self._global.acquire(lane[0].priority)
+                outbound = lane.popleft()
+                OUTBOUND_QUEUE_DURATION.labels(PRIORITY_NAMES[outbound.priority]).observe(
+                    time.monotonic() - outbound.queued_at,
+                )
+                await self._send(chat_id, bucket, outbound)
+        finally:
+            del self._lanes[chat_id]
+
+    async def _send(self, chat_id: int | str, bucket: TokenBucket, outbound: Outbound) -> None:
+        waiters = outbound.waiters
+        attempt = 0
+        while True:
+            if all(waiter.done() for waiter in waiters):
+                # every caller is gone, e.g. its handler was cancelled on shutdown
+                return
+            attempt += 1
+            try:
+                result = await outbound.make_request(outbound.bot, outbound.method)
+            except TelegramRetryAfter as e:
+                if attempt > self._max_retries:
+                    OUTBOUND_MESSAGES.labels(result='failed').inc()
+                    _set_exception(waiters, e)
+                    return
+                OUTBOUND_MESSAGES.labels(result='retried').inc()
+                logger.warning('flood limit hit, retrying', chat_id=chat_id, retry_after=e.retry_after, attempt=attempt)
+                bucket.pause(e.retry_after)
+                await bucket.wait()
+                await self._global.acquire(outbound.priority)
+            except Exception as e:
+                OUTBOUND_MESSAGES.labels(result='failed').inc()
+                _set_exception(waiters, e)
+                return
+            else:
+                OUTBOUND_MESSAGES.labels(result='sent').inc()
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(result)
+                return
+
+    def _get_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # group and channel ids are negative, usernames of channels are strings
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = self._buckets[chat_id] = TokenBucket(*(self._group_limit if is_group else self._chat_limit))
+            # least recently used buckets are forgotten, i.e. refilled
+            while len(self._buckets) > self._max_chats:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(chat_id)
+        return bucket
+
+
+def _set_exception(waiters: list[asyncio.Future], error: Exception) -> None:
+    for waiter in waiters:
+        if not waiter.done():
+            waiter.set_exception(error)
+
+
+def build_outbound_scheduler() -> OutboundScheduler:
+    settings = get_settings()
+    global_rate = settings.outbound_global_rate
+    if settings.bot_mode == 'workers' and settings.worker_processes:
+        # the global limit is per bot, every worker process gets its share; chats stay in one worker
+        global_rate /= settings.worker_processes
+    return OutboundScheduler(
+        global_rate=global_rate,
+        chat_rate=settings.outbound_chat_rate,
+        chat_burst=settings.outbound_chat_burst,
+        group_rate=settings.outbound_group_rate,
+        group_burst=settings.outbound_group_burst,
+        max_retries=settings.outbound_max_retries,
+        max_chats=settings.outbound_max_chats,
+    )
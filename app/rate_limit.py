@@ -0,0 +1,188 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Protocol
+
+import structlog
+from aiogram import BaseMiddleware
+from aiogram.types import Message, TelegramObject
+
+from metrics import RATE_LIMITED
+from settings import get_settings
+
+logger = structlog.get_logger(__name__)
+
+
+class BucketStore(Protocol):
+    async def reserve(self, key: str, rate: float, burst: int, max_wait: float) -> float:
+        """Takes a token from the bucket, returns how long to wait until it is valid.
+
+        Tokens may be taken ahead of time, that's what queues requests. If the wait would be
+        longer than ``max_wait`` nothing is taken and the returned wait is greater than ``max_wait``.
+        """
+
+    async def refund(self, key: str, burst: int) -> None:
+        """Gives back a token taken by ``reserve``."""
+
+    async def close(self) -> None: ...
+
+
+class MemoryBucketStore:
+    """Token buckets of this process. Least recently used buckets are forgotten, i.e. refilled."""
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    async def reserve(self, key: str, rate: float, burst: int, max_wait: float) -> float:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+
+        wait = max(0.0, (1 - tokens) / rate)
+        if wait <= max_wait:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self._max_size:
+            self._buckets.popitem(last=False)
+        return wait
+
+    async def refund(self, key: str, burst: int) -> None:
+        # a forgotten bucket is full already
+        if (bucket := self._buckets.get(key)) is not None:
+            tokens, updated_at = bucket
+            self._buckets[key] = (min(burst, tokens + 1), updated_at)
+
+    async def close(self) -> None:
+        pass
+
+
+def get_command(message: Message) -> str | None:
+    text = message.text or message.caption
+    if not text or not text.startswith('/'):
+        return None
+    return text.split(maxsplit=1)[0][1:].split('@')[0].lower()
+
+
+class RateLimitMiddleware(BaseMiddleware):
+    """Outer middleware on messages: token buckets per user and per user's command.
+
+    A message over the limit waits for its token, so a short burst is slowed down rather than lost.
+    Once it would have to wait longer than ``max_wait`` it is dropped with a reply telling when to retry.
+    All photos of an album cost one token.
+    """
+
+    def __init__(
+            self,
+            store: BucketStore,
+            user_rate: float,
+            user_burst: int,
+            command_rate: float,
+            command_burst: int,
+            max_wait: float,
+            max_keys: int,
+            command_limits: dict[str, tuple[float, int]] | None = None,
+    ) -> None:
+        self._store = store
+        self._user_limit = (user_rate, user_burst)
+        self._command_limit = (command_rate, command_burst)
+        self._command_limits = command_limits or {}
+        self._max_wait = max_wait
+        self._max_keys = max_keys
+        self._charged_media_groups: OrderedDict[str, None] = OrderedDict()
+        self._notified_at: OrderedDict[int, float] = OrderedDict()
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: Message,
+            data: dict[str, Any],
+    ) -> Any:
+        if event.from_user is None or self._is_charged_media_group(event):
+            return await handler(event, data)
+
+        user_id = event.from_user.id
+        limits = [('user', f'rl:user:{user_id}', self._user_limit)]
+        if command := get_command(event):
+            limits.append((
+                'command',
+                f'rl:command:{user_id}:{command}',
+                self._command_limits.get(command, self._command_limit),
+            ))
+
+        wait, delayed_by = 0.0, None
+        reserved = []
+        for scope, key, (rate, burst) in limits:
+            scope_wait = await self._store.reserve(key, rate, burst, self._max_wait)
+            if scope_wait > self._max_wait:
+                # a rejected message costs nothing: hitting a command limit mustn't drain the user's bucket
+                for reserved_key, reserved_burst in reserved:
+                    await self._store.refund(reserved_key, reserved_burst)
+                RATE_LIMITED.labels(scope=scope, result='rejected').inc()
+                logger.info('message rejected by rate limit', user_id=user_id, scope=scope, command=command)
+                await self._notify(event, scope_wait)
+                return None
+            reserved.append((key, burst))
+            if scope_wait > wait:
+                wait, delayed_by = scope_wait, scope
+
+        if delayed_by is not None:
+            RATE_LIMITED.labels(scope=delayed_by, result='delayed').inc()
+            logger.info('message delayed by rate limit', user_id=user_id, wait=round(wait, 2), command=command)
+            await asyncio.sleep(wait)
+
+        return await handler(event, data)
+
+    async def close(self) -> None:
+        await self._store.close()
+
+    def _is_charged_media_group(self, message: Message) -> bool:
+        if message.media_group_id is None:
+            return False
+        if message.media_group_id in self._charged_media_groups:
+            return True
+        self._charged_media_groups[message.media_group_id] = None
+        if len(self._charged_media_groups) > self._max_keys:
+            self._charged_media_groups.popitem(last=False)
+        return False
+
+    async def _notify(self, message: Message, retry_after: float) -> None:
+        # one reply per max_wait, otherwise a flood of messages becomes a flood of replies
+        now = time.monotonic()
+        user_id = message.from_user.id
+        if now - self._notified_at.get(user_id, -math.inf) < self._max_wait:
+            return
+        self._notified_at[user_id] = now
+        self._notified_at.move_to_end(user_id)
+        if len(self._notified_at) > self._max_keys:
+            self._notified_at.popitem(last=False)
+
+        await message.answer(
+            f'Too many requests, please slow down. Try again in {math.ceil(retry_after)} s'
+        )
+
+
+def build_rate_limiter() -> RateLimitMiddleware:
+    settings = get_settings()
+    if settings.rate_limit_storage == 'memory':
+        store = MemoryBucketStore(max_size=settings.rate_limit_max_keys)
+    elif settings.rate_limit_storage == 'redis':
+        # redis is an optional dependency, only needed for limits shared by several replicas
+        from rate_limit_redis import RedisBucketStore
+        store = RedisBucketStore.from_url(settings.rate_limit_redis_url)
+    else:
+        raise ValueError(f'Unknown RATE_LIMIT_STORAGE: {settings.rate_limit_storage!r}')
+
+    logger.info('rate limit configured', storage=settings.rate_limit_storage)
+    return RateLimitMiddleware(
+        store,
+        user_rate=settings.rate_limit_user_rate,
+        user_burst=settings.rate_limit_user_burst,
+        command_rate=settings.rate_limit_command_rate,
+        command_burst=settings.rate_limit_command_burst,
+        max_wait=settings.rate_limit_max_wait,
+        max_keys=settings.rate_limit_max_keys,
+        command_limits=settings.rate_limit_commands,
+    )
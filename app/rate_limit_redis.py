@@ -0,0 +1,58 @@
+from redis.asyncio import ConnectionPool, Redis
+
+# same algorithm as MemoryBucketStore.reserve, run atomically on the server with the server's clock,
+# so every replica takes tokens from the same buckets
+RESERVE_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+
+local wait = math.max(0, (1 - tokens) / rate)
+if wait <= max_wait then
+    tokens = tokens - 1
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+    -- a bucket that has refilled completely is the same as no bucket
+    redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+end
+-- numbers returned from scripts are truncated to integers
+return tostring(wait)
+'''
+
+REFUND_SCRIPT = '''
+local burst = tonumber(ARGV[1])
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+-- an expired bucket is full already
+if tokens then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(burst, tokens + 1)))
+end
+return 0
+'''
+
+
+class RedisBucketStore:
+    """Token buckets in a Redis-compatible server, shared by all replicas of the bot."""
+
+    def __init__(self, redis: Redis) -> None:
+        self._redis = redis
+        self._reserve = redis.register_script(RESERVE_SCRIPT)
+        self._refund = redis.register_script(REFUND_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url: str) -> 'RedisBucketStore':
+        return cls(Redis(connection_pool=ConnectionPool.from_url(url)))
+
+    async def reserve(self, key: str, rate: float, burst: int, max_wait: float) -> float:
+        return float(await self._reserve(keys=[key], args=[rate, burst, max_wait]))
+
+    async def refund(self, key: str, burst: int) -> None:
+        await self._refund(keys=[key], args=[burst])
+
+    async def close(self) -> None:
+        await self._redis.aclose(close_connection_pool=True)
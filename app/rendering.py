@@ -0,0 +1,95 @@
+from dataclasses import dataclass
+from functools import lru_cache
+
+import orjson
+from aiogram.enums import ParseMode
+from aiogram.types import BufferedInputFile, Message
+
+import constants
+from settings import get_settings
+
+CODE_BLOCK_OVERHEAD = len('```json\n\n```')
+
+
+@dataclass(frozen=True)
+class RenderedJson:
+    # MarkdownV2 messages of at most TELEGRAM_MESSAGE_MAX_LENGTH, empty when ``document`` is set
+    messages: tuple[str, ...]
+    # the indented JSON as a file, for payloads over the document threshold
+    document: bytes | None = None
+
+
+def format_json(body: bytes) -> tuple[str, str]:
+    """Indents a raw backend body, returns it with the language of its code block.
+
+    orjson parses the bytes straight away, nothing goes through ``json.loads``/``json.dumps``;
+    a body that is not JSON (an error page) is shown as is.
+    """
+    try:
+        return orjson.dumps(orjson.loads(body), option=orjson.OPT_INDENT_2).decode(), 'json'
+    except orjson.JSONDecodeError:
+        return body.decode(errors='replace').strip() or '(empty response)', ''
+
+
+def escape_code(text: str) -> str:
+    """Inside a MarkdownV2 code block only ``\\`` and the backtick have to be escaped."""
+    return text.replace('\\', '\\\\').replace('`', '\\`')
+
+
+def get_length(text: str) -> int:
+    # Telegram counts the length in UTF-16 code units
+    return len(text) if text.isascii() else len(text.encode('utf-16-le')) // 2
+
+
+def split_lines(text: str, limit: int) -> list[str]:
+    """Splits escaped text into chunks of at most ``limit``, on line boundaries where possible."""
+    chunks: list[str] = []
+    start = 0
+    while get_length(rest := text[start:]) > limit:
+        end = start + limit
+        # characters outside the BMP count twice, shrink the window until it fits
+        while (overflow := get_length(text[start:end]) - limit) > 0:
+            end -= overflow
+        newline = text.rfind('\n', start, end + 1)
+        if newline > start:
+            chunks.append(text[start:newline])
+            start = newline + 1
+        else:
+            # a single line longer than the limit, e.g. a long description
+            if _ends_with_escape(text, start, end):
+                # don't separate a backslash from the character it escapes
+                end -= 1
+            chunks.append(text[start:end])
+            start = end
+    chunks.append(rest)
+    return chunks
+
+
+def _ends_with_escape(line: str, start: int, end: int) -> bool:
+    backslashes = 0
+    while end - backslashes > start and line[end - backslashes - 1] == '\\':
+        backslashes += 1
+    return backslashes % 2 == 1
+
+
+# the same task is often shown to several users while it's in the backend client's cache
+@lru_cache(maxsize=256)
+def render_json(body: bytes, document_threshold: int) -> RenderedJson:
+    text, language = format_json(body)
+    if len(text) > document_threshold:
+        return RenderedJson(messages=(), document=text.encode())
+
+    limit = constants.TELEGRAM_MESSAGE_MAX_LENGTH - CODE_BLOCK_OVERHEAD
+    return RenderedJson(messages=tuple(
+        f'```{language}\n{chunk}\n```' for chunk in split_lines(escape_code(text), limit)
+    ))
+
+
+async def answer_json(message: Message, body: bytes, file_name: str) -> None:
+    """Replies with the backend body as indented JSON: one or more code blocks, or a file if it's too big."""
+    rendered = render_json(body, get_settings().json_document_threshold)
+    if rendered.document is not None:
+        await message.answer_document(BufferedInputFile(rendered.document, filename=file_name))
+        return
+    for text in rendered.messages:
+        await message.answer(text, parse_mode=ParseMode.MARKDOWN_V2)
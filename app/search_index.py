@@ -0,0 +1,103 @@
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import cache
+
+from backend_client import BackendResponse
+from settings import get_settings
+from url import Url
+
+WORD_RE = re.compile(r'\w+')
+
+
+@dataclass(frozen=True)
+class SearchEntry:
+    kind: str
+    id: int
+    title: str
+    description: str | None = None
+
+    @property
+    def key(self) -> str:
+        return f'{self.kind}:{self.id}'
+
+
+def normalize_query(query: str) -> str:
+    return ' '.join(WORD_RE.findall(query.lower()))
+
+
+class SearchIndex:
+    """Tasks and users the bot has recently seen, searchable by words of their title or name.
+
+    The backend can only look things up by id, so the index is filled from its responses
+    and from what the bot creates. The least recently seen entries are forgotten first.
+    Results are cached per query; typing a longer query filters the result of its prefix
+    instead of scanning the whole index.
+    """
+
+    def __init__(self, max_size: int, result_cache_size: int) -> None:
+        self._max_size = max_size
+        self._entries: OrderedDict[str, tuple[SearchEntry, frozenset[str]]] = OrderedDict()
+        self._result_cache_size = result_cache_size
+        self._results: OrderedDict[str, list[SearchEntry]] = OrderedDict()
+
+    def add(self, entry: SearchEntry) -> None:
+        words = frozenset(WORD_RE.findall(f'{entry.title} {entry.description or ""}'.lower()))
+        self._entries[entry.key] = (entry, words)
+        self._entries.move_to_end(entry.key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+        # any cached result may miss the new entry
+        self._results.clear()
+
+    def add_task(self, task: dict) -> None:
+        self.add(SearchEntry(kind='task', id=task['id'], title=task['title'], description=task.get('description')))
+
+    def add_user(self, user: dict) -> None:
+        self.add(SearchEntry(kind='user', id=user['id'], title=user['name']))
+
+    def on_backend_response(self, url: Url, response: BackendResponse) -> None:
+        if response.status != 200 or url.route not in ('task', 'user'):
+            return
+        try:
+            payload = response.json()
+            if url.route == 'task':
+                self.add_task(payload)
+            else:
+                self.add_user(payload)
+        except (ValueError, TypeError, KeyError):
+            pass
+
+    def search(self, query: str) -> list[SearchEntry]:
+        """Entries where every word of the query starts a word of the title or description, the most recent first."""
+        query = normalize_query(query)
+        if query in self._results:
+            self._results.move_to_end(query)
+            return self._results[query]
+
+        # the result of a prefix of the query contains every result of the query
+        candidates = None
+        for prefix_length in range(len(query) - 1, 0, -1):
+            if (prefix := query[:prefix_length]) in self._results:
+                candidates = self._results[prefix]
+                break
+        if candidates is None:
+            candidates = [entry for entry, _ in reversed(self._entries.values())]
+
+        query_words = query.split()
+        results = [
+            entry for entry in candidates
+            if all(any(word.startswith(query_word) for word in self._entries[entry.key][1])
+                   for query_word in query_words)
+        ]
+
+        self._results[query] = results
+        while len(self._results) > self._result_cache_size:
+            self._results.popitem(last=False)
+        return results
+
+
+@cache
+def get_search_index() -> SearchIndex:
+    settings = get_settings()
+    return SearchIndex(max_size=settings.search_index_max_size, result_cache_size=settings.search_result_cache_size)
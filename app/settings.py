@@ -0,0 +1,232 @@
+import os
+from functools import cache
+from pathlib import Path
+from typing import Any, Literal
+
+from pydantic import BaseModel, ConfigDict, Field, SecretStr, field_validator, model_validator
+from yarl import URL
+
+DEFAULT_DATA_DIR = Path(__file__).resolve().parent.parent / 'data'
+DEFAULT_REDIS_URL = 'redis://localhost:6379/0'
+
+
+class Settings(BaseModel):
+    """Configuration of the bot, every field is read from the environment variable of the same name in upper case.
+
+    Loaded once, on the first ``get_settings()`` call, so modules can be imported without any
+    configuration; a missing or malformed variable fails the start with a validation error.
+    """
+
+    # the input is the whole environment, it must not end up in error messages
+    model_config = ConfigDict(
+        frozen=True, alias_generator=str.upper, populate_by_name=True, hide_input_in_errors=True,
+    )
+
+    api_token: SecretStr
+    api_version: str
+    # scheme, host and an optional base path, e.g. https://tms.example.com/api;
+    # IP_ADDRESS (host[:port], plain http) is still accepted instead
+    backend_url: str
+
+    backend_connection_limit: int = 100
+    backend_connection_limit_per_host: int = 20
+    backend_keepalive_timeout: float = 30
+    backend_connect_timeout: float = 5
+    backend_total_timeout: float = 30
+    backend_get_retries: int = 2
+    backend_retry_backoff: float = 0.2
+    backend_cache_max_size: int = 1024
+    backend_cache_ttl: float = 30
+    backend_max_concurrency: int = 50
+
+    max_related_task_ids: int = 200
+    related_tasks_check_concurrency: int = 10
+
+    attachment_batch_window: float = 1.5
+    attachment_batch_max_size: int = 20
+    attachment_upload_concurrency: int = 3
+    attachment_max_transfers: int = 10
+    attachment_bandwidth_limit: int = 0
+    attachment_max_chunk_size: int = 512 * 1024
+    attachment_memory_budget: int = 16 * 1024 * 1024
+    attachment_max_retries: int = 3
+    attachment_retry_backoff: float = 1
+    attachment_spool_dir: str | None = None
+    attachment_spool_max_size: int = 64 * 1024 * 1024
+    attachment_http2: bool = False
+    attachment_max_connections: int = 20
+    attachment_keepalive_expiry: float = 30
+    attachment_connect_timeout: float = 10
+    attachment_read_timeout: float = 120
+    attachment_write_timeout: float = 120
+    attachment_pool_timeout: float = 60
+    attachment_progress_edit_interval: float = 2
+    # repeated files (same file_unique_id and size) are linked or uploaded from a local copy
+    attachment_dedup: bool = True
+    attachment_index_path: Path
+    attachment_blob_dir: Path
+    attachment_index_ttl: float = 30 * 24 * 60 * 60
+    attachment_blob_ttl: float = 7 * 24 * 60 * 60
+    attachment_blob_max_total_size: int = 512 * 1024 * 1024
+
+    telegram_api_url: str | None = None
+
+    # Telegram's flood limits: ~30 messages/s per bot, ~1/s per chat, 20/min per group; 0 is no limit
+    outbound_global_rate: float = 30
+    outbound_chat_rate: float = 1
+    outbound_chat_burst: int = 3
+    outbound_group_rate: float = 20 / 60
+    outbound_group_burst: int = 3
+    outbound_max_retries: int = 5
+    outbound_max_chats: int = 10_000
+
+    bot_mode: Literal['polling', 'webhook', 'workers'] = 'polling'
+    webhook_base_url: str | None = None
+    webhook_path: str = '/webhook'
+    webhook_secret: str | None = None
+    webhook_host: str = '0.0.0.0'
+    webhook_port: int = 8080
+
+    worker_processes: int = Field(default_factory=lambda: os.cpu_count() or 1)
+    worker_queue_size: int = 1000
+    worker_max_pending: int = 1000
+    worker_start_timeout: float = 60
+    worker_drain_timeout: float = 30
+    worker_polling_timeout: int = 10
+
+    data_dir: Path = DEFAULT_DATA_DIR
+
+    fsm_storage: Literal['sqlite', 'redis', 'memory'] = 'sqlite'
+    fsm_sqlite_path: Path
+    fsm_redis_url: str = DEFAULT_REDIS_URL
+    fsm_ttl: int = 24 * 60 * 60
+    fsm_cache_size: int = 1024
+    fsm_flush_interval: float = 0.05
+
+    metrics_host: str = '127.0.0.1'
+    metrics_port: int = 9000
+
+    log_mode: Literal['dev', 'prod'] = 'dev'
+    log_level: str = 'info'
+    log_queue_size: int = 10_000
+
+    rate_limit_storage: Literal['memory', 'redis'] = 'memory'
+    rate_limit_redis_url: str
+    rate_limit_user_rate: float = Field(1, gt=0)
+    rate_limit_user_burst: int = Field(10, ge=1)
+    rate_limit_command_rate: float = Field(0.5, gt=0)
+    rate_limit_command_burst: int = Field(5, ge=1)
+    # {command: (tokens per second, burst)}, from RATE_LIMIT_COMMANDS=get_task=2/5,add_attachment_to_task=0.1/2
+    rate_limit_commands: dict[str, tuple[float, int]] = {'add_attachment_to_task': (0.1, 3), 'import_tasks': (0.05, 2)}
+    rate_limit_max_wait: float = 5
+    rate_limit_max_keys: int = 10_000
+
+    import_max_file_size: int = 20 * 1024 * 1024
+    import_max_rows: int = 10_000
+    import_concurrency: int = 5
+    import_progress_edit_interval: float = 3
+
+    search_index_max_size: int = 10_000
+    search_result_cache_size: int = 256
+    search_debounce: float = 0.3
+    search_page_size: int = 20
+    search_cache_time: int = 10
+
+    # /watch_task: every watched task is polled once however many chats watch it; only one process
+    # of a deployment may sync (TASK_WATCH_SYNC), in the workers mode it's worker 0
+    task_watch_sync: bool = True
+    task_watch_path: Path
+    task_watch_min_interval: float = 30
+    task_watch_max_interval: float = 15 * 60
+    task_watch_jitter: float = 0.2
+    task_watch_rate: float = 5
+    task_watch_concurrency: int = 5
+    task_watch_refresh_interval: float = 10
+    task_watch_max_per_chat: int = 50
+
+    # diagnostics: event loop lag, slow callbacks (0 turns either off) and the /debug_* commands of ADMIN_IDS
+    admin_ids: frozenset[int] = frozenset()
+    loop_lag_interval: float = 1
+    slow_callback_threshold: float = 0.1
+    profile_max_duration: float = 60
+    profile_interval: float = 0.005
+
+    # longer JSON replies (in characters) are sent as a file rather than several messages
+    json_document_threshold: int = 16_000
+
+    @model_validator(mode='before')
+    @classmethod
+    def _fill_derived_defaults(cls, values: Any) -> Any:
+        if not isinstance(values, dict):
+            return values
+        values = dict(values)
+        if not values.get('BACKEND_URL') and values.get('IP_ADDRESS'):
+            values['BACKEND_URL'] = f'http://{values["IP_ADDRESS"]}'
+        data_dir = Path(values.get('DATA_DIR') or DEFAULT_DATA_DIR)
+        values.setdefault('FSM_SQLITE_PATH', data_dir / 'fsm.sqlite3')
+        values.setdefault('ATTACHMENT_INDEX_PATH', data_dir / 'attachments.sqlite3')
+        values.setdefault('ATTACHMENT_BLOB_DIR', data_dir / 'attachment_blobs')
+        values.setdefault('TASK_WATCH_PATH', data_dir / 'watches.sqlite3')
+        values.setdefault('RATE_LIMIT_REDIS_URL', values.get('FSM_REDIS_URL', DEFAULT_REDIS_URL))
+        return values
+
+    @field_validator('backend_url')
+    @classmethod
+    def _check_backend_url(cls, value: str) -> str:
+        url = URL(value)
+        if url.scheme not in ('http', 'https') or not url.host:
+            raise ValueError('must be an http:// or https:// URL')
+        return value.rstrip('/')
+
+    @field_validator('admin_ids', mode='before')
+    @classmethod
+    def _split_ids(cls, value: Any) -> Any:
+        # ADMIN_IDS=1,2
+        if isinstance(value, str):
+            return [part for part in value.replace(' ', '').split(',') if part]
+        return value
+
+    @field_validator('rate_limit_commands', mode='before')
+    @classmethod
+    def _parse_command_limits(cls, value: Any) -> Any:
+        if not isinstance(value, str):
+            return value
+        limits = {}
+        for item in filter(None, (item.strip() for item in value.split(','))):
+            try:
+                command, limit = item.split('=')
+                rate, burst = limit.split('/')
+                limits[command.strip().lstrip('/')] = (float(rate), int(burst))
+            except ValueError:
+                raise ValueError(f'invalid item {item!r}, expected <command>=<rate>/<burst>') from None
+        return limits
+
+    @field_validator('rate_limit_commands')
+    @classmethod
+    def _check_command_limits(cls, value: dict[str, tuple[float, int]]) -> dict[str, tuple[float, int]]:
+        # a rate of 0 would never refill the bucket
+        for command, (rate, burst) in value.items():
+            if rate <= 0 or burst < 1:
+                raise ValueError(f'{command}: the rate must be positive and the burst at least 1')
+        return value
+
+    @field_validator('attachment_http2', 'attachment_dedup', 'task_watch_sync', mode='before')
+    @classmethod
+    def _empty_is_false(cls, value: Any) -> Any:
+        return value or False
+
+    @model_validator(mode='after')
+    def _check_webhook_secret(self) -> 'Settings':
+        # the webhook is public, without the secret anyone could post updates on behalf of any user
+        if self.bot_mode == 'webhook' and not self.webhook_secret:
+            raise ValueError('WEBHOOK_SECRET is required when BOT_MODE=webhook')
+        return self
+
+    @classmethod
+    def from_env(cls, environ: dict[str, str] | None = None) -> 'Settings':
+        return cls.model_validate(dict(os.environ if environ is None else environ))
+
+
+@cache
+def get_settings() -> Settings:
+    return Settings.from_env()
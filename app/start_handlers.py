@@ -1,16 +1,63 @@
-import os
+from functools import cache
 from pathlib import Path
 
 import structlog
 from aiogram import Router, Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, FSInputFile, ReplyKeyboardMarkup, KeyboardButton, BotCommand
 
+from file_id_cache import FileIdCache
+from outbound import build_outbound_scheduler
+from settings import get_settings
+
 logger = structlog.get_logger(__name__)
 
 start_router = Router()
-bot = Bot(os.environ['API_TOKEN'])
+
+
+@cache
+def get_bot() -> Bot:
+    settings = get_settings()
+    # TELEGRAM_API_URL points the bot at a self-hosted Bot API server or a local fake one
+    session = None
+    if settings.telegram_api_url:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(settings.telegram_api_url))
+    bot = Bot(settings.api_token.get_secret_value(), session=session)
+    bot.session.middleware(build_outbound_scheduler())
+    return bot
+
+
+WELCOME_IMAGE_PATH = Path(__file__).resolve().parent / 'images' / 'hello.jpg'
+
+BOT_COMMANDS = [
+    BotCommand(command="start", description="Список команд"),
+    BotCommand(command="create_user", description="Создать пользователя"),
+    BotCommand(command="get_user", description="Получить пользователя"),
+    BotCommand(command="create_task", description="Создать задачу"),
+    BotCommand(command="get_task", description="Получить задачу"),
+    BotCommand(command="create_comment", description="Создать комментарий"),
+    BotCommand(command="get_comment", description="Получить комментарий"),
+    BotCommand(command="add_attachment_to_task", description="Добавить вложение к задаче"),
+    BotCommand(command="import_tasks", description="Импортировать задачи из CSV/JSONL"),
+    BotCommand(command="watch_task", description="Следить за изменениями задачи"),
+    BotCommand(command="unwatch_task", description="Перестать следить за задачей"),
+]
+
+COMMANDS_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text=f"/{cmd.command}") for cmd in BOT_COMMANDS]
+    ],
+    resize_keyboard=True
+)
+
+
+@cache
+def get_file_ids() -> FileIdCache:
+    return FileIdCache(get_settings().data_dir / 'file_ids.json')
 
 
 @start_router.message(CommandStart())
@@ -18,30 +65,28 @@ async def welcome(message: Message, state: FSMContext, bot: Bot) -> None:
     await state.clear()
 
     logger.info('sending welcome message')
-    await message.answer_photo(FSInputFile(Path(__file__).resolve().parent / 'images' / 'hello.jpg'))
+    await _send_welcome_photo(message, bot)
     logger.info('welcome message sent')
 
-    commands = await bot.get_my_commands()
+    await message.answer("Выберите команду:", reply_markup=COMMANDS_KEYBOARD)
+
+
+async def _send_welcome_photo(message: Message, bot: Bot) -> None:
+    key = FileIdCache.make_key(bot.id, WELCOME_IMAGE_PATH)
+    file_ids = get_file_ids()
 
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text=f"/{cmd.command}") for cmd in commands]
-        ],
-        resize_keyboard=True
-    )
+    if file_id := file_ids.get(key):
+        try:
+            await message.answer_photo(file_id)
+            return
+        except TelegramBadRequest as e:
+            logger.info('cached welcome photo file_id was rejected, uploading again', error=str(e))
+            file_ids.discard(key)
 
-    await message.answer("Выберите команду:", reply_markup=keyboard)
+    sent_message = await message.answer_photo(FSInputFile(WELCOME_IMAGE_PATH))
+    file_ids.set(key, sent_message.photo[-1].file_id)
+    logger.info('welcome photo uploaded, file_id cached')
 
 
 async def setup_bot_commands(bot: Bot):
-    commands = [
-        BotCommand(command="start", description="Список команд"),
-        BotCommand(command="create_user", description="Создать пользователя"),
-        BotCommand(command="get_user", description="Получить пользователя"),
-        BotCommand(command="create_task", description="Создать задачу"),
-        BotCommand(command="get_task", description="Получить задачу"),
-        BotCommand(command="create_comment", description="Создать комментарий"),
-        BotCommand(command="get_comment", description="Получить комментарий"),
-        BotCommand(command="add_attachment_to_task", description="Добавить вложение к задаче"),
-    ]
-    await bot.set_my_commands(commands)
+    await bot.set_my_commands(BOT_COMMANDS)
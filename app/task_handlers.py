@@ -1,23 +1,29 @@
+import asyncio
 import json
-from typing import AsyncGenerator
+import re
 
 import aiohttp
-import httpx
 import structlog
-from aiogram import Router
-from aiogram.filters import Command
+from aiogram import F, Router
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import Message, File
-from aiohttp import StreamReader
-
-import utils
+from aiogram.types import Message
+
+from attachments import get_attachment_batcher, UploadProgress, upload_attachment, get_tg_file_name, get_tg_media
+from backend_client import get_backend
+from outbound import standalone
+from rendering import answer_json
+from search_index import get_search_index
+from settings import get_settings
 from url import Url
-from utils import make_pretty_json_in_telegram
 
 logger = structlog.get_logger(__name__)
 task_router = Router()
 
+RANGE_RE = re.compile(r'(?P<start>\d+)-(?P<end>\d+)')
+RANGE_SPACES_RE = re.compile(r'\s*-\s*')
+
 
 class CreatingTaskStates(StatesGroup):
     waiting_for_title = State()
@@ -28,7 +34,14 @@ class CreatingTaskStates(StatesGroup):
 
 
 @task_router.message(Command('create_task'))
-async def create_task(message: Message, state: FSMContext) -> None:
+async def create_task(message: Message, state: FSMContext, command: CommandObject, raw_state: str | None) -> None:
+    # one-shot form: /create_task <title> | <description> | <reporter_id> | <assignee_id> | <related task ids>
+    if command.args:
+        if raw_state is not None:
+            await state.clear()
+        await _create_task_from_args(message, command.args)
+        return
+
     await state.clear()
 
     logger.info('start creating task')
@@ -90,31 +103,130 @@ async def related_task_ids_chosen(message: Message, state: FSMContext) -> None:
         'task related_task_ids has been chosen' if related_task_ids else 'task related_task_ids was omitted',
         related_task_ids=related_task_ids,
     )
-    related_task_ids = await _parce_related_task_ids(related_task_ids)
+    try:
+        related_task_ids = parse_related_task_ids(related_task_ids)
+    except ValueError as e:
+        logger.info('related_task_ids are invalid', error=str(e))
+        await message.answer(f'{e}. Enter related task ids again, e.g. 1, 2, 10-15')
+        return
+
+    try:
+        missing_task_ids = await _find_missing_task_ids(related_task_ids)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning('failed to check related tasks', error=repr(e))
+        await message.answer('Backend is unreachable, enter related task ids again later')
+        return
+    if missing_task_ids:
+        logger.info('related tasks not found', missing_task_ids=missing_task_ids)
+        report = '\n'.join(f'{task_id}: {status}' for task_id, status in missing_task_ids.items())
+        await message.answer(f'Related tasks not found (task id: status):\n{report}\n\nEnter related task ids again')
+        return
+
     await state.update_data(related_task_ids=related_task_ids)
 
     task_data = await state.get_data()
-    async with aiohttp.request(
+    await _create_task(message, task_data)
+    await state.clear()
+
+
+async def _create_task_from_args(message: Message, args: str) -> None:
+    usage = 'Usage: /create_task <title> | <description> | <reporter_id> | [assignee_id] | [related task ids]'
+    parts = [part.strip() for part in args.split('|')]
+    if not 3 <= len(parts) <= 5 or not parts[0]:
+        await message.answer(usage)
+        return
+    title, description, reporter_id, assignee_id, related_task_ids = parts + [''] * (5 - len(parts))
+
+    if not reporter_id.isdecimal() or assignee_id not in ('', '-') and not assignee_id.isdecimal():
+        await message.answer(f'reporter_id and assignee_id must be numbers\n{usage}')
+        return
+
+    try:
+        related_task_ids = parse_related_task_ids(None if related_task_ids == '-' else related_task_ids)
+    except ValueError as e:
+        await message.answer(f'{e}\n{usage}')
+        return
+
+    task_data = {
+        'title': title,
+        'description': None if description in ('', '-') else description,
+        'reporter_id': int(reporter_id),
+        'assignee_id': None if assignee_id in ('', '-') else int(assignee_id),
+        'related_task_ids': related_task_ids,
+    }
+    logger.info('one-shot command', command='create_task', title=title)
+
+    try:
+        missing_task_ids = await _find_missing_task_ids(task_data['related_task_ids'])
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning('failed to check related tasks', error=repr(e))
+        await message.answer('Backend is unreachable, try again later')
+        return
+    if missing_task_ids:
+        report = '\n'.join(f'{task_id}: {status}' for task_id, status in missing_task_ids.items())
+        await message.answer(f'Related tasks not found (task id: status):\n{report}')
+        return
+
+    await _create_task(message, task_data)
+
+
+async def _create_task(message: Message, task_data: dict) -> None:
+    async with get_backend().request(
             'POST',
-            url=str(Url(endpoint='tasks/tasks/')),
+            url=Url('tasks'),
             json=task_data,
     ) as response:
-        response_json = await response.json()
-
-        if response.status == 200:
-            created_task_id = response_json
-            await message.answer(f'created task id: {created_task_id}')
+        # the backend slot is released before replying, replies may wait for Telegram flood limits
+        status, body = response.status, await response.read()
+
+    if status == 200:
+        created_task_id = json.loads(body)
+        for related_task_id in task_data['related_task_ids']:
+            get_backend().invalidate(Url('task', related_task_id))
+        get_search_index().add_task({**task_data, 'id': created_task_id})
+        await message.answer(f'created task id: {created_task_id}')
+    else:
+        await answer_json(message, body, 'error.json')
+
+
+def parse_related_task_ids(related_task_ids: str | None) -> list[int]:
+    """Accepts ids and ranges like ``10-15`` separated by any punctuation or whitespace."""
+    if not related_task_ids:
+        return []
+
+    max_ids = get_settings().max_related_task_ids
+    task_ids = []
+    for token in re.split(r'[^\w-]+', RANGE_SPACES_RE.sub('-', related_task_ids)):
+        if not token:
+            continue
+        if match := RANGE_RE.fullmatch(token):
+            start, end = int(match['start']), int(match['end'])
+            if start > end:
+                raise ValueError(f'Invalid range of related task ids: {token}')
+        elif token.isdecimal():
+            start = end = int(token)
         else:
-            await message.answer(
-                make_pretty_json_in_telegram(json.dumps(response_json)),
-                parse_mode='Markdown',
-            )
+            raise ValueError(f'Invalid related task id: {token}')
 
-    await state.clear()
+        if len(task_ids) + end - start + 1 > max_ids:
+            raise ValueError(f'Too many related task ids, at most {max_ids} are allowed')
+        task_ids.extend(range(start, end + 1))
 
+    return list(dict.fromkeys(task_ids))
 
-async def _parce_related_task_ids(related_task_ids):
-    return related_task_ids.split(', ') if related_task_ids else []
+
+async def _find_missing_task_ids(task_ids: list[int]) -> dict[int, int]:
+    """Checks the tasks exist in parallel, returns the status the backend gave for every missing one."""
+    # NOTE: the backend has no bulk existence endpoint, so every id is a (cached) GET
+    semaphore = asyncio.Semaphore(get_settings().related_tasks_check_concurrency)
+
+    async def get_status(task_id: int) -> tuple[int, int]:
+        async with semaphore:
+            response = await get_backend().get_cached(Url('task', task_id))
+        return task_id, response.status
+
+    statuses = await asyncio.gather(*(get_status(task_id) for task_id in task_ids))
+    return {task_id: status for task_id, status in statuses if status != 200}
 
 
 class GettingTaskStates(StatesGroup):
@@ -122,7 +234,17 @@ class GettingTaskStates(StatesGroup):
 
 
 @task_router.message(Command('get_task'))
-async def get_task(message: Message, state: FSMContext) -> None:
+async def get_task(message: Message, state: FSMContext, command: CommandObject, raw_state: str | None) -> None:
+    # one-shot form: /get_task <task_id>
+    if command.args:
+        if raw_state is not None:
+            await state.clear()
+        if not command.args.strip().isdecimal():
+            await message.answer('Usage: /get_task <task_id>')
+            return
+        await _send_task(message, int(command.args))
+        return
+
     await state.clear()
 
     logger.info('starting command', command='get_task')
@@ -136,21 +258,18 @@ async def get_task(message: Message, state: FSMContext) -> None:
 @task_router.message(GettingTaskStates.waiting_for_task_id)
 async def task_id_chosen(message: Message, state: FSMContext) -> None:
     task_id = int(message.text.strip())
+    await _send_task(message, task_id)
+    await state.clear()
 
-    logger.info('getting task', task_id=task_id)
 
-    async with aiohttp.request(
-            'get',
-            url=str(Url(endpoint=f'tasks/tasks/{task_id}')),
-    ) as response:
-        if response.status == 200:
-            json_data = await response.json()
-            await message.answer(utils.make_pretty_json_in_telegram(json_data), parse_mode='Markdown')
-        else:
-            response_text = await response.text()
-            await message.answer(response_text)
+async def _send_task(message: Message, task_id: int) -> None:
+    logger.info('getting task', task_id=task_id)
 
-        await state.clear()
+    response = await get_backend().get_cached(Url('task', task_id))
+    if response.status == 200:
+        await answer_json(message, response.body, f'task_{task_id}.json')
+    else:
+        await message.answer(response.text())
 
 
 class AddingAttachmentStates(StatesGroup):
@@ -158,8 +277,32 @@ class AddingAttachmentStates(StatesGroup):
     waiting_for_attachment = State()
 
 
-@task_router.message(Command('add_attachment_to_task'))
-async def add_attachment(message: Message, state: FSMContext) -> None:
+@task_router.message(Command('add_attachment_to_task', 'attach'))
+async def add_attachment(message: Message, state: FSMContext, command: CommandObject, raw_state: str | None) -> None:
+    # one-shot form: a file or an album with the caption /attach <task_id>
+    if command.args:
+        if not command.args.strip().isdecimal():
+            await message.answer(f'Usage: /{command.command} <task_id>')
+            return
+        task_id = int(command.args)
+
+        if message.text is None:
+            if raw_state is not None:
+                await state.clear()
+            logger.info('attachment chosen', task_id=task_id, command=command.command)
+            get_attachment_batcher().add(
+                message, task_id, on_batch=lambda messages: _upload_attachments(messages, task_id),
+            )
+            return
+
+        # only the task id was given, ask for the files right away
+        await state.clear()
+        await state.update_data(task_id=task_id)
+        await state.set_state(AddingAttachmentStates.waiting_for_attachment)
+        await message.answer('Choose attachments (one or several files, or an album)')
+        logger.info('Asked for attachment', task_id=task_id, command=command.command)
+        return
+
     await state.clear()
 
     logger.info('starting command', command='add_attachment_to_task')
@@ -170,6 +313,12 @@ async def add_attachment(message: Message, state: FSMContext) -> None:
     logger.info('Asked for task id')
 
 
+@task_router.message(F.media_group_id.func(lambda media_group_id: get_attachment_batcher().has_album(media_group_id)))
+async def add_attachment__album_item(message: Message) -> None:
+    # the caption is only on the first item of an album, the others join its batch
+    get_attachment_batcher().add_to_album(message)
+
+
 @task_router.message(AddingAttachmentStates.waiting_for_task_id)
 async def add_attachment__task_id_chosen(message: Message, state: FSMContext) -> None:
     task_id = int(message.text)
@@ -177,88 +326,61 @@ async def add_attachment__task_id_chosen(message: Message, state: FSMContext) ->
 
     await state.update_data(task_id=task_id)
     await state.set_state(AddingAttachmentStates.waiting_for_attachment)
-    await message.answer('Choose attachment')
+    await message.answer('Choose attachments (one or several files, or an album)')
 
     logger.info('Asked for attachment', task_id=task_id, command='add_attachment_to_task')
 
-    # TODO: check that only one attachment is sent
-
 
 @task_router.message(AddingAttachmentStates.waiting_for_attachment)
 async def add_attachment__attachment_chosen(message: Message, state: FSMContext) -> None:
+    try:
+        get_tg_media(message)
+    except ValueError:
+        await message.answer('Choose attachments (one or several files, or an album), or start another command')
+        return
+
     task_id = await state.get_value('task_id')
     logger.info('attachment chosen', task_id=task_id, command='add_attachment_to_task')
 
-    file = await _get_tg_file(message)
-    tg_file_url = f"https://api.telegram.org/file/bot{message.bot.token}/{file.file_path}"
-    async with aiohttp.request('get', tg_file_url) as tg_file_response:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(200)) as client:
-            upload_response = await client.post(
-                str(Url(endpoint=f'tasks/tasks/{task_id}/attachments/')),
-                content=AsyncIterableOverStreamReader(tg_file_response.content),
-                headers={
-                    # NOTE (SemenK): as of 2025-07-04 telegram doesn't keep filename for images.
-                    # so if filename is None, it means it's an image => .jpg
-                    'Filename': _get_tg_file_name(message) or 'autogenerated_filename.jpg',
-                    "Content-Length": str(file.file_size),
-                }
-            )
-
-            if upload_response.status_code == 201:
-                logger.info(
-                    'attachment uploaded',
-                    attachment_url=upload_response.json()['attachment_url'], task_id=task_id,
-                    command='add_attachment_to_task',
-                )
-                await message.answer(upload_response.json()['attachment_url'])
-            else:
-                logger.info(
-                    'something went wrong during attachment upload',
-                    attachment_url=(upload_response.json()), task_id=task_id, command='add_attachment_to_task',
-                )
-                await message.answer(upload_response.text)
-
-            await state.clear()
-
-
-async def _get_tg_file(message: Message) -> File:
-    if message.document:
-        file_id = message.document.file_id
-    elif message.animation:
-        file_id = message.animation.file_id
-    elif message.audio:
-        file_id = message.audio.file_id
-    elif message.video:
-        file_id = message.video.file_id
-    elif message.photo:
-        file_id = message.photo[-1].file_id
-    else:
-        raise ValueError('File must be either document or animation or audio or video or photo')
-    file = await message.bot.get_file(file_id)
-    return file
-
-
-def _get_tg_file_name(message: Message) -> str | None:
-    if message.document or message.animation:
-        return message.document.file_name
-    elif message.animation:
-        return message.animation.file_name
-    elif message.audio:
-        return message.audio.file_name
-    elif message.video:
-        return message.video.file_name
-    elif message.photo:
-        return None
-    else:
-        raise ValueError('File must be either document or animation or audio or video or photo')
+    # an album or several files sent in a row arrive as separate messages, they are uploaded as one batch
+    get_attachment_batcher().add(
+        message, task_id, on_batch=lambda messages: _upload_attachments(messages, task_id, state),
+    )
 
 
-class AsyncIterableOverStreamReader:
-    CHUNK_SIZE = 5 * 1024 * 1024
+async def _upload_attachments(messages: list[Message], task_id: int, state: FSMContext | None = None) -> None:
+    logger.info('uploading attachments', count=len(messages), task_id=task_id, command='add_attachment_to_task')
 
-    def __init__(self, stream_reader: StreamReader) -> None:
-        self._stream_reader = stream_reader
+    # the batch is complete, the chat is free for other commands while it uploads;
+    # a dialog started during the batch window is left alone
+    if state is not None and await state.get_state() == AddingAttachmentStates.waiting_for_attachment.state:
+        await state.clear()
 
-    async def __aiter__(self) -> AsyncGenerator:
-        while chunk := await self._stream_reader.read(self.CHUNK_SIZE):
-            yield chunk
+    settings = get_settings()
+    # the progress is edited into this message, nothing else may be merged into it
+    with standalone():
+        progress_message = await messages[0].answer(f'Uploading {len(messages)} attachment(s)...')
+    progress = UploadProgress(
+        progress_message,
+        total=len(messages),
+        edit_interval=settings.attachment_progress_edit_interval,
+    )
+    semaphore = asyncio.Semaphore(settings.attachment_upload_concurrency)
+
+    async def upload(message: Message) -> None:
+        file_name = get_tg_file_name(message) or f'photo #{message.message_id}'
+        async with semaphore:
+            try:
+                attachment_url = await upload_attachment(message, task_id)
+            except Exception as e:
+                logger.exception('attachment upload failed', task_id=task_id, file_name=file_name)
+                await progress.file_failed(file_name, str(e) or type(e).__name__)
+            else:
+                await progress.file_uploaded(file_name, attachment_url)
+
+    try:
+        await asyncio.gather(*(upload(message) for message in messages))
+        await progress.finish()
+    finally:
+        if progress.uploaded:
+            get_backend().invalidate(Url('task', task_id))
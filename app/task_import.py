@@ -0,0 +1,403 @@
+import asyncio
+import csv
+import io
+import json
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator
+
+import aiohttp
+import structlog
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import BufferedInputFile, Message
+
+import constants
+from attachments import get_tg_file_url, upload_transport
+from backend_client import get_backend
+from outbound import standalone
+from search_index import get_search_index
+from settings import get_settings
+from task_handlers import parse_related_task_ids
+from url import Url
+
+logger = structlog.get_logger(__name__)
+
+FIELDS = frozenset({'ref', 'title', 'description', 'reporter_id', 'assignee_id', 'related_task_ids'})
+REF_RE = re.compile(r'#([\w-]+)')
+EMPTY_VALUES = (None, '', '-')
+
+
+class ImportFileError(Exception):
+    pass
+
+
+@dataclass(eq=False)
+class TaskRow:
+    line: int
+    ref: str | None
+    task: dict[str, Any]
+    refs: list[str]
+    missing_refs: set[str] = field(default_factory=set)
+
+
+def get_import_format(file_name: str | None, mime_type: str | None) -> str | None:
+    file_name = (file_name or '').lower()
+    if file_name.endswith('.csv') or mime_type == 'text/csv':
+        return 'csv'
+    if file_name.endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    return None
+
+
+async def iter_lines(stream: aiohttp.StreamReader) -> AsyncIterator[str]:
+    line_number = 0
+    try:
+        async for raw_line in stream:
+            line_number += 1
+            yield raw_line.decode('utf-8-sig' if line_number == 1 else 'utf-8')
+    except UnicodeDecodeError:
+        raise ImportFileError(f'Line {line_number} is not valid UTF-8') from None
+    except ValueError:
+        # aiohttp refuses lines longer than its read buffer
+        raise ImportFileError(f'Line {line_number + 1} is too long') from None
+
+
+async def iter_csv_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict[str, Any]]]:
+    header = None
+    delimiter = ','
+    record, record_line, line_number = '', 0, 0
+    async for line in lines:
+        line_number += 1
+        if not record:
+            record_line = line_number
+        record += line
+        # a quoted value may contain line breaks, the record ends on a line with balanced quotes
+        if record.count('"') % 2:
+            continue
+
+        text, record = record, ''
+        if not text.strip():
+            continue
+        if header is None:
+            delimiter = ';' if text.count(';') > text.count(',') else ','
+            header = [name.strip().lower() for name in next(csv.reader([text], delimiter=delimiter))]
+            continue
+
+        values = next(csv.reader([text], delimiter=delimiter))
+        yield record_line, dict(zip(header, values))
+
+    if record.strip():
+        raise ImportFileError(f'Unterminated quote in the record starting on line {record_line}')
+
+
+async def iter_jsonl_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict[str, Any] | str]]:
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_number, f'invalid JSON: {e.msg}'
+            continue
+        yield line_number, record if isinstance(record, dict) else 'a line must be a JSON object'
+
+
+def parse_row(line: int, record: dict[str, Any]) -> TaskRow:
+    """Checks the row has the fields the ``/create_task`` dialog sends, raises ``ValueError`` if not."""
+    unknown = set(record) - FIELDS
+    if unknown:
+        raise ValueError(f'unknown fields: {", ".join(sorted(unknown))}')
+
+    title = str(record.get('title') or '').strip()
+    if not title:
+        raise ValueError('title is required')
+
+    description = record.get('description')
+    description = None if description in EMPTY_VALUES else str(description).strip()
+
+    related_task_ids = record.get('related_task_ids')
+    if isinstance(related_task_ids, list):
+        related_task_ids = ', '.join(map(str, related_task_ids))
+    related_task_ids = '' if related_task_ids in EMPTY_VALUES else str(related_task_ids)
+    refs = list(dict.fromkeys(REF_RE.findall(related_task_ids)))
+    task_ids = parse_related_task_ids(REF_RE.sub(' ', related_task_ids))
+    max_ids = get_settings().max_related_task_ids
+    if len(task_ids) + len(refs) > max_ids:
+        raise ValueError(f'too many related task ids, at most {max_ids} are allowed')
+
+    return TaskRow(
+        line=line,
+        ref=parse_ref(record),
+        task={
+            'title': title,
+            'description': description,
+            'reporter_id': _parse_id(record.get('reporter_id'), 'reporter_id', required=True),
+            'assignee_id': _parse_id(record.get('assignee_id'), 'assignee_id', required=False),
+            'related_task_ids': task_ids,
+        },
+        refs=refs,
+    )
+
+
+def parse_ref(record: dict[str, Any]) -> str | None:
+    ref = record.get('ref')
+    return None if ref in EMPTY_VALUES else str(ref).strip().lstrip('#')
+
+
+def _parse_id(value: Any, name: str, required: bool) -> int | None:
+    if value in EMPTY_VALUES:
+        if required:
+            raise ValueError(f'{name} is required')
+        return None
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        raise ValueError(f'{name} must be an integer, got {value!r}') from None
+
+
+class ImportProgress:
+    """Keeps the progress message of an import up to date, edits are throttled to ``edit_interval``."""
+
+    def __init__(self, progress_message: Message, edit_interval: float) -> None:
+        self._progress_message = progress_message
+        self._edit_interval = edit_interval
+        self._edited_at = time.monotonic()
+        self._text = progress_message.text
+        self.read = 0
+        self.created = 0
+        self.failed: list[tuple[int, str | None, str]] = []
+
+    async def row_read(self) -> None:
+        self.read += 1
+        await self._refresh()
+
+    async def row_created(self) -> None:
+        self.created += 1
+        await self._refresh()
+
+    async def row_failed(self, row_line: int, ref: str | None, error: str) -> None:
+        self.failed.append((row_line, ref, error))
+        await self._refresh()
+
+    async def finish(self, file_error: str | None) -> None:
+        failed = sorted(self.failed, key=lambda failure: failure[0])
+        lines = [f'Imported {self.created}/{self.read} task(s)']
+        if file_error:
+            lines.append(f'Import stopped: {file_error}')
+        if self.failed:
+            lines.append(f'\nFailed {len(self.failed)} row(s):')
+            lines += [self._format_failure(failure) for failure in failed]
+
+        text = '\n'.join(lines)
+        if len(text) <= constants.TELEGRAM_MESSAGE_MAX_LENGTH:
+            await self._edit(text)
+            return
+
+        summary = lines[:2] if file_error else lines[:1]
+        await self._edit('\n'.join(summary) + f'\nFailed {len(self.failed)} row(s), see the report')
+        report = io.StringIO()
+        writer = csv.writer(report)
+        writer.writerow(['line', 'ref', 'error'])
+        writer.writerows(failed)
+        await self._progress_message.answer_document(
+            BufferedInputFile(report.getvalue().encode(), filename='import_errors.csv'),
+        )
+
+    @staticmethod
+    def _format_failure(failure: tuple[int, str | None, str]) -> str:
+        row_line, ref, error = failure
+        return f'line {row_line}{f" (#{ref})" if ref else ""}: {error}'
+
+    async def _refresh(self) -> None:
+        if time.monotonic() - self._edited_at < self._edit_interval:
+            return
+        failed = f', {len(self.failed)} failed' if self.failed else ''
+        await self._edit(f'Importing tasks: {self.read} read, {self.created} created{failed}')
+
+    async def _edit(self, text: str) -> None:
+        if text == self._text:
+            return
+        self._text = text
+        self._edited_at = time.monotonic()
+        try:
+            await self._progress_message.edit_text(text)
+        except (TelegramAPIError, aiohttp.ClientError) as e:
+            # progress is best-effort, a flood limit or a network error must not abort the import
+            logger.info('failed to edit import progress', error=str(e))
+
+
+class TaskImporter:
+    """Creates the tasks of the rows with bounded parallelism as they are read.
+
+    A row referencing other rows (``#ref`` in its related task ids) waits until they are created,
+    i.e. rows are created in the topological order of their references. Rows referencing a failed
+    row fail as well, rows left waiting when the file ends have unknown or circular references.
+    """
+
+    def __init__(self, progress: ImportProgress, concurrency: int | None = None) -> None:
+        concurrency = concurrency or get_settings().import_concurrency
+        self._progress = progress
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # the reader stops while this many rows are being created, so the file isn't read ahead of the backend
+        self._max_in_flight = 2 * concurrency
+        self._refs: set[str] = set()
+        self._created: dict[str, int] = {}
+        self._failed_refs: set[str] = set()
+        self._waiting: dict[str, list[TaskRow]] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def add(self, row: TaskRow) -> None:
+        if row.ref is not None:
+            if row.ref in self._refs:
+                # not _fail, the rows waiting for the ref wait for the first row with it
+                await self._progress.row_failed(row.line, row.ref, f'duplicate ref #{row.ref}')
+                return
+            self._refs.add(row.ref)
+
+        if failed_refs := [ref for ref in row.refs if ref in self._failed_refs]:
+            await self._fail(row, f'row #{failed_refs[0]} was not created')
+            return
+
+        row.missing_refs = {ref for ref in row.refs if ref not in self._created}
+        for ref in row.missing_refs:
+            self._waiting.setdefault(ref, []).append(row)
+
+        if not row.missing_refs:
+            while len(self._tasks) >= self._max_in_flight:
+                await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+            self._start(row)
+
+    async def reject(self, line: int, ref: str | None, error: str) -> None:
+        """Fails an invalid row, the rows referencing it fail too."""
+        row = TaskRow(line=line, ref=ref, task={}, refs=[])
+        if ref is not None:
+            if ref in self._refs:
+                row.ref = None
+            self._refs.add(ref)
+        await self._fail(row, error)
+
+    async def finish(self) -> None:
+        # created rows start the rows waiting for them, so wait until nothing new is started
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+
+        unresolved = {}
+        for rows in self._waiting.values():
+            for row in rows:
+                unresolved[row] = None
+        self._waiting.clear()
+        for row in unresolved:
+            await self._progress.row_failed(
+                row.line, row.ref,
+                'unknown or circular reference ' + ', '.join(f'#{ref}' for ref in sorted(row.missing_refs)),
+            )
+
+    def _start(self, row: TaskRow) -> None:
+        task = asyncio.create_task(self._create(row))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _create(self, row: TaskRow) -> None:
+        related_task_ids = list(dict.fromkeys(row.task['related_task_ids'] + [self._created[ref] for ref in row.refs]))
+        try:
+            async with self._semaphore:
+                async with get_backend().request(
+                        'POST',
+                        url=Url('tasks'),
+                        json={**row.task, 'related_task_ids': related_task_ids},
+                ) as response:
+                    status, body = response.status, await response.text()
+            created_task_id = json.loads(body) if status == 200 else None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            await self._fail(row, f'backend request failed: {e!r}')
+            return
+        except Exception as e:
+            # e.g. a 200 whose body isn't JSON; the row fails, the import goes on to the report
+            logger.exception('failed to create imported task', line=row.line)
+            await self._fail(row, f'unexpected error: {e!r}')
+            return
+
+        if status != 200:
+            await self._fail(row, f'backend responded {status}: {body[:200]}')
+            return
+
+        get_search_index().add_task({**row.task, 'id': created_task_id})
+        for related_task_id in related_task_ids:
+            get_backend().invalidate(Url('task', related_task_id))
+        await self._progress.row_created()
+
+        if row.ref is not None:
+            self._created[row.ref] = created_task_id
+            for waiting_row in self._waiting.pop(row.ref, []):
+                waiting_row.missing_refs.discard(row.ref)
+                if not waiting_row.missing_refs:
+                    self._start(waiting_row)
+
+    async def _fail(self, row: TaskRow, error: str) -> None:
+        await self._progress.row_failed(row.line, row.ref, error)
+        if row.ref is None or row.ref in self._failed_refs:
+            return
+
+        self._failed_refs.add(row.ref)
+        for waiting_row in self._waiting.pop(row.ref, []):
+            for ref in waiting_row.missing_refs - {row.ref}:
+                self._waiting[ref].remove(waiting_row)
+            await self._fail(waiting_row, f'row #{row.ref} was not created')
+
+
+async def import_tasks(message: Message) -> None:
+    """Streams the CSV or JSONL document of the message and creates a task per row."""
+    document = message.document
+    import_format = get_import_format(document.file_name, document.mime_type)
+    if import_format is None:
+        await message.answer('Send the tasks as a .csv or .jsonl file')
+        return
+    settings = get_settings()
+    if document.file_size and document.file_size > settings.import_max_file_size:
+        await message.answer(f'The file is too big, at most {settings.import_max_file_size // 2 ** 20} MiB')
+        return
+
+    logger.info('importing tasks', file_name=document.file_name, file_size=document.file_size, command='import_tasks')
+    with standalone():
+        progress_message = await message.answer('Importing tasks...')
+    progress = ImportProgress(
+        progress_message,
+        edit_interval=settings.import_progress_edit_interval,
+    )
+    importer = TaskImporter(progress)
+    file_error = None
+
+    try:
+        file = await message.bot.get_file(document.file_id)
+        async with upload_transport.telegram.get(get_tg_file_url(message, file)) as response:
+            response.raise_for_status()
+            lines = iter_lines(response.content)
+            records = iter_csv_records(lines) if import_format == 'csv' else iter_jsonl_records(lines)
+            async for line, record in records:
+                if progress.read >= settings.import_max_rows:
+                    raise ImportFileError(f'too many rows, at most {settings.import_max_rows} are imported')
+                await progress.row_read()
+                if isinstance(record, str):
+                    await importer.reject(line, None, record)
+                    continue
+                try:
+                    row = parse_row(line, record)
+                except ValueError as e:
+                    await importer.reject(line, parse_ref(record), str(e))
+                    continue
+                await importer.add(row)
+    except ImportFileError as e:
+        file_error = str(e)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.info('failed to download import file', error=repr(e), command='import_tasks')
+        file_error = 'failed to download the file'
+
+    await importer.finish()
+    await progress.finish(file_error)
+    logger.info(
+        'tasks imported', read=progress.read, created=progress.created, failed=len(progress.failed),
+        file_error=file_error, command='import_tasks',
+    )
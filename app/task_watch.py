@@ -0,0 +1,380 @@
+import asyncio
+import heapq
+import random
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
+from typing import Any
+
+import aiohttp
+import orjson
+import structlog
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError
+
+import constants
+from backend_client import get_backend
+from metrics import TASK_WATCH_NOTIFICATIONS, TASK_WATCH_POLLS, TASK_WATCHES
+from outbound import TokenBucket, background
+from settings import get_settings
+from url import Url
+
+logger = structlog.get_logger(__name__)
+
+MAX_VALUE_LENGTH = 200
+
+
+@dataclass(frozen=True)
+class TaskSnapshot:
+    # the task as the watchers last saw it, with the validators to ask the backend whether it changed since
+    body: bytes
+    etag: str | None = None
+    last_modified: str | None = None
+
+
+class WatchStore:
+    """Which chats watch which tasks, and the last seen version of every watched task.
+
+    SQLite in WAL mode, so all processes on one host share it: in the workers mode the
+    handlers of every worker add watches and worker 0 syncs them.
+    """
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # one thread owns the connection, so queries never run concurrently on it
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='watch-store')
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('PRAGMA busy_timeout=5000')
+        self._connection.executescript(
+            'CREATE TABLE IF NOT EXISTS watches ('
+            'chat_id INTEGER NOT NULL, task_id INTEGER NOT NULL, PRIMARY KEY (chat_id, task_id));'
+            'CREATE INDEX IF NOT EXISTS watches_task_id ON watches (task_id);'
+            'CREATE TABLE IF NOT EXISTS snapshots ('
+            'task_id INTEGER PRIMARY KEY, body BLOB NOT NULL, etag TEXT, last_modified TEXT);'
+        )
+
+    async def add(self, chat_id: int, task_id: int, body: bytes) -> bool:
+        """Returns ``False`` if the chat already watches the task; ``body`` is the version the chat has seen."""
+        return await self._run(self._add, chat_id, task_id, body)
+
+    async def remove(self, chat_id: int, task_id: int) -> bool:
+        return await self._run(self._remove, 'chat_id = ? AND task_id = ?', (chat_id, task_id))
+
+    async def remove_chat(self, chat_id: int) -> None:
+        await self._run(self._remove, 'chat_id = ?', (chat_id,))
+
+    async def remove_task(self, task_id: int) -> None:
+        await self._run(self._remove, 'task_id = ?', (task_id,))
+
+    async def get_chat_tasks(self, chat_id: int) -> list[int]:
+        return await self._run(self._get_chat_tasks, chat_id)
+
+    async def get_watchers(self, task_id: int) -> list[int]:
+        return await self._run(self._get_watchers, task_id)
+
+    async def get_watches(self) -> dict[int, list[int]]:
+        """Chats watching every watched task."""
+        return await self._run(self._get_watches)
+
+    async def get_snapshot(self, task_id: int) -> TaskSnapshot | None:
+        return await self._run(self._get_snapshot, task_id)
+
+    async def save_snapshot(self, task_id: int, snapshot: TaskSnapshot) -> None:
+        await self._run(self._save_snapshot, task_id, snapshot)
+
+    async def close(self) -> None:
+        await self._run(self._connection.close)
+        self._executor.shutdown()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _add(self, chat_id: int, task_id: int, body: bytes) -> bool:
+        cursor = self._connection.execute(
+            'INSERT OR IGNORE INTO watches (chat_id, task_id) VALUES (?, ?)', (chat_id, task_id),
+        )
+        # a task other chats already watch keeps its snapshot, its changes are sent to everyone alike
+        self._connection.execute('INSERT OR IGNORE INTO snapshots (task_id, body) VALUES (?, ?)', (task_id, body))
+        return cursor.rowcount > 0
+
+    def _remove(self, condition: str, params: tuple) -> bool:
+        cursor = self._connection.execute(f'DELETE FROM watches WHERE {condition}', params)
+        self._connection.execute('DELETE FROM snapshots WHERE task_id NOT IN (SELECT task_id FROM watches)')
+        return cursor.rowcount > 0
+
+    def _get_chat_tasks(self, chat_id: int) -> list[int]:
+        rows = self._connection.execute('SELECT task_id FROM watches WHERE chat_id = ? ORDER BY task_id', (chat_id,))
+        return [task_id for task_id, in rows]
+
+    def _get_watchers(self, task_id: int) -> list[int]:
+        rows = self._connection.execute('SELECT chat_id FROM watches WHERE task_id = ?', (task_id,))
+        return [chat_id for chat_id, in rows]
+
+    def _get_watches(self) -> dict[int, list[int]]:
+        watches: dict[int, list[int]] = {}
+        for task_id, chat_id in self._connection.execute('SELECT task_id, chat_id FROM watches'):
+            watches.setdefault(task_id, []).append(chat_id)
+        return watches
+
+    def _get_snapshot(self, task_id: int) -> TaskSnapshot | None:
+        row = self._connection.execute(
+            'SELECT body, etag, last_modified FROM snapshots WHERE task_id = ?', (task_id,),
+        ).fetchone()
+        return TaskSnapshot(*row) if row else None
+
+    def _save_snapshot(self, task_id: int, snapshot: TaskSnapshot) -> None:
+        # a task nobody watches any more gets no snapshot back
+        self._connection.execute(
+            'UPDATE snapshots SET body = ?, etag = ?, last_modified = ? WHERE task_id = ?',
+            (snapshot.body, snapshot.etag, snapshot.last_modified, task_id),
+        )
+
+
+@cache
+def get_watch_store() -> WatchStore:
+    return WatchStore(get_settings().task_watch_path)
+
+
+def diff_tasks(old: dict[str, Any], new: dict[str, Any]) -> list[str]:
+    """One line per changed field; lists (attachments, related tasks) show what was added and removed."""
+    lines = []
+    for key in dict.fromkeys([*old, *new]):
+        before, after = old.get(key), new.get(key)
+        if before == after:
+            continue
+        if isinstance(before, list) or isinstance(after, list):
+            before, after = before or [], after or []
+            added = [item for item in after if item not in before]
+            removed = [item for item in before if item not in after]
+            if added:
+                lines.append(f'{key}: + {", ".join(map(format_value, added))}')
+            if removed:
+                lines.append(f'{key}: - {", ".join(map(format_value, removed))}')
+            if not (added or removed):
+                lines.append(f'{key}: reordered')
+        else:
+            lines.append(f'{key}: {format_value(before)} -> {format_value(after)}')
+    return lines
+
+
+def format_value(value: Any) -> str:
+    text = '-' if value is None else value if isinstance(value, str) else orjson.dumps(value).decode()
+    return text if len(text) <= MAX_VALUE_LENGTH else f'{text[:MAX_VALUE_LENGTH - 1]}…'
+
+
+class TaskSync:
+    """Polls the watched tasks in the background and sends what changed to the chats watching them.
+
+    Every task is fetched once per poll however many chats watch it (the backend has no bulk
+    endpoint), with ``If-None-Match``/``If-Modified-Since`` when the backend gave an ``ETag`` or
+    ``Last-Modified``, so an unchanged task costs a 304 without a body. A task that didn't change
+    is polled half as often each time, up to ``max_interval``; a change brings it back to
+    ``min_interval``. Poll times are jittered, so tasks watched at the same moment spread out, and
+    all polls together stay within ``rate`` requests per second.
+    """
+
+    def __init__(
+            self,
+            store: WatchStore,
+            min_interval: float,
+            max_interval: float,
+            jitter: float,
+            rate: float,
+            concurrency: int,
+            refresh_interval: float,
+            enabled: bool,
+    ) -> None:
+        self.enabled = enabled
+        self._store = store
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._jitter = jitter
+        self._refresh_interval = refresh_interval
+        self._bucket = TokenBucket(rate, max(1, int(rate)))
+        self._slots = asyncio.Semaphore(concurrency)
+        self._bot: Bot | None = None
+        # chats per watched task, reread from the store every refresh_interval
+        self._watchers: dict[int, list[int]] = {}
+        self._intervals: dict[int, float] = {}
+        # the heap may hold outdated entries, the valid one is the time in _due_at
+        self._due: list[tuple[float, int]] = []
+        self._due_at: dict[int, float] = {}
+        self._rescheduled = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._polls: set[asyncio.Task] = set()
+
+    async def start(self, bot: Bot) -> None:
+        if not self.enabled or self._task is not None:
+            return
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+        logger.info('task sync started')
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        for task in (self._task, *self._polls):
+            task.cancel()
+        await asyncio.gather(self._task, *self._polls, return_exceptions=True)
+        self._task = None
+        logger.info('task sync stopped')
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        refreshed_at = float('-inf')
+        while True:
+            now = loop.time()
+            if now - refreshed_at >= self._refresh_interval:
+                try:
+                    await self._refresh()
+                except sqlite3.Error:
+                    logger.exception('failed to read watched tasks')
+                refreshed_at = now = loop.time()
+
+            due_at, task_id = self._due[0] if self._due else (float('inf'), None)
+            if due_at > now:
+                await self._wait(min(due_at, refreshed_at + self._refresh_interval) - now)
+                continue
+
+            heapq.heappop(self._due)
+            if self._due_at.get(task_id) != due_at:
+                continue
+            del self._due_at[task_id]
+
+            await self._bucket.wait()
+            await self._slots.acquire()
+            poll = asyncio.create_task(self._poll(task_id))
+            self._polls.add(poll)
+            poll.add_done_callback(self._polls.discard)
+
+    async def _wait(self, timeout: float) -> None:
+        # a poll that finished meanwhile may schedule its task before the current head
+        self._rescheduled.clear()
+        with suppress(TimeoutError):
+            await asyncio.wait_for(self._rescheduled.wait(), timeout)
+
+    async def _refresh(self) -> None:
+        watchers = await self._store.get_watches()
+        for task_id in watchers.keys() - self._watchers.keys():
+            # spread newly watched tasks over the first interval, they have a snapshot already
+            self._intervals[task_id] = self._min_interval
+            self._schedule(task_id, random.uniform(0, self._min_interval))
+        for task_id in self._watchers.keys() - watchers.keys():
+            self._intervals.pop(task_id, None)
+            self._due_at.pop(task_id, None)
+        self._watchers = watchers
+        TASK_WATCHES.set(len(watchers))
+
+    def _schedule(self, task_id: int, delay: float) -> None:
+        due_at = asyncio.get_running_loop().time() + delay
+        self._due_at[task_id] = due_at
+        heapq.heappush(self._due, (due_at, task_id))
+        self._rescheduled.set()
+
+    async def _poll(self, task_id: int) -> None:
+        try:
+            changed = await self._sync(task_id)
+        except Exception:
+            TASK_WATCH_POLLS.labels(result='error').inc()
+            logger.exception('task sync failed', task_id=task_id)
+            changed = False
+        finally:
+            self._slots.release()
+
+        if task_id not in self._watchers:
+            return
+        interval = self._intervals[task_id]
+        interval = self._min_interval if changed else min(self._max_interval, interval * 2)
+        self._intervals[task_id] = interval
+        self._schedule(task_id, interval * random.uniform(1 - self._jitter, 1 + self._jitter))
+
+    async def _sync(self, task_id: int) -> bool:
+        """Fetches the task and notifies its watchers if it changed, returns whether it did."""
+        snapshot = await self._store.get_snapshot(task_id)
+        headers = {}
+        if snapshot is not None and snapshot.etag:
+            headers['If-None-Match'] = snapshot.etag
+        if snapshot is not None and snapshot.last_modified:
+            headers['If-Modified-Since'] = snapshot.last_modified
+
+        try:
+            async with get_backend().request('GET', Url('task', task_id), headers=headers) as response:
+                status = response.status
+                body = await response.read() if status == 200 else b''
+                latest = TaskSnapshot(body, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            TASK_WATCH_POLLS.labels(result='error').inc()
+            logger.info('task sync request failed', task_id=task_id, error=repr(e))
+            return False
+
+        if status == 304:
+            TASK_WATCH_POLLS.labels(result='not_modified').inc()
+            return False
+        if status == 404:
+            TASK_WATCH_POLLS.labels(result='deleted').inc()
+            await self._notify(task_id, f'Task {task_id} was deleted, it is not watched any more')
+            await self._store.remove_task(task_id)
+            self._watchers.pop(task_id, None)
+            return False
+        if status != 200:
+            TASK_WATCH_POLLS.labels(result='error').inc()
+            logger.info('backend responded to task sync with an error', task_id=task_id, status=status)
+            return False
+
+        if snapshot is None or snapshot.body == body:
+            # a snapshot is only missing if the last watcher left meanwhile, it won't be stored then
+            TASK_WATCH_POLLS.labels(result='unchanged').inc()
+            if snapshot is not None and snapshot != latest:
+                await self._store.save_snapshot(task_id, latest)
+            return False
+
+        changes = diff_tasks(orjson.loads(snapshot.body), orjson.loads(body))
+        await self._store.save_snapshot(task_id, latest)
+        # handlers must not serve the old version from the cache after the watchers were told about the new one
+        get_backend().invalidate(Url('task', task_id))
+        if not changes:
+            TASK_WATCH_POLLS.labels(result='unchanged').inc()
+            return False
+
+        TASK_WATCH_POLLS.labels(result='changed').inc()
+        logger.info('watched task changed', task_id=task_id, fields=len(changes))
+        text = '\n'.join([f'Task {task_id} changed:', *changes])
+        await self._notify(task_id, text[:constants.TELEGRAM_MESSAGE_MAX_LENGTH])
+        return True
+
+    async def _notify(self, task_id: int, text: str) -> None:
+        async def send(chat_id: int) -> None:
+            try:
+                with background():
+                    await self._bot.send_message(chat_id, text)
+            except TelegramForbiddenError as e:
+                # the bot was blocked or removed from the chat, nobody will read its notifications
+                logger.info('chat unreachable, removing its watches', chat_id=chat_id, error=str(e))
+                await self._store.remove_chat(chat_id)
+            except TelegramAPIError as e:
+                logger.warning('failed to notify about a task change', chat_id=chat_id, task_id=task_id, error=str(e))
+            else:
+                TASK_WATCH_NOTIFICATIONS.inc()
+
+        # from the store, not _watchers: a chat that has just left must not get the notification
+        await asyncio.gather(*(send(chat_id) for chat_id in await self._store.get_watchers(task_id)))
+
+
+@cache
+def get_task_sync() -> TaskSync:
+    settings = get_settings()
+    return TaskSync(
+        get_watch_store(),
+        min_interval=settings.task_watch_min_interval,
+        max_interval=settings.task_watch_max_interval,
+        jitter=settings.task_watch_jitter,
+        rate=settings.task_watch_rate,
+        concurrency=settings.task_watch_concurrency,
+        refresh_interval=settings.task_watch_refresh_interval,
+        enabled=settings.task_watch_sync,
+    )
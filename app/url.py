@@ -1,12 +1,55 @@
 from dataclasses import dataclass
+from functools import cache
 
-import constants
+from settings import get_settings
+
+# endpoint templates of the backend resources, relative to BACKEND_URL/API_VERSION
+ROUTES = {
+    'users': 'tasks/users/',
+    'user': 'tasks/users/{id}',
+    'tasks': 'tasks/tasks/',
+    'task': 'tasks/tasks/{id}',
+    'task_attachments': 'tasks/tasks/{id}/attachments/',
+    'comments': 'tasks/comments/',
+    'comment': 'tasks/comments/{id}',
+}
+
+# every template split around its placeholder once, building a URL is then a concatenation
+_COMPILED_ROUTES = {route: template.partition('{id}') for route, template in ROUTES.items()}
+
+
+@cache
+def get_api_url() -> str:
+    settings = get_settings()
+    return f'{settings.backend_url}/{settings.api_version}/'
 
 
 @dataclass(frozen=True)
 class Url:
-    endpoint: str
-    version: str = constants.API_VERSION
+    route: str
+    id: int | str | None = None
+
+    def __post_init__(self) -> None:
+        if self.route not in ROUTES:
+            raise ValueError(f'Unknown route: {self.route!r}')
+        has_id = bool(_COMPILED_ROUTES[self.route][1])
+        if has_id != (self.id is not None):
+            raise ValueError(f'Route {self.route!r} {"needs" if has_id else "takes no"} id')
+        if isinstance(self.id, str):
+            # the id becomes part of the path, '../x' must not reach the backend
+            if not self.id.isdecimal():
+                raise ValueError(f'Invalid id: {self.id!r}')
+            # Url('task', '5') and Url('task', 5) must be one cache key
+            object.__setattr__(self, 'id', int(self.id))
+
+    @property
+    def template(self) -> str:
+        return ROUTES[self.route]
+
+    @property
+    def endpoint(self) -> str:
+        prefix, placeholder, suffix = _COMPILED_ROUTES[self.route]
+        return f'{prefix}{self.id}{suffix}' if placeholder else prefix
 
     def __str__(self) -> str:
-        return f'http://{constants.SERVICE_IP_ADDRESS}/{self.version}/{self.endpoint}'
+        return get_api_url() + self.endpoint
@@ -1,15 +1,16 @@
 import json
 
-import aiohttp
 import structlog
 from aiogram import Router
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import Message
 
+from backend_client import get_backend
+from search_index import get_search_index
+from rendering import answer_json
 from url import Url
-from utils import make_pretty_json_in_telegram
 
 logger = structlog.get_logger(__name__)
 user_router = Router()
@@ -24,7 +25,15 @@ class GettingUserStates(StatesGroup):
 
 
 @user_router.message(Command('create_user'))
-async def create_user(message: Message, state: FSMContext) -> None:
+async def create_user(message: Message, state: FSMContext, command: CommandObject, raw_state: str | None) -> None:
+    # one-shot form: /create_user <user_name>
+    if command.args:
+        if raw_state is not None:
+            await state.clear()
+        logger.info('create_user: one-shot command')
+        await _create_user(message, command.args.strip())
+        return
+
     await state.clear()
 
     logger.info('create_user: starting command')
@@ -37,26 +46,40 @@ async def create_user(message: Message, state: FSMContext) -> None:
 async def username_chosen(message: Message, state: FSMContext) -> None:
     logger.info('username chosen')
 
-    create_user_name = message.text
-    async with aiohttp.request(
+    await _create_user(message, message.text)
+    await state.clear()
+
+
+async def _create_user(message: Message, create_user_name: str) -> None:
+    async with get_backend().request(
             method='post',
-            url=str(Url(endpoint=f'tasks/users/')),
+            url=Url('users'),
             data={'name': create_user_name},
     ) as response:
-        if response.status == 201:
-            json_response = await response.json()
-            created_user_id = json_response['id']
-            await message.answer(f'user_id: {created_user_id}')
-            logger.info(f'user {create_user_name} has been created')
-        else:
-            response_text = await response.text()
-            await message.answer(response_text)
+        # the backend slot is released before replying, replies may wait for Telegram flood limits
+        status, body = response.status, await response.read()
 
-        await state.clear()
+    if status == 201:
+        created_user_id = json.loads(body)['id']
+        get_search_index().add_user({'id': created_user_id, 'name': create_user_name})
+        await message.answer(f'user_id: {created_user_id}')
+        logger.info(f'user {create_user_name} has been created')
+    else:
+        await message.answer(body.decode())
 
 
 @user_router.message(Command('get_user'))
-async def get_user(message: Message, state: FSMContext) -> None:
+async def get_user(message: Message, state: FSMContext, command: CommandObject, raw_state: str | None) -> None:
+    # one-shot form: /get_user <user_id>
+    if command.args:
+        if raw_state is not None:
+            await state.clear()
+        if not command.args.strip().isdecimal():
+            await message.answer('Usage: /get_user <user_id>')
+            return
+        await _send_user(message, int(command.args))
+        return
+
     await state.clear()
 
     logger.info('starting command', command='get_user')
@@ -66,18 +89,18 @@ async def get_user(message: Message, state: FSMContext) -> None:
 
 @user_router.message(GettingUserStates.waiting_for_user_id)
 async def user_id_chosen(message: Message, state: FSMContext) -> None:
-    user_id = message.text
+    if not message.text or not message.text.strip().isdecimal():
+        await message.answer('user_id must be a number, enter it again')
+        return
+
+    await _send_user(message, int(message.text))
+    await state.clear()
+
+
+async def _send_user(message: Message, user_id: int) -> None:
     logger.info('Getting user', user_id=user_id)
 
-    async with aiohttp.request(
-            method='get',
-            url=str(Url(endpoint=f'tasks/users/{user_id}'))
-    ) as response:
-        user = await response.json()
-        logger.info('Got user', user_id=user_id)
+    response = await get_backend().get_cached(Url('user', user_id))
+    logger.info('Got user', user_id=user_id)
 
-    await message.answer(
-        make_pretty_json_in_telegram(json.dumps(user)),
-        parse_mode='Markdown'
-    )
-    await state.clear()
+    await answer_json(message, response.body, 'user.json')
@@ -1,4 +0,0 @@
-def make_pretty_json_in_telegram(json_str: str) -> str:
-    return ('```json\n'
-            f'{json_str}\n'
-            '```')
\ No newline at end of file
@@ -0,0 +1,117 @@
+import structlog
+from aiogram import Router
+from aiogram.filters import Command, CommandObject
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import StatesGroup, State
+from aiogram.types import Message
+
+from backend_client import get_backend
+from settings import get_settings
+from task_watch import get_watch_store
+from url import Url
+
+logger = structlog.get_logger(__name__)
+watch_router = Router()
+
+
+class WatchingTaskStates(StatesGroup):
+    waiting_for_task_id = State()
+
+
+class UnwatchingTaskStates(StatesGroup):
+    waiting_for_task_id = State()
+
+
+@watch_router.message(Command('watch_task'))
+async def watch_task(message: Message, state: FSMContext, command: CommandObject, raw_state: str | None) -> None:
+    # one-shot form: /watch_task <task_id>
+    if command.args:
+        if raw_state is not None:
+            await state.clear()
+        if not command.args.strip().isdecimal():
+            await message.answer('Usage: /watch_task <task_id>')
+            return
+        await _watch_task(message, int(command.args))
+        return
+
+    await state.clear()
+
+    logger.info('starting command', command='watch_task')
+    await state.set_state(WatchingTaskStates.waiting_for_task_id)
+    await message.answer(f'{await _describe_watches(message.chat.id)}\n\nEnter task id to watch')
+
+
+@watch_router.message(WatchingTaskStates.waiting_for_task_id)
+async def watch_task__task_id_chosen(message: Message, state: FSMContext) -> None:
+    if not message.text or not message.text.strip().isdecimal():
+        await message.answer('Task id must be a number. Enter task id to watch')
+        return
+
+    await _watch_task(message, int(message.text))
+    await state.clear()
+
+
+async def _watch_task(message: Message, task_id: int) -> None:
+    logger.info('watching task', task_id=task_id)
+
+    response = await get_backend().get_cached(Url('task', task_id))
+    if response.status != 200:
+        await message.answer(response.text())
+        return
+
+    store = get_watch_store()
+    max_watches = get_settings().task_watch_max_per_chat
+    if len(await store.get_chat_tasks(message.chat.id)) >= max_watches:
+        await message.answer(f'At most {max_watches} tasks can be watched, /unwatch_task one of them first')
+        return
+
+    # changes are reported against the version the user has just been shown
+    if await store.add(message.chat.id, task_id, response.body):
+        await message.answer(f'Watching task {task_id}, its changes will be sent here')
+    else:
+        await message.answer(f'Task {task_id} is already watched')
+
+
+@watch_router.message(Command('unwatch_task'))
+async def unwatch_task(message: Message, state: FSMContext, command: CommandObject, raw_state: str | None) -> None:
+    # one-shot form: /unwatch_task <task_id>
+    if command.args:
+        if raw_state is not None:
+            await state.clear()
+        if not command.args.strip().isdecimal():
+            await message.answer('Usage: /unwatch_task <task_id>')
+            return
+        await _unwatch_task(message, int(command.args))
+        return
+
+    await state.clear()
+
+    logger.info('starting command', command='unwatch_task')
+    await state.set_state(UnwatchingTaskStates.waiting_for_task_id)
+    await message.answer(f'{await _describe_watches(message.chat.id)}\n\nEnter task id to stop watching')
+
+
+@watch_router.message(UnwatchingTaskStates.waiting_for_task_id)
+async def unwatch_task__task_id_chosen(message: Message, state: FSMContext) -> None:
+    if not message.text or not message.text.strip().isdecimal():
+        await message.answer('Task id must be a number. Enter task id to stop watching')
+        return
+
+    await _unwatch_task(message, int(message.text))
+    await state.clear()
+
+
+async def _unwatch_task(message: Message, task_id: int) -> None:
+    logger.info('unwatching task', task_id=task_id)
+
+    if await get_watch_store().remove(message.chat.id, task_id):
+        await message.answer(f'Task {task_id} is not watched any more')
+    else:
+        await message.answer(f'Task {task_id} is not watched')
+
+
+async def _describe_watches(chat_id: int) -> str:
+    task_ids = await get_watch_store().get_chat_tasks(chat_id)
+    if not task_ids:
+        return 'No tasks are watched'
+    return f'Watched tasks: {", ".join(map(str, task_ids))}'
@@ -0,0 +1,53 @@
+import asyncio
+
+import structlog
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from settings import get_settings
+
+logger = structlog.get_logger(__name__)
+
+
+def build_webhook_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    settings = get_settings()
+    app = web.Application()
+    app.router.add_get('/health', health)
+
+    # Telegram gets its 200 right away; the update itself is processed in a background task
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=settings.webhook_secret,
+    ).register(app, path=settings.webhook_path)
+    setup_application(app, dp, bot=bot)
+
+    return app
+
+
+async def health(_: web.Request) -> web.Response:
+    return web.json_response({'status': 'ok'})
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+    settings = get_settings()
+    if settings.webhook_base_url:
+        # NOTE: the webhook is not deleted on shutdown, other replicas may still be serving it
+        await bot.set_webhook(
+            url=f'{settings.webhook_base_url.rstrip("/")}{settings.webhook_path}',
+            secret_token=settings.webhook_secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info('webhook set', base_url=settings.webhook_base_url, path=settings.webhook_path)
+
+    runner = web.AppRunner(build_webhook_app(dp, bot))
+    await runner.setup()
+    await web.TCPSite(runner, settings.webhook_host, settings.webhook_port).start()
+    logger.info('webhook server started', host=settings.webhook_host, port=settings.webhook_port)
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
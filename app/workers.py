@@ -0,0 +1,388 @@
+import asyncio
+import multiprocessing
+import multiprocessing.synchronize
+import queue
+import signal
+import threading
+from collections import deque
+from contextlib import suppress
+from typing import Any, Awaitable, Callable
+
+import aiohttp
+import orjson
+import structlog
+from aiogram import Bot, Dispatcher
+
+from log_config import configure_logging
+from metrics import metrics_server
+from settings import get_settings
+
+logger = structlog.get_logger(__name__)
+
+# sent to a worker process instead of an update when it has to finish
+STOP = None
+
+
+def get_chat_id(update: dict) -> int | None:
+    """The chat the update belongs to, ``None`` for updates outside of chats (inline queries, polls)."""
+    event = next((value for key, value in update.items() if key != 'update_id'), None)
+    if not isinstance(event, dict):
+        return None
+    # callback queries carry the chat in the message their button is attached to
+    chat = event.get('chat') or (event.get('message') or {}).get('chat')
+    return chat['id'] if chat else None
+
+
+def get_routing_key(update: dict) -> int:
+    """Updates with the same key always go to the same worker: the chat, or the user outside of chats."""
+    if (chat_id := get_chat_id(update)) is not None:
+        return chat_id
+    event = next((value for key, value in update.items() if key != 'update_id'), None)
+    if not isinstance(event, dict):
+        return 0
+    user = event.get('from') or event.get('user') or {}
+    return user.get('id', 0)
+
+
+class ChatLanes:
+    """Handles the updates of one chat one after another and the updates of different chats concurrently.
+
+    Updates outside of chats are handled right away. At most ``max_pending`` updates are
+    queued or being handled, ``put`` waits for a free slot.
+    """
+
+    def __init__(self, handle: Callable[[dict], Awaitable[Any]], max_pending: int) -> None:
+        self._handle = handle
+        self._slots = asyncio.Semaphore(max_pending)
+        self._lanes: dict[int, deque[dict]] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def put(self, update: dict) -> None:
+        await self._slots.acquire()
+        chat_id = get_chat_id(update)
+        if chat_id is None:
+            self._spawn(self._run_one(update))
+        elif chat_id in self._lanes:
+            self._lanes[chat_id].append(update)
+        else:
+            self._lanes[chat_id] = deque([update])
+            self._spawn(self._run_lane(chat_id))
+
+    async def drain(self, timeout: float) -> None:
+        """Waits for the queued updates to be handled, cancels whatever is left after ``timeout`` seconds."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._tasks and (left := deadline - loop.time()) > 0:
+            await asyncio.wait(set(self._tasks), timeout=left)
+
+        if self._tasks:
+            logger.warning('updates left unhandled on shutdown', lanes=len(self._lanes), tasks=len(self._tasks))
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _spawn(self, coro: Awaitable[None]) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_lane(self, chat_id: int) -> None:
+        lane = self._lanes[chat_id]
+        try:
+            while lane:
+                await self._run_one(lane.popleft())
+        finally:
+            del self._lanes[chat_id]
+
+    async def _run_one(self, update: dict) -> None:
+        try:
+            await self._handle(update)
+        except Exception:
+            logger.exception('update handling failed', update_id=update.get('update_id'))
+        finally:
+            self._slots.release()
+
+
+class LocalWorkers:
+    """Handles the updates in this process, ordered per chat."""
+
+    def __init__(self, bot: Bot, build_dispatcher: Callable[[], Dispatcher]) -> None:
+        self._bot = bot
+        self._dp = build_dispatcher()
+        self._workflow_data = {'dispatcher': self._dp, 'bots': [bot], **self._dp.workflow_data}
+        self._lanes = ChatLanes(
+            lambda update: self._dp.feed_raw_update(bot, update),
+            max_pending=get_settings().worker_max_pending,
+        )
+
+    async def start(self) -> None:
+        await self._dp.emit_startup(bot=self._bot, **self._workflow_data)
+
+    async def put(self, update: dict) -> None:
+        await self._lanes.put(update)
+
+    async def close(self) -> None:
+        try:
+            await self._lanes.drain(get_settings().worker_drain_timeout)
+        finally:
+            await self._dp.emit_shutdown(bot=self._bot, **self._workflow_data)
+
+
+class ProcessWorkers:
+    """A pool of worker processes, each with its own dispatcher, bot session and backend client.
+
+    An update goes to the worker picked by its routing key, so all updates of a chat are
+    handled by one process, in order, and per-process state (FSM cache, album batches, rate
+    limits) stays consistent. A worker that died is replaced, the updates it had are lost.
+    """
+
+    def __init__(self, size: int, build_dispatcher: Callable[[], Dispatcher]) -> None:
+        self._build_dispatcher = build_dispatcher
+        self._context = multiprocessing.get_context('spawn')
+        self._processes: list[multiprocessing.Process | None] = [None] * size
+        self._queues: list[multiprocessing.Queue | None] = [None] * size
+        self._ready: list[multiprocessing.synchronize.Event | None] = [None] * size
+
+    async def start(self) -> None:
+        for index in range(len(self._processes)):
+            self._start_worker(index)
+
+        # updates are not fetched before every worker can handle them
+        loop = asyncio.get_running_loop()
+        start_timeout = get_settings().worker_start_timeout
+        for index, ready in enumerate(self._ready):
+            if not await loop.run_in_executor(None, ready.wait, start_timeout):
+                raise RuntimeError(f'worker {index} did not start in {start_timeout} s')
+
+    async def put(self, update: dict) -> None:
+        index = get_routing_key(update) % len(self._processes)
+        worker = self._processes[index]
+        if not worker.is_alive():
+            logger.error('worker died, restarting', worker=index, exitcode=worker.exitcode)
+            self._start_worker(index)
+
+        updates = self._queues[index]
+        try:
+            updates.put_nowait(update)
+        except queue.Full:
+            # the worker is behind, hold polling until it catches up
+            await asyncio.get_running_loop().run_in_executor(None, updates.put, update)
+
+    async def close(self) -> None:
+        for updates in self._queues:
+            updates.put(STOP)
+
+        loop = asyncio.get_running_loop()
+        for index, worker in enumerate(self._processes):
+            # the worker gives up on its updates after WORKER_DRAIN_TIMEOUT, then shuts down
+            await loop.run_in_executor(None, worker.join, get_settings().worker_drain_timeout + 10)
+            if worker.is_alive():
+                logger.error('worker did not stop in time, killing it', worker=index)
+                worker.kill()
+        logger.info('workers stopped', workers=len(self._processes))
+
+    def _start_worker(self, index: int) -> None:
+        # a new queue every time: a killed worker may have died holding the lock of the old one
+        self._queues[index] = self._context.Queue(maxsize=get_settings().worker_queue_size)
+        self._ready[index] = self._context.Event()
+        worker = self._context.Process(
+            target=run_worker,
+            args=(index, self._queues[index], self._build_dispatcher, self._ready[index]),
+            name=f'bot-worker-{index}',
+        )
+        worker.start()
+        self._processes[index] = worker
+        logger.info('worker started', worker=index, pid=worker.pid)
+
+
+def run_worker(
+        index: int,
+        updates: multiprocessing.Queue,
+        build_dispatcher: Callable[[], Dispatcher],
+        ready: multiprocessing.synchronize.Event,
+) -> None:
+    # the supervisor stops the workers once it stopped polling, they must not quit on their own
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    configure_logging()
+    if metrics_port := get_settings().metrics_port:
+        metrics_server.port = metrics_port + index
+    if index:
+        # the watch store is shared by the workers, one of them is enough to sync it
+        from task_watch import get_task_sync
+        get_task_sync().enabled = False
+    asyncio.run(_run_worker(updates, build_dispatcher, ready))
+
+
+async def _run_worker(
+        updates: multiprocessing.Queue,
+        build_dispatcher: Callable[[], Dispatcher],
+        ready: multiprocessing.synchronize.Event,
+) -> None:
+    from start_handlers import get_bot
+
+    bot = get_bot()
+    workers = LocalWorkers(bot, build_dispatcher)
+    await workers.start()
+    # pydantic caches the generic models aiogram parses responses with in a context variable;
+    # set it up here, so every handler task spawned from this task shares one cache
+    # instead of building the models again in its own context
+    await bot.get_me()
+    ready.set()
+
+    received: asyncio.Queue[dict | None] = asyncio.Queue(maxsize=1)
+    threading.Thread(
+        target=_read_updates, args=(updates, received, asyncio.get_running_loop()), daemon=True,
+    ).start()
+    try:
+        while (update := await received.get()) is not STOP:
+            await workers.put(update)
+    finally:
+        try:
+            await workers.close()
+        finally:
+            await bot.session.close()
+
+
+def _read_updates(
+        updates: multiprocessing.Queue,
+        received: asyncio.Queue[dict | None],
+        loop: asyncio.AbstractEventLoop,
+) -> None:
+    # a blocking read in its own thread, the event loop only gets the updates
+    while True:
+        try:
+            update = updates.get(timeout=1)
+        except queue.Empty:
+            if multiprocessing.parent_process().is_alive():
+                continue
+            logger.error('supervisor is gone, stopping')
+            update = STOP
+        # waits while the worker has WORKER_MAX_PENDING updates, then the queue fills up and the supervisor waits too
+        asyncio.run_coroutine_threadsafe(received.put(update), loop).result()
+        if update is STOP:
+            return
+
+
+class GetUpdatesError(Exception):
+    def __init__(self, error_code: int | None, description: str, retry_after: int | None) -> None:
+        super().__init__(f'{error_code}: {description}')
+        self.error_code = error_code
+        self.retry_after = retry_after
+
+
+class UpdatePoller:
+    """Long-polls ``getUpdates`` and hands every update over to ``on_update`` as a raw dict.
+
+    The updates are only routed here, so they are not parsed into aiogram objects: that is
+    left to the dispatcher that handles them. An update is confirmed by the next ``getUpdates``
+    call, so stopping only interrupts the wait for new updates, a batch that was received is
+    always handed over completely.
+    """
+
+    def __init__(self, bot: Bot, allowed_updates: list[str], on_update: Callable[[dict], Awaitable[None]]) -> None:
+        self._bot = bot
+        self._allowed_updates = allowed_updates
+        self._on_update = on_update
+        self._offset: int | None = None
+        self._stopping = asyncio.Event()
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+    async def run(self) -> None:
+        backoff = 1.0
+        while not self._stopping.is_set():
+            try:
+                updates = await self._wait_for_updates()
+            except GetUpdatesError as e:
+                if e.error_code in (401, 404):
+                    raise
+                logger.warning('failed to get updates, retrying', error=str(e), backoff=e.retry_after or backoff)
+                await asyncio.sleep(e.retry_after or backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning('failed to get updates, retrying', error=repr(e), backoff=backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            if updates is None:
+                break
+
+            backoff = 1.0
+            for update in updates:
+                await self._on_update(update)
+                self._offset = update['update_id'] + 1
+
+    async def confirm(self) -> None:
+        """Confirms the handed over updates, otherwise Telegram sends them again after a restart."""
+        if self._offset is not None:
+            with suppress(GetUpdatesError, aiohttp.ClientError, asyncio.TimeoutError):
+                await self._get_updates(timeout=0, limit=1)
+
+    async def _wait_for_updates(self) -> list[dict] | None:
+        request = asyncio.create_task(self._get_updates(
+            timeout=get_settings().worker_polling_timeout,
+            allowed_updates=self._allowed_updates,
+        ))
+        stopping = asyncio.create_task(self._stopping.wait())
+        await asyncio.wait({request, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        stopping.cancel()
+        if not request.done():
+            request.cancel()
+            with suppress(asyncio.CancelledError):
+                await request
+            return None
+        return request.result()
+
+    async def _get_updates(self, timeout: int, **params: Any) -> list[dict]:
+        session = await self._bot.session.create_session()
+        url = self._bot.session.api.api_url(token=self._bot.token, method='getUpdates')
+        async with session.post(
+                url,
+                json={'offset': self._offset, 'timeout': timeout, **params},
+                timeout=aiohttp.ClientTimeout(total=timeout + 10),
+        ) as response:
+            payload = orjson.loads(await response.read())
+
+        if not payload.get('ok'):
+            raise GetUpdatesError(
+                payload.get('error_code'),
+                payload.get('description', ''),
+                (payload.get('parameters') or {}).get('retry_after'),
+            )
+        return payload['result']
+
+
+async def run_workers(
+        bot: Bot,
+        build_dispatcher: Callable[[], Dispatcher],
+        allowed_updates: list[str],
+        processes: int | None = None,
+) -> None:
+    """Polls updates once and spreads them over ``processes`` worker processes, or handles them here if 0.
+
+    SIGINT and SIGTERM stop polling; the workers finish the updates they got and shut down.
+    """
+    if processes is None:
+        processes = get_settings().worker_processes
+    workers = ProcessWorkers(processes, build_dispatcher) if processes else LocalWorkers(bot, build_dispatcher)
+    poller = UpdatePoller(bot, allowed_updates, on_update=workers.put)
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(signum, poller.stop)
+
+    await workers.start()
+    logger.info('polling with workers', processes=processes)
+    try:
+        await poller.run()
+    finally:
+        logger.info('polling stopped, draining workers')
+        try:
+            await workers.close()
+            await poller.confirm()
+        finally:
+            await bot.session.close()
@@ -0,0 +1,97 @@
+"""The same file attached over and over: with and without the attachment index (ATTACHMENT_DEDUP).
+
+A document is forwarded to several tasks, then every task gets it once more, like a user does after
+a timeout. Without the index every attachment is a download from Telegram and an upload to the
+backend; with it the repeats to the same task are linked to the first upload and the other tasks
+get the file from its local copy.
+
+Usage: python benchmarks/attachment_dedup_bench.py [--tasks 10] [--size 4194304]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+import structlog
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from common import setup_app_import
+from fake_backend import FakeBackend, start_server
+from fake_telegram import FakeTelegram
+
+
+async def run(dedup: bool, args: argparse.Namespace, backend: FakeBackend) -> None:
+    from aiogram.types import Message
+
+    import attachment_index
+    import attachments
+    import settings
+
+    telegram = FakeTelegram()
+    telegram.add_file('report', os.urandom(args.size))
+    telegram_runner, telegram_address = await start_server(telegram.make_app())
+    bot = Bot('42:benchmark', session=AiohttpSession(api=TelegramAPIServer.from_base(f'http://{telegram_address}')))
+    backend.attachments.clear()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ['DATA_DIR'] = data_dir
+        os.environ['ATTACHMENT_DEDUP'] = '1' if dedup else ''
+        settings.get_settings.cache_clear()
+        attachment_index.get_attachment_index.cache_clear()
+        await attachments.upload_transport.start()
+
+        def forward(message_id: int) -> Message:
+            return Message.model_validate({
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': 1, 'type': 'private'},
+                **telegram.document('report', 'report.pdf'),
+            }).as_(bot)
+
+        task_ids = list(backend.tasks)[:args.tasks]
+        try:
+            started = time.perf_counter()
+            for round_ in range(2):
+                for task_id in task_ids:
+                    await attachments.upload_attachment(forward(round_ * len(task_ids) + task_id), task_id)
+            elapsed = time.perf_counter() - started
+            if (index := attachment_index.get_attachment_index()) is not None:
+                await index.close()
+        finally:
+            await attachments.upload_transport.close()
+            await bot.session.close()
+            await telegram_runner.cleanup()
+
+    downloads = telegram.calls['getfile']
+    uploads = sum(map(len, backend.attachments.values()))
+    print(
+        f'{"index" if dedup else "no index":>8}: {elapsed:.2f} s, {2 * len(task_ids)} attachments, '
+        f'{downloads} downloads ({downloads * args.size / 1024 ** 2:.1f} MiB), '
+        f'{uploads} uploads ({uploads * args.size / 1024 ** 2:.1f} MiB)'
+    )
+
+
+async def main(args: argparse.Namespace) -> None:
+    backend = FakeBackend()
+    for task_id in range(1, args.tasks + 1):
+        backend.tasks[task_id] = {'id': task_id, 'title': f'task {task_id}'}
+    backend_runner, backend_address = await start_server(backend.make_app())
+    setup_app_import(backend_address)
+    # a log line per attachment would bury the results
+    structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING))
+    try:
+        await run(dedup=False, args=args, backend=backend)
+        await run(dedup=True, args=args, backend=backend)
+    finally:
+        await backend_runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=10)
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024, help='size of the file in bytes')
+    asyncio.run(main(parser.parse_args()))
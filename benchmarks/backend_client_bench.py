@@ -0,0 +1,71 @@
+"""Requests per second against a local fake backend: per-call ``aiohttp.request`` vs the pooled client.
+
+Usage: python benchmarks/backend_client_bench.py [--requests 2000] [--concurrency 50]
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+from common import setup_app_import
+from fake_backend import FakeBackend, start_server
+
+
+async def run_per_call(url: str, requests: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one() -> None:
+        async with semaphore:
+            async with aiohttp.request('get', url) as response:
+                await response.read()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return requests / (time.perf_counter() - started)
+
+
+async def run_pooled(task_id: int, requests: int, concurrency: int) -> float:
+    from backend_client import get_backend
+    from url import Url
+
+    client = get_backend()
+    await client.start()
+    semaphore = asyncio.Semaphore(concurrency)
+    url = Url('task', task_id)
+
+    async def one() -> None:
+        async with semaphore:
+            async with client.request('get', url) as response:
+                await response.read()
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        return requests / (time.perf_counter() - started)
+    finally:
+        await client.close()
+
+
+async def main(requests: int, concurrency: int) -> None:
+    backend = FakeBackend()
+    backend.tasks[1] = {'id': 1, 'title': 'benchmark', 'description': None, 'related_task_ids': []}
+    runner, address = await start_server(backend.make_app())
+    setup_app_import(address)
+
+    try:
+        per_call = await run_per_call(f'http://{address}/v1/tasks/tasks/1', requests, concurrency)
+        pooled = await run_pooled(1, requests, concurrency)
+    finally:
+        await runner.cleanup()
+
+    print(f'aiohttp.request per call: {per_call:10.1f} req/s')
+    print(f'pooled BackendClient:     {pooled:10.1f} req/s  (x{pooled / per_call:.2f})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
@@ -0,0 +1,21 @@
+import os
+import sys
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent / 'app'
+
+
+def setup_app_import(backend_address: str, api_version: str = 'v1') -> None:
+    """Makes the bot modules importable against a local backend without a real ``.env``."""
+    os.environ['IP_ADDRESS'] = backend_address
+    os.environ['API_VERSION'] = api_version
+    os.environ.setdefault('API_TOKEN', '42:benchmark')
+    if str(APP_DIR) not in sys.path:
+        sys.path.insert(0, str(APP_DIR))
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
@@ -0,0 +1,61 @@
+"""Overhead of the loop monitor (diagnostics.LoopMonitor): busy and idle.
+
+Busy: many tasks switching on ``asyncio.sleep(0)``, the worst case for timing every callback.
+Idle: CPU time the process uses while nothing but the lag sampler runs.
+
+Usage: python benchmarks/diagnostics_bench.py [--tasks 100] [--switches 2000] [--idle 5]
+"""
+import argparse
+import asyncio
+import logging
+import resource
+import time
+
+import structlog
+
+from common import setup_app_import
+
+
+async def switch(switches: int) -> None:
+    for _ in range(switches):
+        await asyncio.sleep(0)
+
+
+async def measure_busy(tasks: int, switches: int) -> float:
+    started = time.perf_counter()
+    await asyncio.gather(*(switch(switches) for _ in range(tasks)))
+    return (time.perf_counter() - started) / (tasks * switches) * 1e6
+
+
+def cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def main(args: argparse.Namespace) -> None:
+    setup_app_import('127.0.0.1:1')
+    structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.ERROR))
+    from diagnostics import HandlerTracker, LoopMonitor
+
+    plain = await measure_busy(args.tasks, args.switches)
+    monitor = LoopMonitor(lag_interval=1, slow_threshold=0.1, tracker=HandlerTracker())
+    await monitor.start()
+    try:
+        monitored = await measure_busy(args.tasks, args.switches)
+        cpu_started = cpu_time()
+        await asyncio.sleep(args.idle)
+        idle_cpu = cpu_time() - cpu_started
+    finally:
+        await monitor.close()
+
+    print(f'task switch: {plain:.2f} us without the monitor, {monitored:.2f} us with it '
+          f'(+{(monitored / plain - 1) * 100:.0f}%)')
+    print(f'idle: {idle_cpu * 1000:.1f} ms of CPU in {args.idle:g} s ({idle_cpu / args.idle * 100:.3f}% of a core)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=100)
+    parser.add_argument('--switches', type=int, default=2000)
+    parser.add_argument('--idle', type=float, default=5, help='seconds to measure the idle overhead')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,245 @@
+"""End-to-end load test: the real bot process against a fake Telegram Bot API and a fake backend.
+
+The bot is started from ``app/main.py`` in polling mode (or in workers mode with ``--workers N``)
+with ``TELEGRAM_API_URL`` pointing at the fake Telegram. Every virtual user runs all conversations
+in turn, step by step like a person would: send a message, wait for the bot's answer, send the next
+one. Everything runs on localhost, so it works offline, e.g. in CI; the exit code is 1 if any
+conversation failed. CI runs it in both modes:
+
+    python benchmarks/e2e_load.py && python benchmarks/e2e_load.py --workers 2
+
+Usage: python benchmarks/e2e_load.py [--users 20] [--rounds 2] [--attachment-size 262144] [--workers 4]
+"""
+import argparse
+import asyncio
+import os
+import re
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from common import APP_DIR, percentile
+from fake_backend import FakeBackend, start_server
+from fake_telegram import FakeTelegram
+
+USER_ID_RE = re.compile(r'user_id: (\d+)')
+TASK_ID_RE = re.compile(r'created task id: (\d+)')
+ATTACHMENT_TASK_ID_RE = re.compile(r'/media/(\d+)/')
+
+
+class VirtualUser:
+    def __init__(self, telegram: FakeTelegram, backend: FakeBackend, user_id: int, timeout: float) -> None:
+        self.telegram = telegram
+        self.backend = backend
+        self.user_id = user_id
+        self.timeout = timeout
+        self.backend_user_id: int | None = None
+        self.task_id: int | None = None
+        self.quick_task_id: int | None = None
+
+    async def step(self, expect: str, text: str | None = None, **fields) -> dict:
+        await self.telegram.send_message(self.user_id, text, **fields)
+        return await self.telegram.wait_for(self.user_id, expect, self.timeout)
+
+    async def start(self) -> None:
+        await self.step('Выберите команду', '/start')
+
+    async def create_user(self) -> None:
+        await self.step('Please enter user_name', '/create_user')
+        reply = await self.step('user_id: ', f'user {self.user_id}')
+        self.backend_user_id = int(USER_ID_RE.search(reply['text'])[1])
+
+    async def create_task(self) -> None:
+        await self.step('Enter task title', '/create_task')
+        await self.step('Enter task description', f'task of {self.user_id}')
+        await self.step('Enter reporter id', '-')
+        await self.step('Enter assignee id', str(self.backend_user_id))
+        await self.step('Enter related task ids', '-')
+        reply = await self.step('created task id: ', '-')
+        self.task_id = int(TASK_ID_RE.search(reply['text'])[1])
+
+    async def create_task_one_shot(self) -> None:
+        reply = await self.step(
+            'created task id: ', f'/create_task quick task | - | {self.backend_user_id} | - | {self.task_id}',
+        )
+        self.quick_task_id = int(TASK_ID_RE.search(reply['text'])[1])
+
+    async def get_task(self) -> None:
+        await self.step('Enter task id', '/get_task')
+        await self.step('```json', str(self.task_id))
+
+    async def get_task_one_shot(self) -> None:
+        await self.step('```json', f'/get_task {self.task_id}')
+
+    async def create_comment(self) -> None:
+        await self.step('Enter comment text', '/create_comment')
+        await self.step('Enter user id', 'looks good')
+        await self.step('Enter task id', str(self.backend_user_id))
+        await self.step('```json', str(self.task_id))
+
+    async def create_comment_one_shot(self) -> None:
+        await self.step('```json', f'/create_comment {self.task_id} {self.backend_user_id} looks good')
+
+    async def add_attachment(self) -> None:
+        await self.step('Enter task id', '/add_attachment_to_task')
+        await self.step('Choose attachments', str(self.task_id))
+        await self.step('Uploaded 1/1', **self.telegram.document('attachment', 'report.pdf'))
+
+    async def attach_one_shot(self) -> None:
+        await self.step('Uploaded 1/1', caption=f'/attach {self.task_id}', **self.telegram.document('attachment', 'report.pdf'))
+
+    async def attach_two_tasks(self) -> None:
+        # both files arrive within one batch window, still every one must go to its own task
+        document = self.telegram.document('attachment', 'report.pdf')
+        await self.telegram.send_message(self.user_id, caption=f'/attach {self.task_id}', **document)
+        await self.telegram.send_message(self.user_id, caption=f'/attach {self.quick_task_id}', **document)
+        replies = [await self.telegram.wait_for(self.user_id, 'Uploaded 1/1', self.timeout) for _ in range(2)]
+        uploaded_to = {int(ATTACHMENT_TASK_ID_RE.search(reply['text'])[1]) for reply in replies}
+        if uploaded_to != {self.task_id, self.quick_task_id}:
+            raise AssertionError(f'attachments went to tasks {uploaded_to}')
+
+    async def watch_task(self) -> None:
+        await self.step('Watching task', f'/watch_task {self.task_id}')
+        # changed behind the bot's back, the background sync has to notice it
+        self.backend.tasks[self.task_id]['title'] = f'renamed at {time.time()}'
+        await self.telegram.wait_for(self.user_id, f'Task {self.task_id} changed', self.timeout)
+        await self.step(f'Task {self.task_id} is not watched', f'/unwatch_task {self.task_id}')
+
+
+CONVERSATIONS = [
+    'start', 'create_user', 'create_task', 'create_task_one_shot', 'get_task', 'get_task_one_shot',
+    'create_comment', 'create_comment_one_shot', 'add_attachment', 'attach_one_shot', 'attach_two_tasks',
+    'watch_task',
+]
+
+
+def get_peak_rss(pid: int) -> int | None:
+    """Peak RSS of the process plus its children, i.e. the worker processes."""
+    try:
+        status = Path(f'/proc/{pid}/status').read_text()
+        children = Path(f'/proc/{pid}/task/{pid}/children').read_text().split()
+    except OSError:
+        return None
+    match = re.search(r'VmHWM:\s+(\d+) kB', status)
+    if not match:
+        return None
+    return int(match[1]) * 1024 + sum(get_peak_rss(int(child)) or 0 for child in children)
+
+
+async def start_bot(telegram_address: str, backend_address: str, data_dir: str, args: argparse.Namespace):
+    env = {
+        **os.environ,
+        'API_TOKEN': '42:e2e',
+        'TELEGRAM_API_URL': f'http://{telegram_address}',
+        'IP_ADDRESS': backend_address,
+        'API_VERSION': 'v1',
+        'BOT_MODE': 'workers' if args.workers is not None else 'polling',
+        'WORKER_PROCESSES': str(args.workers or 0),
+        'DATA_DIR': data_dir,
+        'FSM_STORAGE': args.fsm_storage,
+        'METRICS_PORT': '0',
+        'LOG_MODE': 'prod',
+        'LOG_LEVEL': 'warning',
+        'ATTACHMENT_BATCH_WINDOW': str(args.batch_window),
+        # the virtual users are scripted, the limits would only measure themselves
+        'RATE_LIMIT_USER_RATE': '1000',
+        'RATE_LIMIT_USER_BURST': '1000',
+        'RATE_LIMIT_COMMAND_RATE': '1000',
+        'RATE_LIMIT_COMMAND_BURST': '1000',
+        'RATE_LIMIT_COMMANDS': '',
+        # every reply still goes through the outbound scheduler, but the limits are far above what
+        # the virtual users send; the fake Telegram has no flood limits, see outbound_bench.py for those
+        'OUTBOUND_GLOBAL_RATE': '1000',
+        'OUTBOUND_CHAT_RATE': '1000',
+        'OUTBOUND_CHAT_BURST': '1000',
+        'OUTBOUND_GROUP_RATE': '1000',
+        'OUTBOUND_GROUP_BURST': '1000',
+        # watched tasks are polled right away, the sync would otherwise wait for tens of seconds
+        'TASK_WATCH_MIN_INTERVAL': '0.1',
+        'TASK_WATCH_REFRESH_INTERVAL': '0.1',
+        'TASK_WATCH_RATE': '0',
+    }
+    stderr = open(Path(data_dir) / 'bot.stderr', 'wb')
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, str(APP_DIR / 'main.py'), env=env, stdout=asyncio.subprocess.DEVNULL, stderr=stderr,
+    )
+    return process, stderr
+
+
+async def main(args: argparse.Namespace) -> int:
+    backend = FakeBackend(latency=args.backend_latency)
+    telegram = FakeTelegram(latency=args.telegram_latency)
+    telegram.add_file('attachment', os.urandom(args.attachment_size))
+    backend_runner, backend_address = await start_server(backend.make_app())
+    telegram_runner, telegram_address = await start_server(telegram.make_app())
+
+    latencies: dict[str, list[float]] = defaultdict(list)
+    failures: dict[str, int] = defaultdict(int)
+
+    async def run_user(user: VirtualUser) -> None:
+        for _ in range(args.rounds):
+            for name in CONVERSATIONS:
+                started = time.perf_counter()
+                try:
+                    await getattr(user, name)()
+                except (TimeoutError, TypeError, AssertionError) as e:
+                    # a missing or wrong reply, or an id that could not be parsed; the rest of the round depends on it
+                    failures[name] += 1
+                    print(f'user {user.user_id}: {name} failed: {e!r}', file=sys.stderr)
+                    break
+                latencies[name].append(time.perf_counter() - started)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        process, stderr = await start_bot(telegram_address, backend_address, data_dir, args)
+        try:
+            while not telegram.calls['getupdates']:
+                if process.returncode is not None:
+                    raise RuntimeError(f'bot exited with code {process.returncode}')
+                await asyncio.sleep(0.1)
+
+            users = [VirtualUser(telegram, backend, 100_000 + i, args.timeout) for i in range(args.users)]
+            started = time.perf_counter()
+            await asyncio.gather(*(run_user(user) for user in users))
+            elapsed = time.perf_counter() - started
+            # measured while the bot runs, its worker processes are gone once it stopped
+            peak_rss = get_peak_rss(process.pid)
+        finally:
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+            stderr.close()
+            if process.returncode not in (0, -15) or any(failures.values()):
+                print((Path(data_dir) / 'bot.stderr').read_text()[-4000:], file=sys.stderr)
+            await telegram_runner.cleanup()
+            await backend_runner.cleanup()
+
+    conversations = sum(map(len, latencies.values()))
+    messages = sum(telegram.calls[method] for method in ('sendmessage', 'editmessagetext', 'sendphoto'))
+    mode = f'workers: {args.workers}' if args.workers is not None else 'polling'
+    print(f'users: {args.users}, rounds: {args.rounds}, {mode}, elapsed: {elapsed:.2f} s')
+    print(f'throughput: {conversations / elapsed:.1f} conversations/s, {messages / elapsed:.1f} bot messages/s')
+    print(f'peak bot RSS: {peak_rss / 2 ** 20:.1f} MiB' if peak_rss else 'peak bot RSS: n/a')
+    print(f'\n{"command":<26} {"count":>6} {"failed":>6} {"p50, ms":>9} {"p99, ms":>9}')
+    for name in CONVERSATIONS:
+        values = latencies[name]
+        print(
+            f'{name:<26} {len(values):>6} {failures[name]:>6} '
+            f'{percentile(values, 0.50) * 1000:>9.1f} {percentile(values, 0.99) * 1000:>9.1f}'
+        )
+    return 1 if any(failures.values()) else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=2)
+    parser.add_argument('--attachment-size', type=int, default=256 * 1024)
+    parser.add_argument('--backend-latency', type=float, default=0.005)
+    parser.add_argument('--telegram-latency', type=float, default=0.005)
+    parser.add_argument('--batch-window', type=float, default=0.2, help='ATTACHMENT_BATCH_WINDOW of the bot')
+    parser.add_argument('--fsm-storage', default='sqlite', choices=['memory', 'sqlite'])
+    parser.add_argument('--workers', type=int, help='run in workers mode with this many processes, 0 for in-process')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for every reply')
+    sys.exit(asyncio.run(main(parser.parse_args())))
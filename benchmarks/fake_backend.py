@@ -0,0 +1,106 @@
+import asyncio
+import hashlib
+import itertools
+import json
+
+from aiohttp import web
+
+
+class FakeBackend:
+    """In-memory stand-in for the TMS backend, serving the endpoints built by ``url.Url``.
+
+    GET responses carry an ``ETag`` and a matching ``If-None-Match`` gets a 304, like a backend
+    with conditional requests would answer.
+    """
+
+    def __init__(self, version: str = 'v1', latency: float = 0.0) -> None:
+        self.version = version
+        self.latency = latency
+        self.users: dict[int, dict] = {}
+        self.tasks: dict[int, dict] = {}
+        self.comments: dict[int, dict] = {}
+        self.attachments: dict[int, list[str]] = {}
+        self.gets = 0
+        self.not_modified = 0
+        self._ids = itertools.count(1)
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=0)
+        prefix = f'/{self.version}/tasks'
+        app.router.add_post(f'{prefix}/users/', self.create_user)
+        app.router.add_get(f'{prefix}/users/{{id:\\d+}}', self.get_user)
+        app.router.add_post(f'{prefix}/tasks/', self.create_task)
+        app.router.add_get(f'{prefix}/tasks/{{id:\\d+}}', self.get_task)
+        app.router.add_post(f'{prefix}/tasks/{{id:\\d+}}/attachments/', self.add_attachment)
+        app.router.add_post(f'{prefix}/comments/', self.create_comment)
+        app.router.add_get(f'{prefix}/comments/{{id:\\d+}}', self.get_comment)
+        return app
+
+    async def create_user(self, request: web.Request) -> web.Response:
+        await self._delay()
+        data = await request.post()
+        user = {'id': next(self._ids), 'name': data['name']}
+        self.users[user['id']] = user
+        return web.json_response(user, status=201)
+
+    async def get_user(self, request: web.Request) -> web.Response:
+        return await self._get(self.users, request)
+
+    async def create_task(self, request: web.Request) -> web.Response:
+        await self._delay()
+        data = await request.json()
+        task = {'id': next(self._ids), **data}
+        self.tasks[task['id']] = task
+        return web.json_response(task['id'], status=200)
+
+    async def get_task(self, request: web.Request) -> web.Response:
+        return await self._get(self.tasks, request)
+
+    async def create_comment(self, request: web.Request) -> web.Response:
+        await self._delay()
+        data = await request.json()
+        comment = {'id': next(self._ids), **data}
+        self.comments[comment['id']] = comment
+        return web.json_response(comment, status=201)
+
+    async def get_comment(self, request: web.Request) -> web.Response:
+        return await self._get(self.comments, request)
+
+    async def add_attachment(self, request: web.Request) -> web.Response:
+        task_id = int(request.match_info['id'])
+        if task_id not in self.tasks:
+            return web.json_response({'detail': 'Not found.'}, status=404)
+
+        size = 0
+        async for chunk in request.content.iter_any():
+            size += len(chunk)
+
+        attachment_url = f'http://{request.host}/media/{task_id}/{request.headers.get("Filename", "file")}'
+        self.attachments.setdefault(task_id, []).append(attachment_url)
+        return web.json_response({'attachment_url': attachment_url, 'size': size}, status=201)
+
+    async def _get(self, objects: dict[int, dict], request: web.Request) -> web.Response:
+        await self._delay()
+        self.gets += 1
+        obj = objects.get(int(request.match_info['id']))
+        if obj is None:
+            return web.json_response({'detail': 'Not found.'}, status=404)
+        body = json.dumps(obj).encode()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if request.headers.get('If-None-Match') == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
+
+    async def _delay(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+async def start_server(app: web.Application, host: str = '127.0.0.1', port: int = 0) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, f'{host}:{bound_port}'
@@ -0,0 +1,203 @@
+import asyncio
+import itertools
+import json
+import math
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+# aiogram sends complex values as JSON strings inside the form
+JSON_PARAMS = frozenset({'reply_markup', 'entities', 'allowed_updates', 'commands', 'results', 'link_preview_options'})
+MESSAGE_METHODS = frozenset({'sendmessage', 'editmessagetext', 'sendphoto', 'senddocument'})
+
+
+class FloodControl:
+    """Telegram-like flood limits: token buckets per bot and per chat, a request over them gets a 429."""
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: int = 3) -> None:
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._buckets: dict[int | None, tuple[float, float]] = {}
+        self.rejected = 0
+
+    def retry_after(self, chat_id: int) -> int:
+        """0 if the message may be sent now, otherwise the seconds to wait, as Telegram rounds them."""
+        now = time.monotonic()
+        waits = []
+        for key, rate, burst in ((None, self.global_rate, int(self.global_rate)), (chat_id, self.chat_rate, self.chat_burst)):
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            self._buckets[key] = (tokens, now)
+            waits.append(max(0.0, (1 - tokens) / rate))
+        if max(waits) > 0:
+            self.rejected += 1
+            return max(1, math.ceil(max(waits)))
+        for key in (None, chat_id):
+            tokens, updated_at = self._buckets[key]
+            self._buckets[key] = (tokens - 1, updated_at)
+        return 0
+
+
+class FakeTelegram:
+    """In-memory stand-in for the Telegram Bot API, for a bot started with ``TELEGRAM_API_URL``.
+
+    Virtual users push updates with ``send_message`` and read what the bot sent to their chat
+    with ``wait_for``. Files registered with ``add_file`` can be fetched through ``getFile``
+    and downloaded, with ``Range`` support.
+    """
+
+    def __init__(self, latency: float = 0.0, flood_control: FloodControl | None = None) -> None:
+        self.latency = latency
+        self.flood_control = flood_control
+        self.files: dict[str, bytes] = {}
+        self.calls: dict[str, int] = defaultdict(int)
+        self._updates: list[dict] = []
+        self._new_update = asyncio.Condition()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._outbox: dict[int, asyncio.Queue[dict]] = defaultdict(asyncio.Queue)
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=0)
+        app.router.add_post('/bot{token}/{method}', self.call)
+        app.router.add_get('/file/bot{token}/{path:.+}', self.download)
+        return app
+
+    def add_file(self, file_id: str, content: bytes) -> None:
+        self.files[file_id] = content
+
+    async def send_message(self, user_id: int, text: str | None = None, **fields) -> None:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user {user_id}'},
+            **fields,
+        }
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        async with self._new_update:
+            self._updates.append({'update_id': next(self._update_ids), 'message': message})
+            self._new_update.notify_all()
+
+    def document(self, file_id: str, file_name: str) -> dict:
+        return {
+            'document': {
+                'file_id': file_id,
+                'file_unique_id': f'unique-{file_id}',
+                'file_name': file_name,
+                'file_size': len(self.files[file_id]),
+            },
+        }
+
+    async def wait_for(self, chat_id: int, prefix: str, timeout: float) -> dict:
+        """Waits for a message or an edit sent to the chat whose text starts with ``prefix``."""
+        outbox = self._outbox[chat_id]
+        async with asyncio.timeout(timeout):
+            while True:
+                message = await outbox.get()
+                if (message.get('text') or '').startswith(prefix):
+                    return message
+
+    async def call(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        self.calls[method] += 1
+        params = await self._read_params(request)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.flood_control is not None and method in MESSAGE_METHODS:
+            if retry_after := self.flood_control.retry_after(int(params['chat_id'])):
+                return web.json_response({
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {retry_after}',
+                    'parameters': {'retry_after': retry_after},
+                }, status=429)
+
+        handler = getattr(self, f'_method_{method}', None)
+        result = await handler(params) if handler is not None else True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def download(self, request: web.Request) -> web.StreamResponse:
+        file_id = request.match_info['path'].rsplit('/', 1)[-1]
+        content = self.files.get(file_id)
+        if content is None:
+            raise web.HTTPNotFound()
+
+        if range_header := request.headers.get('Range'):
+            start = int(range_header.removeprefix('bytes=').split('-')[0])
+            return web.Response(
+                body=content[start:], status=206,
+                headers={'Content-Range': f'bytes {start}-{len(content) - 1}/{len(content)}'},
+            )
+        return web.Response(body=content)
+
+    async def _method_getme(self, params: dict) -> dict:
+        return {'id': 42, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+
+    async def _method_getupdates(self, params: dict) -> list[dict]:
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+
+        def pending() -> list[dict]:
+            return [update for update in self._updates if update['update_id'] >= offset]
+
+        async with self._new_update:
+            # confirmed updates are dropped, like Telegram does
+            self._updates = pending()
+            try:
+                async with asyncio.timeout(timeout):
+                    await self._new_update.wait_for(pending)
+            except TimeoutError:
+                pass
+            return pending()[:int(params.get('limit') or 100)]
+
+    async def _method_sendmessage(self, params: dict) -> dict:
+        return self._deliver(params, text=params['text'])
+
+    async def _method_editmessagetext(self, params: dict) -> dict:
+        return self._deliver(params, text=params['text'], message_id=int(params['message_id']))
+
+    async def _method_sendphoto(self, params: dict) -> dict:
+        return self._deliver(params, photo=[
+            {'file_id': 'welcome-photo', 'file_unique_id': 'welcome-photo', 'width': 1, 'height': 1},
+        ])
+
+    async def _method_senddocument(self, params: dict) -> dict:
+        return self._deliver(params, document={'file_id': 'report', 'file_unique_id': 'report'})
+
+    async def _method_getfile(self, params: dict) -> dict:
+        file_id = params['file_id']
+        return {
+            'file_id': file_id,
+            'file_unique_id': f'unique-{file_id}',
+            'file_size': len(self.files.get(file_id, b'')),
+            'file_path': f'documents/{file_id}',
+        }
+
+    def _deliver(self, params: dict, message_id: int | None = None, **content) -> dict:
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': message_id or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            **content,
+        }
+        self._outbox[chat_id].put_nowait(message)
+        return message
+
+    @staticmethod
+    async def _read_params(request: web.Request) -> dict:
+        if request.content_type == 'application/json':
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            if key in JSON_PARAMS:
+                value = json.loads(value)
+            params[key] = value
+        return params
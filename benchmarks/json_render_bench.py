@@ -0,0 +1,84 @@
+"""Rendering of large task payloads: the old json.loads/json.dumps path vs rendering.render_json.
+
+The old path produced one Markdown message and Telegram rejected everything over 4096 characters;
+the new one indents the raw body with orjson and splits it into MarkdownV2 messages, or makes
+a file above JSON_DOCUMENT_THRESHOLD.
+
+Usage: python benchmarks/json_render_bench.py [--iterations 200]
+"""
+import argparse
+import json
+import time
+
+import orjson
+
+from common import setup_app_import
+
+TELEGRAM_MESSAGE_MAX_LENGTH = 4096
+
+PAYLOADS = {
+    'small task': (200, 5),
+    'long description': (3_000, 20),
+    'over the limit': (2_000, 400),
+    'many related ids': (500, 2_000),
+    'huge task': (50_000, 10_000),
+}
+
+
+def make_task(description_size: int, related_ids: int) -> bytes:
+    description = ('Steps to reproduce: open the "report" page, press `Export`. ' * 100)[:description_size]
+    return orjson.dumps({
+        'id': 42,
+        'title': 'Export fails for big reports',
+        'description': description,
+        'reporter_id': 1,
+        'assignee_id': 2,
+        'related_task_ids': list(range(1, related_ids + 1)),
+        'attachments': [],
+    })
+
+
+def render_old(body: bytes) -> str:
+    # what the handlers did: decode, encode again, wrap in a legacy Markdown code block
+    return f'```json\n{json.dumps(json.loads(body))}\n```'
+
+
+def measure(render, body: bytes, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        render(body)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main(iterations: int) -> None:
+    setup_app_import('127.0.0.1:1')
+    from rendering import render_json
+    from settings import get_settings
+
+    threshold = get_settings().json_document_threshold
+    # the uncached function, a cache hit would only measure the lookup
+    render_new = render_json.__wrapped__
+
+    print(f'{"payload":<18} {"bytes":>8} {"old, us":>9} {"new, us":>9} {"cached, us":>11}  result')
+    for name, (description_size, related_ids) in PAYLOADS.items():
+        body = make_task(description_size, related_ids)
+        old = measure(render_old, body, iterations)
+        new = measure(lambda body: render_new(body, threshold), body, iterations)
+        cached = measure(lambda body: render_json(body, threshold), body, iterations)
+
+        old_fits = len(render_old(body)) <= TELEGRAM_MESSAGE_MAX_LENGTH
+        rendered = render_new(body, threshold)
+        if rendered.document is not None:
+            result = f'file of {len(rendered.document)} bytes'
+        else:
+            result = f'{len(rendered.messages)} message(s)'
+        print(
+            f'{name:<18} {len(body):>8} {old:>9.1f} {new:>9.1f} {cached:>11.2f}  '
+            f'{result}{"" if old_fits else ", the old reply was rejected as too long"}'
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=200)
+    main(parser.parse_args().iterations)
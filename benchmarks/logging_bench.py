@@ -0,0 +1,116 @@
+"""Log calls per second and event-loop lag: ``LOG_MODE=dev`` vs ``LOG_MODE=prod``.
+
+Every mode runs in a child process whose stdout is either ``/dev/null`` or a pipe drained slowly
+by another process, the way a congested log collector behaves. While the child logs in bursts
+like handlers do, a ticker task measures how late the event loop wakes it up.
+
+Usage: python benchmarks/logging_bench.py [--calls 100000] [--burst 20] [--slow-reader-rate 2000000]
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+
+from common import percentile, setup_app_import
+
+SLOW_READER = '''
+import sys, time
+rate = float(sys.argv[1])
+while chunk := sys.stdin.buffer.read1(16384):
+    time.sleep(len(chunk) / rate)
+'''
+
+
+async def measure(calls: int, burst: int) -> dict:
+    import structlog
+
+    logger = structlog.get_logger('benchmark')
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker() -> None:
+        loop = asyncio.get_running_loop()
+        while not done.is_set():
+            expected = loop.time() + 0.001
+            await asyncio.sleep(0.001)
+            lags.append(loop.time() - expected)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+
+    started = time.perf_counter()
+    for i in range(0, calls, burst):
+        for j in range(i, min(i + burst, calls)):
+            logger.info('task title has been chosen', title='benchmark task', user_id=j, command='create_task')
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+
+    done.set()
+    await ticker_task
+    return {
+        'calls_per_second': calls / elapsed,
+        'lag_p99_ms': percentile(lags, 0.99) * 1000,
+        'lag_max_ms': max(lags, default=0) * 1000,
+    }
+
+
+def run_child(mode: str, calls: int, burst: int) -> None:
+    setup_app_import('127.0.0.1:1')
+    from log_config import configure_logging
+
+    configure_logging(mode=mode, level='info')
+    result = asyncio.run(measure(calls, burst))
+    print(json.dumps(result), file=sys.stderr, flush=True)
+
+
+def run_case(mode: str, sink: str, args: argparse.Namespace) -> dict:
+    command = [
+        sys.executable, __file__, '--child', mode,
+        '--calls', str(args.calls), '--burst', str(args.burst),
+    ]
+    reader = None
+    if sink == 'slow pipe':
+        reader = subprocess.Popen(
+            [sys.executable, '-c', SLOW_READER, str(args.slow_reader_rate)], stdin=subprocess.PIPE,
+        )
+        stdout = reader.stdin
+    else:
+        stdout = subprocess.DEVNULL
+
+    try:
+        child = subprocess.run(command, stdout=stdout, stderr=subprocess.PIPE, check=True, text=True)
+    finally:
+        if reader is not None:
+            reader.stdin.close()
+            reader.kill()
+            reader.wait()
+
+    return json.loads(child.stderr.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=100_000)
+    parser.add_argument('--burst', type=int, default=20, help='log calls between event-loop yields')
+    parser.add_argument('--slow-reader-rate', type=float, default=2_000_000, help='bytes per second')
+    parser.add_argument('--child', choices=['dev', 'prod'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.calls, args.burst)
+        return
+
+    print(f'{"mode":<6} {"stdout":<10} {"calls/s":>10} {"lag p99, ms":>12} {"lag max, ms":>12}')
+    for sink in ('/dev/null', 'slow pipe'):
+        for mode in ('dev', 'prod'):
+            result = run_case(mode, sink, args)
+            print(
+                f'{mode:<6} {sink:<10} {result["calls_per_second"]:>10.0f} '
+                f'{result["lag_p99_ms"]:>12.2f} {result["lag_max_ms"]:>12.2f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
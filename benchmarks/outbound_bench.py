@@ -0,0 +1,106 @@
+"""Bursts of replies and progress edits against a fake Telegram that enforces flood limits.
+
+Every chat sends a few replies at once and edits a progress message in a loop, all chats at the
+same time. Without the scheduler the requests over the limits come back as 429s and are lost;
+with it they wait for their turn, quick replies to a chat are merged and stale edits are dropped.
+
+Usage: python benchmarks/outbound_bench.py [--chats 20] [--replies 3] [--edits 10]
+"""
+import argparse
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+
+from common import percentile, setup_app_import
+from fake_backend import start_server
+from fake_telegram import FakeTelegram, FloodControl
+
+
+async def run(scheduled: bool, args: argparse.Namespace) -> None:
+    from outbound import OutboundScheduler, standalone
+
+    flood_control = FloodControl(global_rate=args.global_rate, chat_rate=args.chat_rate, chat_burst=args.chat_burst)
+    telegram = FakeTelegram(flood_control=flood_control)
+    runner, address = await start_server(telegram.make_app())
+    bot = Bot('42:benchmark', session=AiohttpSession(api=TelegramAPIServer.from_base(f'http://{address}')))
+    if scheduled:
+        bot.session.middleware(OutboundScheduler(
+            global_rate=args.global_rate,
+            chat_rate=args.chat_rate,
+            chat_burst=args.chat_burst,
+            group_rate=args.chat_rate,
+            group_burst=args.chat_burst,
+            max_retries=5,
+            max_chats=10_000,
+        ))
+
+    latencies: dict[str, list[float]] = {'reply': [], 'edit': []}
+    dropped = {'reply': 0, 'edit': 0}
+
+    async def call(kind: str, coroutine) -> None:
+        started = time.perf_counter()
+        try:
+            await coroutine
+        except TelegramRetryAfter:
+            dropped[kind] += 1
+            return
+        latencies[kind].append(time.perf_counter() - started)
+
+    async def chat(chat_id: int) -> None:
+        try:
+            with standalone():
+                progress = await bot.send_message(chat_id, 'Uploading...')
+        except TelegramRetryAfter:
+            dropped['reply'] += 1
+            return
+
+        async def edit_progress() -> None:
+            for done in range(1, args.edits + 1):
+                await call('edit', bot.edit_message_text(
+                    f'Uploading: {done}/{args.edits}', chat_id=chat_id, message_id=progress.message_id,
+                ))
+                await asyncio.sleep(args.edit_interval)
+
+        await asyncio.gather(
+            edit_progress(),
+            *(call('reply', bot.send_message(chat_id, f'reply {i}')) for i in range(args.replies)),
+        )
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(chat(100_000 + i) for i in range(args.chats)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
+
+    calls = sum(telegram.calls[method] for method in ('sendmessage', 'editmessagetext')) - flood_control.rejected
+    print(f'{"scheduler" if scheduled else "direct"}: {elapsed:.2f} s, {calls / elapsed:.1f} messages/s delivered, '
+          f'{flood_control.rejected} rejected with 429')
+    for kind, values in latencies.items():
+        print(
+            f'  {kind:<6} ok {len(values):>5}  dropped {dropped[kind]:>5}  '
+            f'p50 {percentile(values, 0.50) * 1000:>8.1f} ms  p99 {percentile(values, 0.99) * 1000:>8.1f} ms'
+        )
+
+
+async def main(args: argparse.Namespace) -> None:
+    setup_app_import('127.0.0.1:1')
+    await run(scheduled=False, args=args)
+    await run(scheduled=True, args=args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--replies', type=int, default=3, help='replies sent at once to every chat')
+    parser.add_argument('--edits', type=int, default=10, help='progress edits per chat')
+    parser.add_argument('--edit-interval', type=float, default=0.1)
+    parser.add_argument('--global-rate', type=float, default=30)
+    parser.add_argument('--chat-rate', type=float, default=1)
+    parser.add_argument('--chat-burst', type=int, default=3)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,149 @@
+"""Peak RSS and throughput of the Telegram -> backend attachment relay under concurrent uploads.
+
+Compares the old fixed 5 MiB ``read`` relay with the adaptive zero-copy one. The stub servers and
+every relay variant run in separate processes, so each RSS figure only covers one relay.
+
+Usage: python benchmarks/relay_bench.py [--uploads 50]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+
+import aiohttp
+import httpx
+from aiohttp import web
+
+from common import setup_app_import
+from fake_backend import FakeBackend, start_server
+
+FILE_SIZES = [50 * 1024, 300 * 1024, 2 * 1024 * 1024, 8 * 1024 * 1024, 24 * 1024 * 1024]
+PAYLOAD = os.urandom(256 * 1024)
+
+
+async def serve_file(request: web.Request) -> web.StreamResponse:
+    size = int(request.match_info['size'])
+    response = web.StreamResponse(headers={'Content-Length': str(size)})
+    await response.prepare(request)
+    for offset in range(0, size, len(PAYLOAD)):
+        await response.write(PAYLOAD[:min(len(PAYLOAD), size - offset)])
+    return response
+
+
+async def run_servers() -> None:
+    backend = FakeBackend()
+    backend.tasks[1] = {'id': 1, 'title': 'relay benchmark'}
+    backend_runner, backend_address = await start_server(backend.make_app())
+
+    files_app = web.Application()
+    files_app.router.add_get('/file/bot{token}/{size:\\d+}.bin', serve_file)
+    files_runner, files_address = await start_server(files_app)
+
+    print(json.dumps({'backend': backend_address, 'files': files_address}), flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await backend_runner.cleanup()
+        await files_runner.cleanup()
+
+
+class FixedChunkReader:
+    """The relay as it was: a fixed 5 MiB ``read`` per chunk."""
+    CHUNK_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, stream_reader) -> None:
+        self._stream_reader = stream_reader
+
+    async def __aiter__(self):
+        while chunk := await self._stream_reader.read(self.CHUNK_SIZE):
+            yield chunk
+
+
+def current_rss_kib() -> int:
+    with open('/proc/self/status') as f:
+        return int(re.search(r'VmRSS:\s+(\d+)', f.read()).group(1))
+
+
+async def run_client(reader: str, backend_address: str, files_address: str, uploads: int) -> None:
+    setup_app_import(backend_address)
+    import attachments
+
+    sizes = list(itertools.islice(itertools.cycle(FILE_SIZES), uploads))
+    upload_url = f'http://{backend_address}/v1/tasks/tasks/1/attachments/'
+    baseline_rss = current_rss_kib()
+
+    async with aiohttp.ClientSession() as session, httpx.AsyncClient(timeout=200) as client:
+        async def relay(size: int) -> None:
+            file_url = f'http://{files_address}/file/bot42:benchmark/{size}.bin'
+            if reader == 'fixed':
+                async with session.get(file_url) as download:
+                    content = FixedChunkReader(download.content)
+                    response = await client.post(upload_url, content=content, headers={'Content-Length': str(size)})
+            else:
+                buffer_size = attachments.get_read_buffer_size(size)
+                reserved = await attachments.get_memory_budget().acquire(2 * buffer_size)
+                try:
+                    async with session.get(file_url, read_bufsize=buffer_size) as download:
+                        content = attachments.AsyncIterableOverStreamReader(download.content, size)
+                        response = await client.post(
+                            upload_url, content=content, headers={'Content-Length': str(size)},
+                        )
+                finally:
+                    attachments.get_memory_budget().release(reserved)
+            assert response.status_code == 201, response.text
+            assert response.json()['size'] == size
+
+        started = time.perf_counter()
+        await asyncio.gather(*(relay(size) for size in sizes))
+        elapsed = time.perf_counter() - started
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        'throughput_mib_s': sum(sizes) / elapsed / 1024 ** 2,
+        'peak_rss_mib': peak_rss / 1024,
+        'peak_rss_growth_mib': (peak_rss - baseline_rss) / 1024,
+    }))
+
+
+def main(uploads: int) -> None:
+    script = os.path.abspath(__file__)
+    servers = subprocess.Popen([sys.executable, script, '--role', 'servers'], stdout=subprocess.PIPE, text=True)
+    try:
+        addresses = json.loads(servers.stdout.readline())
+        for reader in ('fixed', 'adaptive'):
+            output = subprocess.run(
+                [sys.executable, script, '--role', 'client', '--reader', reader, '--uploads', str(uploads),
+                 '--backend', addresses['backend'], '--files', addresses['files']],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(
+                f'{reader:>8}: {result["throughput_mib_s"]:8.1f} MiB/s, '
+                f'peak RSS {result["peak_rss_mib"]:7.1f} MiB (+{result["peak_rss_growth_mib"]:.1f} MiB during uploads)'
+            )
+    finally:
+        servers.terminate()
+        servers.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--role', choices=['main', 'servers', 'client'], default='main')
+    parser.add_argument('--reader', choices=['fixed', 'adaptive'])
+    parser.add_argument('--uploads', type=int, default=50)
+    parser.add_argument('--backend')
+    parser.add_argument('--files')
+    args = parser.parse_args()
+
+    if args.role == 'servers':
+        asyncio.run(run_servers())
+    elif args.role == 'client':
+        asyncio.run(run_client(args.reader, args.backend, args.files, args.uploads))
+    else:
+        main(args.uploads)
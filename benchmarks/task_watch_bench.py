@@ -0,0 +1,101 @@
+"""Backend load of /watch_task: many chats watching tasks that rarely change.
+
+Every chat watches a few of the tasks, a few tasks change every second. Compared with what
+polling every watch on its own would cost: one GET per watch every TASK_WATCH_MIN_INTERVAL.
+
+Usage: python benchmarks/task_watch_bench.py [--chats 500] [--tasks 200] [--duration 20]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+
+import structlog
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from common import setup_app_import
+from fake_backend import FakeBackend, start_server
+from fake_telegram import FakeTelegram
+
+
+async def main(args: argparse.Namespace) -> None:
+    backend = FakeBackend()
+    for task_id in range(1, args.tasks + 1):
+        backend.tasks[task_id] = {'id': task_id, 'title': f'task {task_id}', 'related_task_ids': []}
+    backend_runner, backend_address = await start_server(backend.make_app())
+    telegram = FakeTelegram()
+    telegram_runner, telegram_address = await start_server(telegram.make_app())
+    setup_app_import(backend_address)
+    structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING))
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ['DATA_DIR'] = data_dir
+        from backend_client import get_backend
+        from task_watch import TaskSync, get_watch_store
+        from url import Url
+
+        backend_client = get_backend()
+        await backend_client.start()
+        store = get_watch_store()
+        watches = 0
+        for chat_id in range(1, args.chats + 1):
+            for task_id in random.sample(sorted(backend.tasks), args.watches_per_chat):
+                response = await backend_client.get_cached(Url('task', task_id))
+                watches += await store.add(chat_id, task_id, response.body)
+
+        bot = Bot('42:benchmark', session=AiohttpSession(api=TelegramAPIServer.from_base(f'http://{telegram_address}')))
+        sync = TaskSync(
+            store,
+            min_interval=args.min_interval,
+            max_interval=args.max_interval,
+            jitter=0.2,
+            rate=args.rate,
+            concurrency=5,
+            refresh_interval=1,
+            enabled=True,
+        )
+        gets_before = backend.gets
+        await sync.start(bot)
+        changes = 0
+        started = time.perf_counter()
+        try:
+            while time.perf_counter() - started < args.duration:
+                for task_id in random.sample(sorted(backend.tasks), args.changes_per_second):
+                    backend.tasks[task_id]['related_task_ids'].append(changes)
+                    changes += 1
+                await asyncio.sleep(1)
+        finally:
+            elapsed = time.perf_counter() - started
+            await sync.close()
+            await bot.session.close()
+            await backend_client.close()
+            await store.close()
+            await telegram_runner.cleanup()
+            await backend_runner.cleanup()
+
+    gets = backend.gets - gets_before
+    print(f'{args.chats} chats, {watches} watches of {args.tasks} tasks, {changes} changes in {elapsed:.0f} s')
+    print(f'naive polling:  {watches / args.min_interval * 60:>8.0f} requests/min')
+    print(
+        f'task sync:      {gets / elapsed * 60:>8.0f} requests/min, '
+        f'{backend.not_modified / max(gets, 1):.0%} answered with 304'
+    )
+    print(f'notifications:  {telegram.calls["sendmessage"]:>8}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--watches-per-chat', type=int, default=5)
+    parser.add_argument('--tasks', type=int, default=200)
+    parser.add_argument('--changes-per-second', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--min-interval', type=float, default=1, help='TASK_WATCH_MIN_INTERVAL')
+    parser.add_argument('--max-interval', type=float, default=16, help='TASK_WATCH_MAX_INTERVAL')
+    parser.add_argument('--rate', type=float, default=100, help='TASK_WATCH_RATE')
+    asyncio.run(main(parser.parse_args()))
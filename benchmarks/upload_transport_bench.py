@@ -0,0 +1,83 @@
+"""Connection-setup cost per attachment upload: fresh clients per upload vs the shared upload transport.
+
+Uploads run one after another so the difference per upload is the cost of the new aiohttp session
+and httpx client: pool and SSL context creation plus TCP setup on both legs.
+
+Usage: python benchmarks/upload_transport_bench.py [--uploads 300] [--size 16384]
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import aiohttp
+import httpx
+from aiohttp import web
+
+from common import setup_app_import
+from fake_backend import FakeBackend, start_server
+
+
+async def run(uploads: int, size: int, fresh_clients: bool) -> float:
+    import attachments
+    from url import Url
+
+    headers = {'Content-Length': str(size), 'Filename': 'bench.bin'}
+    upload_url = str(Url('task_attachments', 1))
+
+    async def upload(session: aiohttp.ClientSession, client: httpx.AsyncClient) -> None:
+        relay = attachments.ResumableRelay(session, FILES_URL, size, spool_path=None)
+        response = await client.post(upload_url, content=relay, headers=headers)
+        assert response.status_code == 201, response.text
+
+    started = time.perf_counter()
+    if fresh_clients:
+        for _ in range(uploads):
+            async with aiohttp.ClientSession() as session, httpx.AsyncClient(timeout=httpx.Timeout(200)) as client:
+                await upload(session, client)
+    else:
+        transport = attachments.UploadTransport()
+        await transport.start()
+        try:
+            for _ in range(uploads):
+                await upload(transport.telegram, transport.backend)
+        finally:
+            await transport.close()
+    return (time.perf_counter() - started) / uploads
+
+
+FILES_URL = ''
+
+
+async def main(uploads: int, size: int) -> None:
+    global FILES_URL
+
+    backend = FakeBackend()
+    backend.tasks[1] = {'id': 1, 'title': 'transport benchmark'}
+    backend_runner, backend_address = await start_server(backend.make_app())
+
+    payload = os.urandom(size)
+    files_app = web.Application()
+    files_app.router.add_get('/file', lambda _: web.Response(body=payload))
+    files_runner, files_address = await start_server(files_app)
+    FILES_URL = f'http://{files_address}/file'
+
+    setup_app_import(backend_address)
+    try:
+        fresh = await run(uploads, size, fresh_clients=True)
+        shared = await run(uploads, size, fresh_clients=False)
+    finally:
+        await backend_runner.cleanup()
+        await files_runner.cleanup()
+
+    print(f'fresh clients per upload: {fresh * 1000:7.2f} ms/upload')
+    print(f'shared upload transport:  {shared * 1000:7.2f} ms/upload')
+    print(f'setup cost removed:       {(fresh - shared) * 1000:7.2f} ms/upload')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uploads', type=int, default=300)
+    parser.add_argument('--size', type=int, default=16 * 1024)
+    args = parser.parse_args()
+    asyncio.run(main(args.uploads, args.size))
@@ -0,0 +1,76 @@
+"""Replays recorded updates against a running webhook and reports update latency.
+
+Every virtual user replays the whole recording in order with its own chat id, so the bot sees
+the same conversations it would see from real chats.
+
+Usage: python benchmarks/webhook_load.py --url http://127.0.0.1:8080/webhook --secret <WEBHOOK_SECRET>
+"""
+import argparse
+import asyncio
+import copy
+import itertools
+import json
+import time
+from pathlib import Path
+
+import aiohttp
+
+from common import percentile
+
+DEFAULT_UPDATES = Path(__file__).resolve().parent / 'data' / 'updates.jsonl'
+
+
+def load_updates(path: Path) -> list[dict]:
+    with path.open() as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def personalize(update: dict, user_id: int, update_id: int) -> dict:
+    update = copy.deepcopy(update)
+    update['update_id'] = update_id
+    message = update.get('message')
+    if message:
+        message['chat']['id'] = user_id
+        message['from']['id'] = user_id
+    return update
+
+
+async def main(url: str, secret: str | None, updates_path: Path, users: int, rounds: int) -> None:
+    updates = load_updates(updates_path)
+    update_ids = itertools.count(1)
+    latencies: list[float] = []
+    failures = 0
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+
+    async def replay(session: aiohttp.ClientSession, user_id: int) -> None:
+        nonlocal failures
+        for _ in range(rounds):
+            for update in updates:
+                payload = personalize(update, user_id, next(update_ids))
+                started = time.perf_counter()
+                async with session.post(url, json=payload, headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        failures += 1
+                latencies.append(time.perf_counter() - started)
+
+    async with aiohttp.ClientSession() as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(replay(session, 100_000 + i) for i in range(users)))
+        elapsed = time.perf_counter() - started
+
+    print(f'updates sent:  {len(latencies)} ({failures} failed)')
+    print(f'throughput:    {len(latencies) / elapsed:.1f} updates/s')
+    print(f'latency p50:   {percentile(latencies, 0.50) * 1000:.2f} ms')
+    print(f'latency p99:   {percentile(latencies, 0.99) * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook')
+    parser.add_argument('--secret')
+    parser.add_argument('--updates', type=Path, default=DEFAULT_UPDATES)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.url, args.secret, args.updates, args.users, args.rounds))